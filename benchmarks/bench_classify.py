@@ -0,0 +1,92 @@
+"""消息分类进程池扩展性基准
+
+在合成语料上比较 MessageClassifier.classify_batch 在不同进程数下的吞吐（消息/秒）。
+
+用法：
+    python benchmarks/bench_classify.py --count 1000000 --workers 1,2,4,8
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+
+# 未指定数据目录时使用临时目录，进程退出时删除
+TMP_DATA_DIR = None
+if 'TGDL_DATA_DIR' not in os.environ:
+    TMP_DATA_DIR = tempfile.TemporaryDirectory(prefix='tgdl_bench_', ignore_cleanup_errors=True)
+    os.environ['TGDL_DATA_DIR'] = TMP_DATA_DIR.name
+os.environ.setdefault('TGDL_DISABLE_TQDM', 'true')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import MessageClassifier, MessageDescriptor  # noqa: E402
+
+MEDIA_TYPES = ['video', 'audio', 'document']
+CONFIG = {
+    'download_settings': {'exclude_patterns': ['promo', 're:免费|福利'], 'max_file_size_mb': 500, 'min_file_size_mb': 0},
+    'language_filter': {'enabled': True, 'languages': ['cn', 'zh', 'en'], 'detection_threshold': 0.7},
+}
+TEXTS = [
+    '',
+    '周杰伦 - 晴天 无损音乐分享',
+    '资源合集 https://pan.baidu.com/s/1AbCdEfGh 提取码: x7k9',
+    '阿里盘 https://www.alipan.com/s/Zx9Yw8 夸克 https://pan.quark.cn/s/abc123def',
+    '获取链接 https://t.me/share_bot?start=get_link_100123_456_baidu',
+    'New album out now! ' + 'lorem ipsum dolor sit amet ' * 20,
+]
+FILENAMES = ['周杰伦 - 晴天.flac', 'Taylor Swift - Love Story.mp3', 'temp_draft.mp4', '[中文] 纪录片.mkv', 'report.pdf', '']
+MIMES = ['audio/flac', 'audio/mpeg', 'video/mp4', 'video/x-matroska', 'application/pdf', 'image/jpeg']
+
+
+def build_corpus(count: int, seed: int = 42) -> list:
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    corpus = []
+    for i in range(count):
+        text = rng.choice(TEXTS)
+        entities = [(0, min(len(text), 24), None)] if text and rng.random() < 0.3 else []
+        idx = rng.randrange(len(FILENAMES))
+        has_document = rng.random() < 0.7
+        corpus.append(MessageDescriptor(
+            i + 1, now, text, entities, has_document,
+            FILENAMES[idx] if has_document else '',
+            MIMES[idx] if has_document else '',
+            rng.randint(1, 800) * 1024 * 1024 if has_document else 0
+        ))
+    return corpus
+
+
+def run(corpus: list, workers: int, batch_size: int) -> float:
+    start = time.perf_counter()
+    if workers <= 1:
+        MessageClassifier.classify_batch(corpus, MEDIA_TYPES, CONFIG)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunks = [corpus[i:i + batch_size] for i in range(0, len(corpus), batch_size)]
+            for _ in pool.map(MessageClassifier.classify_batch, chunks, [MEDIA_TYPES] * len(chunks), [CONFIG] * len(chunks)):
+                pass
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='消息分类进程池扩展性基准')
+    parser.add_argument('--count', type=int, default=1_000_000, help='合成消息数量')
+    parser.add_argument('--workers', default=','.join(str(w) for w in sorted({1, 2, 4, os.cpu_count() or 1})), help='进程数列表（逗号分隔）')
+    parser.add_argument('--batch-size', type=int, default=256, help='每批发送给进程池的消息数')
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.count)
+    print(f'合成语料: {len(corpus)} 条消息，CPU 核数: {os.cpu_count()}')
+    baseline = None
+    for workers in [int(w) for w in args.workers.split(',') if w.strip()]:
+        elapsed = run(corpus, workers, args.batch_size)
+        rate = len(corpus) / elapsed
+        baseline = baseline or rate
+        print(f'workers={workers:<3} 耗时={elapsed:8.2f}s  吞吐={rate:12.0f} msg/s  加速比={rate / baseline:5.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""FloodWait 暂停与续传校验
+
+用 benchmarks/fake_client.py 的 TelegramClient 替身在指定的调用或下载分块上注入 FloodWaitError，
+经 main.RateLimitedClient / ApiRateLimiter 驱动，校验：
+    iterate      iter_messages 按页分段请求、每页取一个令牌；第二页触发 FloodWait：暂停 history 类请求至少 flood 秒后，
+                 以最后产出的消息ID为 offset_id 续传，消息不重复、不遗漏；带 limit 时只取剩余条数
+    isolation    history 类暂停期间，entity 类请求不受影响；get_messages 等待结束后自动重试成功
+    download     download_file 传输中途触发 FloodWait：RateLimitedClient 暂停 download 类并把错误抛给调用方，
+                 TelegramDownloader._stream_document 等待后从已写入的位置用 iter_download 续传，数据不重复
+任一校验失败时以非零状态退出。
+
+用法：
+    python benchmarks/bench_flood_wait.py
+    python benchmarks/bench_flood_wait.py --flood-seconds 2 --messages 1000
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from telethon.errors import FloodWaitError  # noqa: E402
+from bench_pipeline import RESULTS_DIR, git_commit, print_result  # noqa: E402
+from fake_client import FakeTelegramClient  # noqa: E402
+import main  # noqa: E402
+
+
+class ScriptedFloodClient(FakeTelegramClient):
+    """在第 n 次注入点（每次 API 调用与每个下载分块各算一次）抛出 FloodWaitError，并记录下载与历史调用的参数"""
+    def __init__(self, flood_on: set, flood_seconds: int, **kwargs):
+        super().__init__(flood_seconds=flood_seconds, **kwargs)
+        self.flood_on = set(flood_on)
+        self.injections = 0
+        self.log: list = []
+
+    def _inject(self) -> None:
+        self.injections += 1
+        if self.injections in self.flood_on:
+            self.stats['flood_waits'] += 1
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+
+    def iter_messages(self, entity, **kwargs):
+        self.log.append(('iter_messages', dict(kwargs)))
+        return super().iter_messages(entity, **kwargs)
+
+    async def download_file(self, input_location, file=None, **kwargs):
+        self.log.append(('download_file', {'offset': file.tell()}))
+        return await super().download_file(input_location, file, **kwargs)
+
+    def iter_download(self, file, offset=0, **kwargs):
+        self.log.append(('iter_download', {'offset': offset}))
+        return super().iter_download(file, offset=offset, **kwargs)
+
+
+class MemoryWriter:
+    """内存中的下载写入句柄，提供 _stream_document 用到的 tell/write"""
+    def __init__(self):
+        self.data = bytearray()
+
+    def tell(self) -> int:
+        return len(self.data)
+
+    async def write(self, chunk) -> None:
+        self.data += chunk
+
+
+def limited(fake: FakeTelegramClient) -> 'main.RateLimitedClient':
+    # 各类别不限速，只验证 FloodWait 的暂停与恢复
+    return main.RateLimitedClient(fake, main.ApiRateLimiter({'enabled': True, 'methods': {}}))
+
+
+async def check_iterate(args, failures: list) -> dict:
+    page = FakeTelegramClient.PAGE_SIZE
+    result = {}
+    for limit in (None, page + page // 2):
+        # 第 1 次注入点是第一页，第 2 次是第二页：第一页产出后触发
+        fake = ScriptedFloodClient({2}, args.flood_seconds, channels=1, messages_per_channel=args.messages, mix={'text': 1})
+        client = limited(fake)
+        entity = next(iter(fake.channels.values())).entity
+        kwargs = {} if limit is None else {'limit': limit}
+        start = time.perf_counter()
+        ids = [m.id async for m in client.iter_messages(entity, **kwargs)]
+        elapsed = time.perf_counter() - start
+        calls = [kw for name, kw in fake.log if name == 'iter_messages']
+        expected = list(range(args.messages, args.messages - (limit or args.messages), -1))
+        name = f'iterate{"" if limit is None else "_limit"}'
+        if ids != expected:
+            failures.append(f'{name}: 产出 {len(ids)} 条，重复 {len(ids) - len(set(ids))} 条，与期望的 {len(expected)} 条不一致')
+        # 按页分段请求：第二页（offset_id 为第一页最后一条）触发 FloodWait，等待后以相同参数重发
+        if len(calls) < 3 or calls[1] != calls[2] or calls[1].get('offset_id') != expected[page - 1]:
+            failures.append(f'{name}: 续传调用参数 {calls[1:3]}，期望两次 offset_id={expected[page - 1]}')
+        oversized = [kw.get('limit') for kw in calls if not kw.get('limit') or kw['limit'] > page]
+        if oversized:
+            failures.append(f'{name}: 存在超过一页的请求 limit={oversized}')
+        if limit is not None and len(calls) >= 3 and calls[2].get('limit') != limit - page:
+            failures.append(f'{name}: 续传 limit={calls[2].get("limit")}，期望 {limit - page}')
+        if elapsed < args.flood_seconds * 0.95:
+            failures.append(f'{name}: 耗时 {elapsed:.2f}s，未暂停 {args.flood_seconds}s')
+        stats = client.limiter.stats().get('history', {})
+        if stats.get('flood_waits') != 1:
+            failures.append(f'{name}: history 类 FloodWait 计数为 {stats.get("flood_waits")}，期望 1')
+        if stats.get('calls') != len(calls):
+            failures.append(f'{name}: 发出 {len(calls)} 次分页请求，只取了 {stats.get("calls")} 个令牌')
+        result[name] = {'messages': len(ids), 'seconds': elapsed, 'pages': len(calls), 'tokens': stats.get('calls'),
+                        'resume_offset_id': calls[2].get('offset_id') if len(calls) > 2 else None}
+    return result
+
+
+async def check_isolation(args, failures: list) -> dict:
+    fake = ScriptedFloodClient({1}, args.flood_seconds, channels=1, messages_per_channel=10, mix={'text': 1})
+    client = limited(fake)
+    entity = next(iter(fake.channels.values())).entity
+
+    async def timed(coro):
+        start = time.perf_counter()
+        value = await coro
+        return value, time.perf_counter() - start
+
+    history = asyncio.create_task(timed(client.get_messages(entity, ids=1)))
+    await asyncio.sleep(0.05)
+    _, entity_seconds = await timed(client.get_entity(entity.id))
+    msg, history_seconds = await history
+    if getattr(msg, 'id', None) != 1:
+        failures.append(f'isolation: FloodWait 后 get_messages 未重试成功，返回 {msg!r}')
+    if history_seconds < args.flood_seconds * 0.95:
+        failures.append(f'isolation: get_messages 耗时 {history_seconds:.2f}s，未暂停 {args.flood_seconds}s')
+    if entity_seconds > args.flood_seconds / 2:
+        failures.append(f'isolation: history 暂停期间 get_entity 耗时 {entity_seconds:.2f}s，被其他类别的暂停阻塞')
+    return {'history_seconds': history_seconds, 'entity_seconds': entity_seconds}
+
+
+async def check_download(args, failures: list) -> dict:
+    chunk = 128 * 1024
+    size = chunk * 8
+    # 第 1 次注入点是 download_file 调用本身，之后每个分块一次：第 4 个分块触发，此前已写入 3 块
+    fake = ScriptedFloodClient({5}, args.flood_seconds, channels=1, messages_per_channel=1, mix={'audio': 1},
+                               file_size=(size, size), chunk_size=chunk)
+    client = limited(fake)
+    msg = next(iter(fake.channels.values())).messages[0]
+    task = main.MediaTask.from_message(msg, msg.peer_id.channel_id)
+
+    # RateLimitedClient 不原样重试传输，而是暂停后抛给调用方
+    try:
+        await client.download_file(task.input_location(), MemoryWriter(), file_size=task.size)
+        failures.append('download: RateLimitedClient.download_file 未抛出 FloodWaitError')
+    except FloodWaitError:
+        pass
+
+    fake.injections, fake.log, fake.stats['bytes_sent'] = 0, [], 0
+    client = limited(fake)
+    writer = MemoryWriter()
+    start = time.perf_counter()
+    await main.TelegramDownloader._stream_document(client, task, writer)
+    elapsed = time.perf_counter() - start
+    resumed = [kw['offset'] for name, kw in fake.log if name == 'iter_download']
+    if len(writer.data) != size:
+        failures.append(f'download: 写入 {len(writer.data)} 字节，期望 {size}')
+    if fake.stats['bytes_sent'] != size:
+        failures.append(f'download: 替身发送 {fake.stats["bytes_sent"]} 字节，续传重复或遗漏了数据')
+    if resumed != [chunk * 3]:
+        failures.append(f'download: 续传偏移 {resumed}，期望 [{chunk * 3}]')
+    if elapsed < args.flood_seconds * 0.95:
+        failures.append(f'download: 耗时 {elapsed:.2f}s，未暂停 {args.flood_seconds}s')
+    if client.limiter.stats().get('download', {}).get('flood_waits') != 1:
+        failures.append(f'download: download 类 FloodWait 计数为 {client.limiter.stats().get("download")}，期望 1')
+    return {'bytes': len(writer.data), 'seconds': elapsed, 'resume_offsets': resumed}
+
+
+async def run_checks(args, failures: list) -> dict:
+    return {
+        **await check_iterate(args, failures),
+        'isolation': await check_isolation(args, failures),
+        'download': await check_download(args, failures),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='注入 FloodWait，校验限流器的按类别暂停、恢复与续传')
+    parser.add_argument('--flood-seconds', type=int, default=1, help='注入的 FloodWait 秒数')
+    parser.add_argument('--messages', type=int, default=350, help='iterate 校验中频道的消息数（需大于两页）')
+    parser.add_argument('--output', help='结果 JSON 路径（默认 benchmarks/results/flood-wait-<提交>-<时间>.json）')
+    args = parser.parse_args()
+    if args.messages <= FakeTelegramClient.PAGE_SIZE * 2:
+        parser.error(f'--messages 需大于 {FakeTelegramClient.PAGE_SIZE * 2}')
+
+    main.setup_logging(log_file=None)
+    main.logger.setLevel('ERROR')
+    failures: list = []
+    results = asyncio.run(run_checks(args, failures))
+    for name, result in results.items():
+        print_result(name, result)
+
+    commit = git_commit()
+    output = args.output or os.path.join(RESULTS_DIR, f'flood-wait-{commit}-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'commit': commit,
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': vars(args),
+            'scenarios': results,
+            'failures': failures,
+        }, f, ensure_ascii=False, indent=2)
+    print(f'结果已保存: {output}')
+    for failure in failures:
+        print(f'失败: {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,136 @@
+"""云盘链接探测基准与校验
+
+启动 benchmarks/fake_share_host.py 替身服务，把 main.LinkProbe 的全部探测请求改发到替身，
+对合成的分享链接（百度、阿里云盘、夸克、迅雷、UC，按比例有效/失效/404/503，含重复链接）分批并发探测：
+    - 校验每条链接的结果（有效 -> alive，失效与 404 -> dead，503 -> unknown）
+    - 校验替身同时处理的请求数不超过 per_host_concurrency
+    - 报告探测速率、实际请求数（重复链接合并、结果缓存后少于链接数）与第二轮（命中缓存）的耗时
+任一校验失败时以非零状态退出。
+
+用法：
+    python benchmarks/bench_link_probe.py --links 2000 --latency-ms 50 --per-host 8
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_pipeline import RESULTS_DIR, git_commit, print_result  # noqa: E402
+from fake_share_host import FakeShareHost  # noqa: E402
+import main  # noqa: E402
+
+URLS = {
+    'baidupan': 'https://pan.baidu.com/s/1{id}',
+    'aliyundrive': 'https://www.alipan.com/s/{id}',
+    'quark': 'https://pan.quark.cn/s/{id}',
+    'xunlei': 'https://pan.xunlei.com/s/{id}',
+    'ucdrive': 'https://drive.uc.cn/s/{id}',
+}
+# 分享状态 -> (权重, 期望结果)
+STATES = {'ok': (60, 'alive'), 'dead': (30, 'dead'), 'gone': (5, 'dead'), 'busy': (5, 'unknown')}
+
+
+def make_links(count: int, dup_rate: float, seed: int) -> list:
+    rng = random.Random(seed)
+    states = list(STATES)
+    weights = [STATES[s][0] for s in states]
+    links = []
+    for n in range(count):
+        if links and rng.random() < dup_rate:
+            links.append(dict(rng.choice(links)))
+            continue
+        provider = rng.choice(list(URLS))
+        state = rng.choices(states, weights)[0]
+        links.append({'kind': 'cloud_link', 'provider': provider, 'url': URLS[provider].format(id=f'{state}{n:06d}'), 'code': '', 'expect': STATES[state][1]})
+    return links
+
+
+async def run_probe(args, host: FakeShareHost) -> dict:
+    settings = main.ConfigManager.get_link_probe_settings({'link_probe': {
+        'enabled': True, 'endpoint': host.url, 'per_host_concurrency': args.per_host, 'max_connections': args.max_connections,
+        'timeout_seconds': args.timeout,
+    }})
+    probe = main.LinkProbe(settings)
+    links = make_links(args.links, args.dup_rate, args.seed)
+    try:
+        start = time.perf_counter()
+        for i in range(0, len(links), args.batch):
+            await probe.probe_all(links[i:i + args.batch])
+        elapsed = time.perf_counter() - start
+        served = host.requests
+        # 第二轮：有效与失效的结果应全部命中缓存
+        rerun = [{k: v for k, v in t.items() if k != 'liveness'} for t in links if t['expect'] != 'unknown']
+        start = time.perf_counter()
+        await probe.probe_all(rerun)
+        cached_elapsed = time.perf_counter() - start
+    finally:
+        probe.close()
+    results: dict[str, int] = {}
+    mismatches = [t for t in links if t['liveness'] != t['expect']]
+    for t in links:
+        results[t['liveness']] = results.get(t['liveness'], 0) + 1
+    return {
+        'links': len(links), 'seconds': elapsed, 'links_per_second': len(links) / elapsed if elapsed else 0.0,
+        'requests': served, 'max_inflight': host.max_inflight, 'per_host_concurrency': args.per_host,
+        'cached_links': len(rerun), 'cached_requests': host.requests - served, 'cached_seconds': cached_elapsed,
+        'mismatches': len(mismatches), 'decisions': results,
+        'mismatch_examples': [{'url': t['url'], 'expect': t['expect'], 'got': t['liveness']} for t in mismatches[:5]],
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='对本地替身服务并发探测云盘链接，校验结果、并发上限与缓存')
+    parser.add_argument('--links', type=int, default=1000, help='探测的链接数')
+    parser.add_argument('--dup-rate', type=float, default=0.1, help='重复链接比例')
+    parser.add_argument('--batch', type=int, default=50, help='每批并发探测的链接数（对应一轮抓取中的链接任务）')
+    parser.add_argument('--latency-ms', type=float, default=20, help='替身服务每个请求的延迟')
+    parser.add_argument('--per-host', type=int, default=4, help='link_probe.per_host_concurrency')
+    parser.add_argument('--max-connections', type=int, default=32, help='link_probe.max_connections')
+    parser.add_argument('--timeout', type=float, default=10, help='link_probe.timeout_seconds')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='结果 JSON 路径（默认 benchmarks/results/link-probe-<提交>-<时间>.json）')
+    args = parser.parse_args()
+
+    host = FakeShareHost(latency_ms=args.latency_ms).start()
+    try:
+        result = asyncio.run(run_probe(args, host))
+    finally:
+        host.stop()
+    print_result('link-probe', result)
+
+    failures = []
+    if result['mismatches']:
+        failures.append(f'{result["mismatches"]} 条链接结果不符，例如: {json.dumps(result["mismatch_examples"], ensure_ascii=False)}')
+    if result['max_inflight'] > args.per_host:
+        failures.append(f'替身同时处理 {result["max_inflight"]} 个请求，超过每主机上限 {args.per_host}')
+    if result['cached_requests']:
+        failures.append(f'第二轮仍发出 {result["cached_requests"]} 个请求，结果未被缓存')
+
+    commit = git_commit()
+    output = args.output or os.path.join(RESULTS_DIR, f'link-probe-{commit}-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'commit': commit,
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': vars(args),
+            'scenarios': {'link-probe': result},
+            'failures': failures,
+        }, f, ensure_ascii=False, indent=2)
+    print(f'结果已保存: {output}')
+    for failure in failures:
+        print(f'失败: {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,318 @@
+"""离线流水线基准
+
+用 benchmarks/fake_client.py 中的 TelegramClient 替身驱动真实的抓取、过滤与下载代码，不需要账号与网络。
+场景：
+    scan    实时抓取（MessagePreprocessor.fetch_valid_messages）的扫描速率
+    filter  消息分类（MessageClassifier.classify_messages）的过滤速率与决策分布
+    e2e     端到端（TelegramDownloader.process_channel，含落盘、清单与状态写入）的字节吞吐
+    memory  在 tracemalloc 下运行端到端场景，报告 Python 堆峰值与进程 RSS
+
+结果保存为 JSON（含提交号与参数），可用 --compare 对比两次运行。
+
+用法：
+    python benchmarks/bench_pipeline.py --scenarios scan,filter,e2e --messages 5000
+    python benchmarks/bench_pipeline.py --scenarios e2e --latency-ms 20 --bandwidth-mbps 8 --flood-rate 0.01 --disconnect-rate 0.005
+    python benchmarks/bench_pipeline.py --compare benchmarks/results/a.json benchmarks/results/b.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 未指定数据目录时使用临时目录，进程退出时删除
+TMP_DATA_DIR = None
+if 'TGDL_DATA_DIR' not in os.environ:
+    TMP_DATA_DIR = tempfile.TemporaryDirectory(prefix='tgdl_bench_', ignore_cleanup_errors=True)
+    os.environ['TGDL_DATA_DIR'] = TMP_DATA_DIR.name
+DATA_DIR = os.environ['TGDL_DATA_DIR']
+os.environ.setdefault('TGDL_DISABLE_TQDM', 'true')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ('scan', 'filter', 'e2e', 'memory')
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+
+def write_config(args) -> None:
+    """main 在导入时读取数据目录，配置需在导入前写好，避免首次运行的交互式配置"""
+    config_dir = os.path.join(DATA_DIR, 'config')
+    os.makedirs(config_dir, exist_ok=True)
+    config = {
+        'api_id': 1,
+        'api_hash': 'bench',
+        'phone_number': '+10000000000',
+        'media_types': args.media_types.split(','),
+        'selected_channels': [],
+        'audio_quality_check': {'enabled': False, 'check_type': 'size', 'min_size_mb': 1, 'min_duration_seconds': 0},
+        'download_settings': {
+            'max_file_size_mb': 2048,
+            'min_file_size_mb': 0,
+            'wait_interval_seconds': 0,
+            'initial_retry_delay': 0,
+            'max_retry_delay': 0,
+            'max_retries': 0,
+            'max_concurrent_downloads': args.concurrency,
+            'batch_size': args.batch_size,
+            'progress_step': 10,
+            'exclude_patterns': [],
+            'downloading_dir': os.path.join(DATA_DIR, 'downloads', 'downloading'),
+            'completed_dir': os.path.join(DATA_DIR, 'downloads', 'completed'),
+            'min_disk_space_mb': 0,
+        },
+        'language_filter': {'enabled': args.language_filter, 'languages': ['cn', 'zh', 'en'], 'detection_threshold': 0.7},
+        'link_submission': {'enabled': False, 'api_url': ''},
+        'bot_interaction': {'allowed_start_bots': [], 'start_reply_wait_seconds': 0, 'start_reply_limit': 5},
+        'rate_limit': {'enabled': args.rate_limit},
+        'backfill': {'enabled': False},
+        'metrics': {'enabled': False},
+    }
+    with open(os.path.join(config_dir, 'config.json'), 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+
+def metric(name: str, **labels) -> float:
+    return main.METRICS.values.get(main.Metrics._key(name, labels), 0)
+
+
+def rss() -> int:
+    return main.psutil.Process().memory_info().rss
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.runs = 0
+
+    def fake(self, publish_batch: int) -> 'FakeTelegramClient':
+        a = self.args
+        # 每个场景使用不同的频道ID，避免进度状态与已下载文件在场景间互相影响
+        self.runs += 1
+        return FakeTelegramClient(
+            channels=a.channels, messages_per_channel=a.messages, mix=parse_mix(a.mix) if a.mix else None,
+            file_size=(int(a.min_size_kb * 1024), int(a.max_size_kb * 1024)),
+            latency=a.latency_ms / 1000, bandwidth=a.bandwidth_mbps * 1024 * 1024, chunk_size=a.chunk_kb * 1024,
+            flood_rate=a.flood_rate, flood_seconds=a.flood_seconds, disconnect_rate=a.disconnect_rate,
+            publish_batch=publish_batch, seed=a.seed, base_channel_id=1000000001 + self.runs * 100
+        )
+
+    def wrap(self, fake) -> 'main.RateLimitedClient':
+        limiter = main.ApiRateLimiter(main.ConfigManager.get_rate_limit_settings(main.ConfigManager.load_config()))
+        return main.RateLimitedClient(fake, limiter)
+
+    async def scan(self) -> dict:
+        config = main.ConfigManager.load_config()
+        settings = main.ConfigManager.get_download_settings(config)
+        fake = self.fake(settings['batch_size'] * 2)
+        client = self.wrap(fake)
+        preprocessor = main.MessagePreprocessor(client, config['media_types'], config)
+        scanned = metric('tgdl_messages_scanned_total')
+        queued = 0
+        reconnects = 0
+        start = time.perf_counter()
+        try:
+            for channel in fake.channels.values():
+                while not channel.drained:
+                    try:
+                        queued += len(await preprocessor.fetch_valid_messages(channel.entity, client))
+                    except ConnectionError:
+                        # 与 process_channel 一样，连接断开后重新抓取
+                        reconnects += 1
+        finally:
+            preprocessor.classifier.shutdown()
+        elapsed = time.perf_counter() - start
+        scanned = metric('tgdl_messages_scanned_total') - scanned
+        return {'messages': scanned, 'queued_tasks': queued, 'seconds': elapsed, 'messages_per_second': scanned / elapsed,
+                'api_calls': fake.stats['calls'], 'reconnects': reconnects, 'rate_limit': client.limiter.stats()}
+
+    async def filter(self) -> dict:
+        config = main.ConfigManager.load_config()
+        settings = main.ConfigManager.get_download_settings(config)
+        fake = self.fake(0)
+        messages = [m for c in fake.channels.values() for m in c.messages]
+        classifier = main.MessageClassifier(config['media_types'], config, workers=settings['cpu_workers'], batch_size=settings['cpu_batch_size'])
+        try:
+            start = time.perf_counter()
+            results = await classifier.classify_messages(messages)
+            elapsed = time.perf_counter() - start
+        finally:
+            classifier.shutdown()
+        decisions: dict[str, int] = {}
+        for r in results:
+            key = 'download' if r['download'] else r['skip_reason']
+            decisions[key] = decisions.get(key, 0) + 1
+        return {
+            'messages': len(messages), 'seconds': elapsed, 'messages_per_second': len(messages) / elapsed,
+            'decisions': decisions,
+            'cloud_links': sum(len(r['cloud_tasks']) for r in results),
+            'deeplinks': sum(len(r['deeplinks']) for r in results),
+        }
+
+    async def e2e(self) -> dict:
+        main.stop_event.clear()
+        shutil.rmtree(os.path.join(DATA_DIR, 'downloads'), ignore_errors=True)
+        downloader = main.TelegramDownloader()
+        fake = self.fake(downloader.download_settings['batch_size'] * 2)
+        client = self.wrap(fake)
+        downloader.pool.add('bench', client)
+        downloader.client = client
+        downloader.rate_limiter = client.limiter
+        downloader.preprocessor = main.MessagePreprocessor(client, downloader.config['media_types'], downloader.config)
+        # 与 TelegramDownloader.run 相同，按 tracing 设置（如 TGDL_TRACING_ENABLED=1）记录逐消息追踪
+        main.TRACER.configure(downloader.tracing_settings)
+        before = {
+            'bytes': metric('tgdl_download_bytes_total'),
+            'completed': metric('tgdl_downloads_total', result='completed'),
+            'failed': metric('tgdl_downloads_total', result='failed'),
+        }
+        start = time.perf_counter()
+        tasks = [asyncio.create_task(downloader.process_channel(str(cid)), name=f'channel-{cid}') for cid in fake.channels]
+        try:
+            while not fake.drained and not all(t.done() for t in tasks):
+                if time.perf_counter() - start > self.args.timeout:
+                    raise TimeoutError(f'端到端场景超过 {self.args.timeout} 秒未完成')
+                await asyncio.sleep(0.01)
+        finally:
+            main.stop_event.set()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            downloader.preprocessor.classifier.shutdown()
+            main.TRACER.close()
+            main.stop_event.clear()
+        elapsed = time.perf_counter() - start
+        received = metric('tgdl_download_bytes_total') - before['bytes']
+        return {
+            'messages': fake.total_messages,
+            'files_completed': metric('tgdl_downloads_total', result='completed') - before['completed'],
+            'files_failed': metric('tgdl_downloads_total', result='failed') - before['failed'],
+            'bytes': received,
+            'seconds': elapsed,
+            'bytes_per_second': received / elapsed,
+            'api_calls': fake.stats['calls'],
+            'injected_flood_waits': fake.stats['flood_waits'],
+            'injected_disconnects': fake.stats['disconnects'],
+            'rate_limit': client.limiter.stats(),
+        }
+
+    async def memory(self) -> dict:
+        rss_before = rss()
+        tracemalloc.start()
+        try:
+            result = await self.e2e()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return {
+            'messages': result['messages'],
+            'files_completed': result['files_completed'],
+            'python_heap_peak_bytes': peak,
+            'rss_bytes': rss(),
+            'rss_growth_bytes': rss() - rss_before,
+        }
+
+
+def print_result(name: str, result: dict) -> None:
+    parts = []
+    for key, value in result.items():
+        if isinstance(value, dict):
+            continue
+        parts.append(f'{key}={value:.2f}' if isinstance(value, float) else f'{key}={value}')
+    print(f'[{name}] ' + '  '.join(parts))
+    if 'decisions' in result:
+        print(f'[{name}] decisions: ' + json.dumps(result['decisions'], ensure_ascii=False))
+
+
+def compare(path_a: str, path_b: str) -> None:
+    with open(path_a, encoding='utf-8') as f:
+        a = json.load(f)
+    with open(path_b, encoding='utf-8') as f:
+        b = json.load(f)
+    print(f'A: {path_a} (commit {a.get("commit")})')
+    print(f'B: {path_b} (commit {b.get("commit")})')
+    for name in sorted(set(a['scenarios']) & set(b['scenarios'])):
+        ra, rb = a['scenarios'][name], b['scenarios'][name]
+        for key in ra:
+            va, vb = ra[key], rb.get(key)
+            if not isinstance(va, (int, float)) or not isinstance(vb, (int, float)) or isinstance(va, bool):
+                continue
+            change = f'{(vb - va) / va:+7.1%}' if va else '    n/a'
+            print(f'{name:<7} {key:<24} {va:>16.2f} -> {vb:>16.2f}  {change}')
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='离线流水线基准（使用 TelegramClient 替身）')
+    parser.add_argument('--scenarios', default='scan,filter,e2e', help=f'要运行的场景（逗号分隔，可选 {",".join(SCENARIOS)}）')
+    parser.add_argument('--channels', type=int, default=1, help='合成频道数量')
+    parser.add_argument('--messages', type=int, default=2000, help='每个频道的消息数')
+    parser.add_argument('--mix', default='', help='消息构成，如 audio=40,video=15,document=10,text=20,link=10,deeplink=5')
+    parser.add_argument('--min-size-kb', type=float, default=64, help='最小文件大小（KB）')
+    parser.add_argument('--max-size-kb', type=float, default=1024, help='最大文件大小（KB）')
+    parser.add_argument('--chunk-kb', type=int, default=128, help='下载分块大小（KB）')
+    parser.add_argument('--latency-ms', type=float, default=0, help='每次 API 调用的延迟（毫秒）')
+    parser.add_argument('--bandwidth-mbps', type=float, default=0, help='单个传输的带宽（MB/s），0 表示不限')
+    parser.add_argument('--flood-rate', type=float, default=0, help='每次调用触发 FloodWait 的概率')
+    parser.add_argument('--flood-seconds', type=int, default=0, help='注入的 FloodWait 秒数')
+    parser.add_argument('--disconnect-rate', type=float, default=0, help='每次调用断开连接的概率')
+    parser.add_argument('--media-types', default='audio,video', help='下载的媒体类型')
+    parser.add_argument('--batch-size', type=int, default=15, help='每轮抓取的任务数（download_settings.batch_size）')
+    parser.add_argument('--concurrency', type=int, default=3, help='每频道并发下载数（download_settings.max_concurrent_downloads）')
+    parser.add_argument('--language-filter', action='store_true', help='启用文件名语言过滤（cn,zh,en）')
+    parser.add_argument('--rate-limit', action='store_true', help='启用默认 API 限流（默认关闭以测量流水线本身）')
+    parser.add_argument('--seed', type=int, default=42, help='随机种子')
+    parser.add_argument('--timeout', type=float, default=600, help='端到端场景超时（秒）')
+    parser.add_argument('--log-level', default='WARNING', help='main 的日志级别')
+    parser.add_argument('--output', help='结果 JSON 路径（默认 benchmarks/results/<提交>-<时间>.json）')
+    parser.add_argument('--compare', nargs=2, metavar=('A', 'B'), help='对比两个结果 JSON 后退出')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f'未知场景: {", ".join(unknown)}')
+
+    write_config(args)
+    global main, FakeTelegramClient, parse_mix
+    import main
+    from fake_client import FakeTelegramClient, parse_mix
+    main.setup_logging(log_file=None)
+    main.logger.setLevel(args.log_level.upper())
+
+    bench = Bench(args)
+    results = {}
+    for name in scenarios:
+        results[name] = asyncio.run(getattr(bench, name)())
+        print_result(name, results[name])
+
+    commit = git_commit()
+    output = args.output or os.path.join(RESULTS_DIR, f'{commit}-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'commit': commit,
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+            'scenarios': results,
+        }, f, ensure_ascii=False, indent=2)
+    print(f'结果已保存: {output}')
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,178 @@
+"""S3 分片上传落地校验
+
+经 main.S3Sink / S3UploadWriter 把合成文件分块写入分片上传，默认使用 benchmarks/fake_s3.py 的内存替身，
+指定 --endpoint 时改用真实的 S3 兼容服务（如本地 MinIO，需安装 boto3）。校验：
+    fresh        一次写完：对象内容与摘要正确，状态文件中不留上传记录，存储桶中不留未完成的上传
+    resume       写入 2.5 个分片后中断：再次打开从已上传的整片处续传（未满一片的缓冲丢弃），
+                 合并后对象内容正确，续传前的分片未重复上传，摘要由读回的对象补算
+    list_failed  中断后 list_parts 失败：取消保存的上传并重新开始，不留下孤立的分片上传
+    size_changed 同名文件大小变化：取消旧上传并重新开始
+任一校验失败时以非零状态退出。
+
+用法：
+    python benchmarks/bench_s3_sink.py
+    TGDL_S3_ACCESS_KEY=minio TGDL_S3_SECRET_KEY=minio123 \\
+        python benchmarks/bench_s3_sink.py --endpoint http://127.0.0.1:9000 --bucket tlg
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import platform
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_pipeline import RESULTS_DIR, git_commit, print_result  # noqa: E402
+from fake_s3 import FakeS3Client, FaultInjector  # noqa: E402
+import main  # noqa: E402
+
+CHUNK = 512 * 1024
+
+
+def make_sink(args) -> 'main.S3Sink':
+    settings = {'bucket': args.bucket, 'prefix': f'bench-s3-{int(time.time())}', 'part_size_mb': args.part_size_mb}
+    if not args.endpoint:
+        return main.S3Sink(settings, client=FaultInjector(FakeS3Client()))
+    sink = main.S3Sink({**settings, 'endpoint_url': args.endpoint, 'region': args.region,
+                        'access_key': os.getenv('TGDL_S3_ACCESS_KEY', ''), 'secret_key': os.getenv('TGDL_S3_SECRET_KEY', '')})
+    sink.client = FaultInjector(sink.client)
+    return sink
+
+
+def payload(size: int, seed: int) -> bytes:
+    block = hashlib.sha256(str(seed).encode()).digest() * (CHUNK // 32)
+    return (block * (size // len(block) + 1))[:size]
+
+
+async def write_from(writer, data: bytes, stop: int | None = None) -> None:
+    """从 writer.tell() 处分块写入到 stop（默认写完）"""
+    pos = writer.tell()
+    stop = len(data) if stop is None else stop
+    while pos < stop:
+        await writer.write(data[pos:min(pos + CHUNK, stop)])
+        pos = writer.tell()
+
+
+def uploads_left(sink, key: str) -> list:
+    return sink.client.list_multipart_uploads(Bucket=sink.bucket, Prefix=key).get('Uploads', [])
+
+
+def read_object(sink, key: str) -> bytes:
+    body = sink.client.get_object(Bucket=sink.bucket, Key=key)['Body']
+    try:
+        return body.read()
+    finally:
+        body.close()
+
+
+async def finish(sink, name: str, data: bytes, check: str, failures: list, writer=None) -> dict:
+    """写完剩余数据并合并，校验对象内容、摘要与残留状态"""
+    key = sink.key(name)
+    writer = writer or await sink.open('', '', name, len(data))
+    resumed_at = writer.tell()
+    await write_from(writer, data)
+    await writer.commit()
+    if read_object(sink, key) != data:
+        failures.append(f'{check}: 合并后的对象内容与写入的数据不一致')
+    digest = writer.hexdigest()
+    if digest != hashlib.sha256(data).hexdigest():
+        failures.append(f'{check}: 摘要为 {digest}，与数据的 SHA-256 不一致')
+    if main.StateManager.get_upload(key) is not None:
+        failures.append(f'{check}: 合并后状态文件中仍有上传记录')
+    left = uploads_left(sink, key)
+    if left:
+        failures.append(f'{check}: 存储桶中残留 {len(left)} 个未完成的分片上传')
+    sink.client.delete_object(Bucket=sink.bucket, Key=key)
+    return {'resumed_at': resumed_at, 'digest_ok': digest == hashlib.sha256(data).hexdigest(), 'uploads_left': len(left)}
+
+
+async def interrupted(sink, name: str, data: bytes) -> int:
+    """写入 2.5 个分片后中断，返回中断时已写入的字节数"""
+    writer = await sink.open('', '', name, len(data))
+    await write_from(writer, data, sink.part_size * 5 // 2)
+    written = writer.tell()
+    await writer.abort()
+    return written
+
+
+async def run_checks(args, failures: list) -> dict:
+    sink = make_sink(args)
+    part = sink.part_size
+    size = part * args.parts + part // 2
+    data = payload(size, 1)
+    results = {}
+
+    results['fresh'] = await finish(sink, 'fresh.bin', data, 'fresh', failures)
+
+    await interrupted(sink, 'resume.bin', data)
+    calls = dict(getattr(sink.client.client, 'calls', {}))
+    writer = await sink.open('', '', 'resume.bin', size)
+    if writer.tell() != part * 2:
+        failures.append(f'resume: 续传位置 {writer.tell()}，期望 {part * 2}')
+    result = await finish(sink, 'resume.bin', data, 'resume', failures, writer)
+    if calls:
+        uploaded = sink.client.client.calls['upload_part'] - calls['upload_part']
+        # 续传只需上传第 3 片起的剩余分片
+        if uploaded != args.parts - 1:
+            failures.append(f'resume: 续传上传了 {uploaded} 个分片，期望 {args.parts - 1}')
+        result['parts_uploaded'] = uploaded
+    results['resume'] = result
+
+    await interrupted(sink, 'list-failed.bin', data)
+    saved = main.StateManager.get_upload(sink.key('list-failed.bin'))
+    sink.client.fail('list_parts')
+    writer = await sink.open('', '', 'list-failed.bin', size)
+    if writer.tell() != 0 or writer.upload_id == saved['upload_id']:
+        failures.append(f'list_failed: list_parts 失败后续传位置 {writer.tell()}，未重新开始上传')
+    results['list_failed'] = await finish(sink, 'list-failed.bin', data, 'list_failed', failures, writer)
+
+    await interrupted(sink, 'size-changed.bin', data)
+    changed = payload(size - part, 2)
+    results['size_changed'] = await finish(sink, 'size-changed.bin', changed, 'size_changed', failures)
+    return results
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='经 S3Sink 写入分片上传，校验续传、摘要与未完成上传的清理')
+    parser.add_argument('--endpoint', help='S3 兼容服务地址（如 http://127.0.0.1:9000）；不指定时使用内存替身')
+    parser.add_argument('--bucket', default='tlg', help='存储桶（使用真实服务时需已存在）')
+    parser.add_argument('--region', default='', help='区域')
+    parser.add_argument('--part-size-mb', type=int, default=5, help='分片大小（MB），S3 要求至少 5')
+    parser.add_argument('--parts', type=int, default=3, help='文件包含的整分片数（另加半个分片），至少 3')
+    parser.add_argument('--output', help='结果 JSON 路径（默认 benchmarks/results/s3-sink-<提交>-<时间>.json）')
+    args = parser.parse_args()
+    if args.parts < 3:
+        parser.error('--parts 至少为 3')
+
+    main.setup_logging(log_file=None)
+    main.logger.setLevel('ERROR')
+    failures: list = []
+    results = asyncio.run(run_checks(args, failures))
+    for name, result in results.items():
+        print_result(name, result)
+
+    commit = git_commit()
+    output = args.output or os.path.join(RESULTS_DIR, f's3-sink-{commit}-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'commit': commit,
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': vars(args),
+            'scenarios': results,
+            'failures': failures,
+        }, f, ensure_ascii=False, indent=2)
+    print(f'结果已保存: {output}')
+    for failure in failures:
+        print(f'失败: {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,139 @@
+"""启动耗时基准与守护
+
+在干净的临时工作目录与数据目录中，用 `python -X importtime` 测量：
+    import        `import main` 的耗时（含解释器导入链），报告自身耗时最多的模块
+    print-config  `main.py --print-config` 的完整进程耗时
+
+并检查导入保持无副作用：
+    - 不导入 telethon、requests、tqdm、mutagen、psutil（只在真正用到时按需导入）
+    - 不在工作目录或数据目录中创建任何文件（日志、数据目录、会话目录）
+    - --print-config 的标准输出只有 JSON（日志写到 stderr），可直接交给 jq
+任一检查失败或耗时超过 --max-ms 时以非零状态退出，可作为 CI 中的回归守护。
+
+用法：
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeat 10 --max-ms 300 --top 15
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_pipeline import ROOT, RESULTS_DIR, git_commit, print_result  # noqa: E402
+
+HEAVY_MODULES = ('telethon', 'requests', 'tqdm', 'mutagen', 'psutil')
+
+
+def parse_importtime(stderr: str) -> list:
+    """解析 -X importtime 输出，返回 [(模块, 自身微秒, 累计微秒, 层级)]"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        entries.append((name.strip(), int(self_us), int(cumulative_us), (len(name) - len(name.lstrip())) // 2))
+    return entries
+
+
+def run_once(argv: list) -> dict:
+    """在新的临时目录中运行一次，返回墙钟耗时、导入记录与残留文件"""
+    with tempfile.TemporaryDirectory(prefix='tgdl_startup_', ignore_cleanup_errors=True) as workdir:
+        env = {**os.environ, 'PYTHONPATH': ROOT, 'TGDL_DATA_DIR': os.path.join(workdir, 'data'), 'TGDL_DISABLE_TQDM': 'true'}
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-X', 'importtime', *argv], cwd=workdir, env=env, capture_output=True, text=True,
+                              stdin=subprocess.DEVNULL, timeout=120)
+        elapsed = time.perf_counter() - start
+        if proc.returncode != 0:
+            raise RuntimeError(f'{" ".join(argv)} 退出码 {proc.returncode}:\n{proc.stderr[-2000:]}')
+        created = sorted(os.path.relpath(os.path.join(d, f), workdir) for d, dirs, files in os.walk(workdir) for f in files + dirs)
+    return {'seconds': elapsed, 'imports': parse_importtime(proc.stderr), 'created': created, 'stdout': proc.stdout}
+
+
+def is_json(text: str) -> bool:
+    try:
+        json.loads(text)
+        return True
+    except ValueError:
+        return False
+
+
+def measure(name: str, argv: list, repeat: int, top: int, expect_json: bool = False) -> dict:
+    runs = [run_once(argv) for _ in range(max(repeat, 1))]
+    best = min(runs, key=lambda r: r['seconds'])
+    imported = {module for r in runs for module, *_ in r['imports']}
+    main_us = next((cumulative for module, _, cumulative, _ in best['imports'] if module == 'main'), None)
+    slowest = sorted(best['imports'], key=lambda e: e[1], reverse=True)[:top]
+    result = {
+        'seconds': best['seconds'],
+        'median_seconds': sorted(r['seconds'] for r in runs)[len(runs) // 2],
+        # 作为脚本运行时 main 以 __main__ 执行，不出现在导入记录中
+        'import_main_ms': main_us / 1000 if main_us is not None else None,
+        'modules': len(best['imports']),
+        'heavy_modules': sorted(m for m in imported if m.split('.')[0] in HEAVY_MODULES and '.' not in m),
+        'created_files': sorted({f for r in runs for f in r['created']}),
+        'slowest_modules': {module: self_us / 1000 for module, self_us, _, _ in slowest},
+    }
+    if expect_json:
+        result['stdout_json'] = all(is_json(r['stdout']) for r in runs)
+    print_result(name, result)
+    for module, self_ms in result['slowest_modules'].items():
+        print(f'[{name}]   {self_ms:8.2f}ms  {module}')
+    return result
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='测量 main 的导入与 --print-config 耗时，并检查导入无副作用')
+    parser.add_argument('--repeat', type=int, default=5, help='每项测量的运行次数，取最快一次')
+    parser.add_argument('--top', type=int, default=10, help='列出自身耗时最多的模块数')
+    parser.add_argument('--max-ms', type=float, default=0, help='import main 耗时上限（毫秒），超过时失败；0 表示不检查')
+    parser.add_argument('--output', help='结果 JSON 路径（默认 benchmarks/results/startup-<提交>-<时间>.json）')
+    args = parser.parse_args()
+
+    # 预先编译，避免首轮运行把字节码编译计入导入耗时
+    subprocess.run([sys.executable, '-m', 'compileall', '-q', os.path.join(ROOT, 'main.py')], check=True)
+    results = {
+        'import': measure('import', ['-c', 'import main'], args.repeat, args.top),
+        'print-config': measure('print-config', [os.path.join(ROOT, 'main.py'), '--print-config'], args.repeat, args.top, expect_json=True),
+    }
+
+    failures = []
+    if results['import']['heavy_modules']:
+        failures.append(f'import main 导入了重量级依赖: {", ".join(results["import"]["heavy_modules"])}')
+    if results['print-config']['heavy_modules']:
+        failures.append(f'--print-config 导入了重量级依赖: {", ".join(results["print-config"]["heavy_modules"])}')
+    if results['import']['created_files']:
+        failures.append(f'import main 创建了文件: {", ".join(results["import"]["created_files"])}')
+    if results['print-config']['created_files']:
+        failures.append(f'--print-config 创建了文件: {", ".join(results["print-config"]["created_files"])}')
+    if not results['print-config']['stdout_json']:
+        failures.append('--print-config 的标准输出不是纯 JSON（日志应写到 stderr）')
+    if args.max_ms and (results['import']['import_main_ms'] or 0) > args.max_ms:
+        failures.append(f'import main 耗时 {results["import"]["import_main_ms"]:.1f}ms，超过上限 {args.max_ms:g}ms')
+
+    commit = git_commit()
+    output = args.output or os.path.join(RESULTS_DIR, f'startup-{commit}-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'commit': commit,
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': {'repeat': args.repeat, 'max_ms': args.max_ms},
+            'scenarios': results,
+            'failures': failures,
+        }, f, ensure_ascii=False, indent=2)
+    print(f'结果已保存: {output}')
+    for failure in failures:
+        print(f'失败: {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main_cli()
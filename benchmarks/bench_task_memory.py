@@ -0,0 +1,85 @@
+"""排队任务内存占用基准
+
+用 tracemalloc 比较下载队列中保留完整 telethon Message 对象与 MediaTask 紧凑记录的每任务内存占用。
+
+用法：
+    python benchmarks/bench_task_memory.py --count 100000
+"""
+import os
+import sys
+import random
+import argparse
+import tempfile
+import tracemalloc
+from datetime import datetime, timezone
+
+# 未指定数据目录时使用临时目录，进程退出时删除
+TMP_DATA_DIR = None
+if 'TGDL_DATA_DIR' not in os.environ:
+    TMP_DATA_DIR = tempfile.TemporaryDirectory(prefix='tgdl_bench_', ignore_cleanup_errors=True)
+    os.environ['TGDL_DATA_DIR'] = TMP_DATA_DIR.name
+os.environ.setdefault('TGDL_DISABLE_TQDM', 'true')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telethon.tl.types import (  # noqa: E402
+    Message, MessageMediaDocument, Document, DocumentAttributeFilename, DocumentAttributeAudio,
+    PeerChannel, MessageEntityUrl, MessageEntityBold
+)
+from main import MediaTask  # noqa: E402
+
+CHANNEL_ID = 1234567890
+TEXTS = [
+    '周杰伦 - 晴天 无损音乐分享 #FLAC #周杰伦',
+    '资源合集 https://pan.baidu.com/s/1AbCdEfGh 提取码: x7k9',
+    'New album out now! ' + 'lorem ipsum dolor sit amet ' * 20,
+]
+FILENAMES = ['周杰伦 - 晴天.flac', 'Taylor Swift - Love Story.mp3', '[中文] 纪录片.mkv']
+MIMES = ['audio/flac', 'audio/mpeg', 'video/x-matroska']
+
+
+def build_messages(count: int, seed: int = 42) -> list:
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    messages = []
+    for i in range(count):
+        idx = rng.randrange(len(FILENAMES))
+        text = rng.choice(TEXTS)
+        doc = Document(
+            id=rng.getrandbits(63), access_hash=rng.getrandbits(63), file_reference=rng.randbytes(28),
+            date=now, mime_type=MIMES[idx], size=rng.randint(1, 800) * 1024 * 1024, dc_id=rng.randint(1, 5),
+            attributes=[DocumentAttributeAudio(duration=rng.randint(60, 600)), DocumentAttributeFilename(file_name=FILENAMES[idx])]
+        )
+        messages.append(Message(
+            id=i + 1, peer_id=PeerChannel(CHANNEL_ID), date=now, message=text,
+            media=MessageMediaDocument(document=doc),
+            entities=[MessageEntityBold(offset=0, length=4), MessageEntityUrl(offset=5, length=10)]
+        ))
+    return messages
+
+
+def measure(build) -> int:
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    queue = build()
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del queue
+    return current - baseline
+
+
+def main():
+    parser = argparse.ArgumentParser(description='排队任务内存占用基准')
+    parser.add_argument('--count', type=int, default=100_000, help='排队任务数量')
+    args = parser.parse_args()
+
+    full = measure(lambda: build_messages(args.count))
+    # Message 对象在转换后即被释放，只统计队列中实际保留的记录（含共享的文件名与文件引用）
+    compact = measure(lambda: [MediaTask.from_message(m, CHANNEL_ID) for m in build_messages(args.count)])
+    print(f'排队任务: {args.count} 条')
+    print(f'Message 对象: 共 {full / 1024 / 1024:8.2f}MB  每任务 {full / args.count:8.0f}B')
+    print(f'MediaTask 记录: 共 {compact / 1024 / 1024:8.2f}MB  每任务 {compact / args.count:8.0f}B')
+    print(f'节省: {1 - compact / full:6.1%}')
+
+
+if __name__ == '__main__':
+    main()
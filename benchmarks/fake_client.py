@@ -0,0 +1,307 @@
+"""离线基准用的 TelegramClient 替身
+
+在合成频道上实现 main.py 用到的客户端方法（iter_messages、get_entity、get_messages、download_media、
+download_file、iter_download、send_message），消息是真实的 telethon Message/Document 对象，
+可配置消息构成、文件大小、调用延迟、单连接带宽，以及随机注入 FloodWait 与连接断开。
+
+频道按"直播"方式发布：每次带 min_id（不带 offset_id）的 iter_messages 调用先发布 publish_batch 条新消息，
+模拟实时抓取轮询时频道持续有新内容，全部发布完后连续两次空轮询即视为抓取完毕（drained）。
+"""
+import bisect
+import random
+import asyncio
+import inspect
+from datetime import datetime, timezone, timedelta
+
+from telethon.errors import FloodWaitError
+from telethon.tl.types import (
+    Message, MessageMediaDocument, Document, DocumentAttributeFilename, DocumentAttributeAudio,
+    DocumentAttributeVideo, PeerChannel, PeerUser, MessageEntityTextUrl
+)
+
+# 消息类型 -> 默认权重
+DEFAULT_MIX = {'audio': 40, 'video': 15, 'document': 10, 'text': 20, 'link': 10, 'deeplink': 5}
+BOT_USERNAME = 'bench_share_bot'
+ARTISTS = ['周杰伦', '林俊杰', '陈奕迅', 'Taylor Swift', 'Adele', '五月天']
+TITLES = ['晴天', '江南', '十年', 'Love Story', 'Hello', '倔强']
+LINKS = [
+    'https://pan.baidu.com/s/1AbCdEfGh{n} 提取码: x7k9',
+    'https://www.alipan.com/s/Zx9Yw8{n}',
+    'https://pan.quark.cn/s/abc123def{n}',
+]
+
+
+def parse_mix(spec: str) -> dict:
+    """解析 'audio=40,video=15,text=20' 形式的消息构成，未列出的类型权重为 0"""
+    mix = {}
+    for part in spec.split(','):
+        if not part.strip():
+            continue
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in DEFAULT_MIX:
+            raise ValueError(f'未知的消息类型: {kind}（可选 {", ".join(DEFAULT_MIX)}）')
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+class FakeEntity:
+    """频道或机器人实体，只提供 main.py 读取的字段"""
+    def __init__(self, id: int, title: str = '', username: str = ''):
+        self.id = id
+        self.title = title
+        self.username = username
+        self.left = False
+
+
+class FakeChannel:
+    def __init__(self, entity: FakeEntity, messages: list, publish_batch: int):
+        self.entity = entity
+        # 按消息ID升序
+        self.messages = messages
+        self.by_id = {m.id: m for m in messages}
+        self.publish_batch = publish_batch
+        self.published = len(messages) if publish_batch <= 0 else 0
+        self.idle_polls = 0
+
+    def publish(self) -> None:
+        if self.published >= len(self.messages):
+            return
+        self.published = min(len(self.messages), self.published + self.publish_batch)
+
+    @property
+    def drained(self) -> bool:
+        # 第一次空轮询可能发生在最后一批消息下载之前，第二次说明上一批已经处理完
+        return self.idle_polls >= 2
+
+    @property
+    def visible(self) -> list:
+        return self.messages[:self.published]
+
+
+class FakeTelegramClient:
+    """TelegramClient 替身
+
+    Args:
+        channels: 频道数量
+        messages_per_channel: 每个频道的消息数
+        mix: 消息类型权重（见 DEFAULT_MIX）
+        file_size: (最小, 最大) 文件字节数
+        latency: 每次 API 调用（及每页 100 条历史消息）的延迟秒数
+        bandwidth: 单个传输的带宽（字节/秒），0 表示不限
+        chunk_size: 下载分块大小
+        flood_rate: 每次调用（含每个下载分块）触发 FloodWait 的概率
+        flood_seconds: 注入的 FloodWait 秒数
+        disconnect_rate: 每次调用（含每个下载分块）抛出 ConnectionError 的概率
+        publish_batch: 每次实时轮询新发布的消息数，0 表示一开始全部可见
+    """
+    PAGE_SIZE = 100
+
+    def __init__(self, channels: int = 1, messages_per_channel: int = 1000, mix: dict | None = None,
+                 file_size: tuple = (64 * 1024, 1024 * 1024), latency: float = 0.0, bandwidth: float = 0.0,
+                 chunk_size: int = 128 * 1024, flood_rate: float = 0.0, flood_seconds: int = 0,
+                 disconnect_rate: float = 0.0, publish_batch: int = 0, seed: int = 42, base_channel_id: int = 1000000001):
+        self.rng = random.Random(seed)
+        self.mix = mix or DEFAULT_MIX
+        self.file_size = file_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.chunk_size = chunk_size
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.disconnect_rate = disconnect_rate
+        self.channels: dict[int, FakeChannel] = {}
+        self.documents: dict[int, int] = {}
+        self.bot = FakeEntity(base_channel_id - 1, username=BOT_USERNAME)
+        self.bot_messages: list = []
+        self.stats = {'calls': 0, 'flood_waits': 0, 'disconnects': 0, 'bytes_sent': 0}
+        self._zero = memoryview(bytes(chunk_size))
+        for n in range(channels):
+            cid = base_channel_id + n
+            entity = FakeEntity(cid, title=f'基准频道 {n + 1}')
+            self.channels[cid] = FakeChannel(entity, self._build_messages(cid, messages_per_channel), publish_batch)
+
+    @classmethod
+    def from_messages(cls, channels: dict, publish_batch: int = 0, **kwargs) -> 'FakeTelegramClient':
+        """用现成的消息（如回放的录制轨迹）构建频道，channels 为 {频道ID: [Message, ...]}"""
+        client = cls(channels=0, publish_batch=publish_batch, **kwargs)
+        for cid, messages in channels.items():
+            messages = sorted(messages, key=lambda m: m.id)
+            client.channels[cid] = FakeChannel(FakeEntity(cid, title=str(cid)), messages, publish_batch)
+            for m in messages:
+                doc = getattr(m.media, 'document', None)
+                if doc is not None:
+                    client.documents[doc.id] = doc.size
+        return client
+
+    # ---- 合成数据 ----
+
+    def _document(self, mime: str, filename: str, attributes: list) -> Document:
+        size = self.rng.randint(*self.file_size)
+        doc = Document(
+            id=self.rng.getrandbits(62), access_hash=self.rng.getrandbits(62), file_reference=self.rng.randbytes(20),
+            date=None, mime_type=mime, size=size, dc_id=self.rng.randint(1, 5),
+            attributes=attributes + [DocumentAttributeFilename(file_name=filename)]
+        )
+        self.documents[doc.id] = size
+        return doc
+
+    def _build_messages(self, channel_id: int, count: int) -> list:
+        kinds = list(self.mix)
+        weights = [self.mix[k] for k in kinds]
+        start = datetime.now(timezone.utc) - timedelta(seconds=count * 60)
+        first_channel = min(self.channels) if self.channels else channel_id
+        messages = []
+        for i in range(1, count + 1):
+            kind = self.rng.choices(kinds, weights)[0]
+            song = f'{self.rng.choice(ARTISTS)} - {self.rng.choice(TITLES)} {channel_id % 1000}-{i}'
+            text, media, entities = f'{song} 分享', None, None
+            if kind == 'audio':
+                doc = self._document('audio/mpeg', f'{song}.mp3', [DocumentAttributeAudio(duration=self.rng.randint(120, 360))])
+                media = MessageMediaDocument(document=doc)
+            elif kind == 'video':
+                doc = self._document('video/mp4', f'{song} MV.mp4', [DocumentAttributeVideo(duration=self.rng.randint(120, 360), w=1280, h=720)])
+                media = MessageMediaDocument(document=doc)
+            elif kind == 'document':
+                media = MessageMediaDocument(document=self._document('application/pdf', f'{song} 歌词.pdf', []))
+            elif kind == 'link':
+                text = f'{song} 网盘: ' + self.rng.choice(LINKS).format(n=i)
+                entities = [MessageEntityTextUrl(offset=0, length=len(song), url=f'https://pan.quark.cn/s/ent{channel_id % 1000}x{i}')]
+            elif kind == 'deeplink':
+                # 指向第一个频道中的某条消息，实时抓取会调用 get_entity/get_messages/send_message 解析
+                text = f'{song} 获取链接 https://t.me/{BOT_USERNAME}?start=get_link_{first_channel}_{self.rng.randint(1, count)}_baidu'
+            messages.append(Message(
+                id=i, peer_id=PeerChannel(channel_id), date=start + timedelta(seconds=i * 60),
+                message=text, media=media, entities=entities
+            ))
+        return messages
+
+    # ---- 故障注入 ----
+
+    async def _api(self) -> None:
+        self.stats['calls'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self._inject()
+
+    def _inject(self) -> None:
+        if self.flood_rate and self.rng.random() < self.flood_rate:
+            self.stats['flood_waits'] += 1
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+        if self.disconnect_rate and self.rng.random() < self.disconnect_rate:
+            self.stats['disconnects'] += 1
+            raise ConnectionError('基准注入的连接断开')
+
+    def _channel(self, entity) -> FakeChannel:
+        cid = getattr(entity, 'id', entity)
+        if cid not in self.channels:
+            raise ValueError(f'Could not find the input entity for {entity!r}')
+        return self.channels[cid]
+
+    # ---- TelegramClient 接口 ----
+
+    def is_connected(self) -> bool:
+        return True
+
+    async def disconnect(self) -> None:
+        pass
+
+    async def get_entity(self, entity):
+        await self._api()
+        if entity in (BOT_USERNAME, self.bot.id) or getattr(entity, 'id', None) == self.bot.id:
+            return self.bot
+        return self._channel(entity).entity
+
+    async def iter_messages(self, entity, limit=None, min_id=None, offset_id=0, **kwargs):
+        if getattr(entity, 'id', entity) == self.bot.id:
+            pool = self.bot_messages
+        else:
+            channel = self._channel(entity)
+            if min_id is not None and not offset_id:
+                # 实时轮询：先发布一批新消息；全部发布后再轮询即为空轮询
+                if channel.published >= len(channel.messages):
+                    channel.idle_polls += 1
+                channel.publish()
+            pool = channel.visible
+        # Telegram 语义：从新到旧，offset_id 之前（不含），min_id 之后（不含）
+        hi = bisect.bisect_left(pool, offset_id, key=lambda m: m.id) if offset_id else len(pool)
+        remaining = limit if limit is not None else float('inf')
+        index = hi - 1
+        while remaining > 0 and index >= 0:
+            await self._api()
+            page_end = max(index - self.PAGE_SIZE, -1)
+            while index > page_end and remaining > 0:
+                msg = pool[index]
+                index -= 1
+                if min_id and msg.id <= min_id:
+                    return
+                remaining -= 1
+                yield msg
+
+    async def get_messages(self, entity, limit=None, ids=None, **kwargs):
+        if ids is None:
+            return [m async for m in self.iter_messages(entity, limit=limit or 1)]
+        await self._api()
+        channel = self._channel(entity)
+        if isinstance(ids, (list, tuple)):
+            return [channel.by_id.get(i) for i in ids]
+        return channel.by_id.get(ids)
+
+    async def send_message(self, entity, message, **kwargs):
+        await self._api()
+        sent = Message(id=len(self.bot_messages) + 1, peer_id=PeerUser(self.bot.id), date=datetime.now(timezone.utc), message=message, out=True)
+        self.bot_messages.append(sent)
+        if getattr(entity, 'id', None) == self.bot.id:
+            # 机器人立即回复一个网盘链接
+            self.bot_messages.append(Message(
+                id=len(self.bot_messages) + 1, peer_id=PeerUser(self.bot.id), date=datetime.now(timezone.utc),
+                message='资源链接 ' + self.rng.choice(LINKS).format(n=sent.id), reply_to=None
+            ))
+        return sent
+
+    async def _transfer(self, size: int, offset: int):
+        """按带宽节流产出数据块；每个分块都可能注入 FloodWait 或断开"""
+        sent = offset
+        while sent < size:
+            n = min(self.chunk_size, size - sent)
+            if self.bandwidth:
+                await asyncio.sleep(n / self.bandwidth)
+            else:
+                await asyncio.sleep(0)
+            self._inject()
+            sent += n
+            self.stats['bytes_sent'] += n
+            yield self._zero[:n]
+
+    async def download_file(self, input_location, file=None, part_size_kb=None, file_size=None, progress_callback=None, dc_id=None, **kwargs):
+        await self._api()
+        size = self.documents.get(getattr(input_location, 'id', None), file_size or 0)
+        async for chunk in self._transfer(size, 0):
+            r = file.write(chunk)
+            if inspect.isawaitable(r):
+                await r
+            if progress_callback:
+                r = progress_callback(file.tell(), size)
+                if inspect.isawaitable(r):
+                    await r
+        return file
+
+    async def iter_download(self, file, offset=0, file_size=None, dc_id=None, **kwargs):
+        await self._api()
+        size = self.documents.get(getattr(file, 'id', None), file_size or 0)
+        async for chunk in self._transfer(size, offset):
+            yield chunk
+
+    async def download_media(self, message, file=None, progress_callback=None, **kwargs):
+        doc = message.media.document
+        return await self.download_file(doc, file, file_size=doc.size, progress_callback=progress_callback)
+
+    # ---- 统计 ----
+
+    @property
+    def drained(self) -> bool:
+        return all(c.drained for c in self.channels.values())
+
+    @property
+    def total_messages(self) -> int:
+        return sum(len(c.messages) for c in self.channels.values())
@@ -0,0 +1,160 @@
+"""S3 分片上传用的内存替身
+
+实现 main.S3Sink / S3UploadWriter 用到的 boto3 S3 客户端接口（create/upload_part/list_parts/complete/abort、
+head_object、get_object、delete_object、list_multipart_uploads），行为按 S3 与 MinIO：
+    - 除最后一个分片外，分片小于 5MB 时合并失败（EntityTooSmall）
+    - list_parts 分页返回，每页 max_parts 个分片
+    - 合并或取消后 upload_id 失效（NoSuchUpload）
+FaultInjector 可包装替身或真实的 boto3 客户端，让指定方法的后续若干次调用失败，用于校验续传与清理路径。
+
+    client = FaultInjector(FakeS3Client())
+    client.fail('list_parts')
+    sink = main.S3Sink({'bucket': 'tlg', 'part_size_mb': 5}, client=client)
+"""
+import io
+import uuid
+import hashlib
+import threading
+from types import SimpleNamespace
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class ClientError(Exception):
+    """与 botocore.exceptions.ClientError 相同地通过 response['Error']['Code'] 区分错误"""
+    def __init__(self, code: str, operation: str):
+        super().__init__(f'An error occurred ({code}) when calling the {operation} operation')
+        self.response = {'Error': {'Code': code}}
+
+
+class FakeS3Client:
+    exceptions = SimpleNamespace(ClientError=ClientError)
+
+    def __init__(self, max_parts: int = 2):
+        self.max_parts = max_parts
+        self.objects: dict = {}
+        # upload_id -> {'bucket', 'key', 'parts': {编号: (ETag, 数据)}}
+        self.uploads: dict = {}
+        self.calls: dict = {}
+        self.lock = threading.Lock()
+
+    def _count(self, name: str) -> None:
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _upload(self, operation: str, upload_id: str) -> dict:
+        upload = self.uploads.get(upload_id)
+        if upload is None:
+            raise ClientError('NoSuchUpload', operation)
+        return upload
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        with self.lock:
+            self._count('create_multipart_upload')
+            upload_id = uuid.uuid4().hex
+            self.uploads[upload_id] = {'bucket': Bucket, 'key': Key, 'parts': {}}
+            return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        with self.lock:
+            self._count('upload_part')
+            upload = self._upload('UploadPart', UploadId)
+            data = bytes(Body)
+            etag = f'"{hashlib.md5(data).hexdigest()}"'
+            upload['parts'][PartNumber] = (etag, data)
+            return {'ETag': etag}
+
+    def get_paginator(self, name: str):
+        if name != 'list_parts':
+            raise NotImplementedError(name)
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Key, UploadId, **kwargs):
+                with client.lock:
+                    client._count('list_parts')
+                    upload = client._upload('ListParts', UploadId)
+                    parts = [{'PartNumber': n, 'ETag': etag, 'Size': len(data)} for n, (etag, data) in sorted(upload['parts'].items())]
+                for i in range(0, max(len(parts), 1), client.max_parts):
+                    yield {'Parts': parts[i:i + client.max_parts], 'IsTruncated': i + client.max_parts < len(parts)}
+
+        return Paginator()
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        with self.lock:
+            self._count('complete_multipart_upload')
+            upload = self._upload('CompleteMultipartUpload', UploadId)
+            requested = MultipartUpload['Parts']
+            data = bytearray()
+            for i, part in enumerate(requested):
+                stored = upload['parts'].get(part['PartNumber'])
+                if stored is None or stored[0] != part['ETag']:
+                    raise ClientError('InvalidPart', 'CompleteMultipartUpload')
+                if i < len(requested) - 1 and len(stored[1]) < MIN_PART_SIZE:
+                    raise ClientError('EntityTooSmall', 'CompleteMultipartUpload')
+                data += stored[1]
+            self.objects[(Bucket, Key)] = bytes(data)
+            del self.uploads[UploadId]
+            return {'Bucket': Bucket, 'Key': Key}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        with self.lock:
+            self._count('abort_multipart_upload')
+            self._upload('AbortMultipartUpload', UploadId)
+            del self.uploads[UploadId]
+            return {}
+
+    def list_multipart_uploads(self, Bucket, Prefix='', **kwargs):
+        with self.lock:
+            return {'Uploads': [{'Key': u['key'], 'UploadId': upload_id} for upload_id, u in self.uploads.items()
+                                if u['bucket'] == Bucket and u['key'].startswith(Prefix)]}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise ClientError('404', 'HeadObject')
+            return {'ContentLength': len(self.objects[(Bucket, Key)])}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        with self.lock:
+            self._count('get_object')
+            if (Bucket, Key) not in self.objects:
+                raise ClientError('NoSuchKey', 'GetObject')
+            return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+            return {}
+
+
+class FaultInjector:
+    """转发到被包装的客户端；fail(方法名, 次数) 后该方法的接下来若干次调用抛出 ClientError"""
+    def __init__(self, client):
+        self.client = client
+        self.pending: dict = {}
+
+    @property
+    def exceptions(self):
+        return self.client.exceptions
+
+    def fail(self, name: str, times: int = 1) -> None:
+        self.pending[name] = self.pending.get(name, 0) + times
+
+    def _check(self, name: str) -> None:
+        if self.pending.get(name):
+            self.pending[name] -= 1
+            raise ClientError('InternalError', name)
+
+    def get_paginator(self, name: str):
+        self._check(name)
+        return self.client.get_paginator(name)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self._check(name)
+            return attr(*args, **kwargs)
+        return call
@@ -0,0 +1,159 @@
+"""云盘分享链接探测用的本地替身服务
+
+按 main.LinkProbe 的规则实现各提供方被探测的接口，分享的状态由分享 ID 中的关键字决定：
+    含 dead  已取消/删除（百度、迅雷跳转到错误页，阿里云盘返回 ShareLink.Cancelled，夸克/UC 返回"分享不存在"）
+    含 gone  404
+    含 busy  503（探测结果应为 unknown）
+    含 slow  额外延迟 10 倍
+    其他     有效
+记录请求数与同时处理的最大请求数，用于验证每主机并发上限。
+
+单独运行后把探测请求改发到这里：
+    python benchmarks/fake_share_host.py --port 8081
+    TGDL_LINK_PROBE_ENABLED=1 TGDL_LINK_PROBE_ENDPOINT=http://127.0.0.1:8081 python main.py
+"""
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+ALIVE_PAGE = '<html><body><div>请输入提取码</div></body></html>'
+ERROR_PAGE = '<html><body>啊哦，你来晚了，分享的文件已经被删除了 / 分享不存在</body></html>'
+
+
+class FakeShareHost:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency_ms: float = 0):
+        self.latency = latency_ms / 1000
+        self.requests = 0
+        self.inflight = 0
+        self.max_inflight = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'FakeShareHost':
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-share-host', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        host = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # 保持连接，让探测方的连接池生效
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: str, content_type: str = 'text/html; charset=utf-8', headers: dict | None = None):
+                data = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _json(self, status: int, obj: dict):
+                self._send(status, json.dumps(obj, ensure_ascii=False), 'application/json')
+
+            def _enter(self, share_id: str) -> bool:
+                """登记请求并模拟延迟；返回 False 表示已按 gone/busy 响应"""
+                with host.lock:
+                    host.requests += 1
+                    host.inflight += 1
+                    host.max_inflight = max(host.max_inflight, host.inflight)
+                try:
+                    time.sleep(host.latency * (10 if 'slow' in share_id else 1))
+                finally:
+                    with host.lock:
+                        host.inflight -= 1
+                if 'gone' in share_id:
+                    self._send(404, 'not found')
+                    return False
+                if 'busy' in share_id:
+                    self._send(503, 'busy')
+                    return False
+                return True
+
+            def _body(self) -> dict:
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    return json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    return {}
+
+            def do_GET(self):
+                path = urlsplit(self.path).path
+                if path.startswith('/share/error'):
+                    self._send(200, ERROR_PAGE)
+                    return
+                if not path.startswith('/s/'):
+                    self._send(404, 'not found')
+                    return
+                share_id = path[len('/s/'):]
+                if not self._enter(share_id):
+                    return
+                if 'dead' in share_id:
+                    self._send(302, '', headers={'Location': '/share/error?errno=9'})
+                else:
+                    self._send(200, ALIVE_PAGE)
+
+            def do_POST(self):
+                parts = urlsplit(self.path)
+                body = self._body()
+                if parts.path == '/adrive/v3/share_link/get_share_by_anonymous':
+                    share_id = parse_qs(parts.query).get('share_id', [''])[0] or body.get('share_id', '')
+                    if not self._enter(share_id):
+                        return
+                    if 'dead' in share_id:
+                        self._json(400, {'code': 'ShareLink.Cancelled', 'message': 'share link is cancelled'})
+                    else:
+                        self._json(200, {'file_infos': [{'file_id': '1'}], 'share_name': share_id})
+                elif parts.path == '/1/clouddrive/share/sharepage/token':
+                    share_id = body.get('pwd_id', '')
+                    if not self._enter(share_id):
+                        return
+                    if 'dead' in share_id:
+                        self._json(200, {'status': 404, 'code': 41006, 'message': '分享不存在'})
+                    else:
+                        self._json(200, {'status': 200, 'code': 0, 'data': {'stoken': 'fake-' + share_id}})
+                else:
+                    self._send(404, 'not found')
+
+        return Handler
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='云盘分享链接探测的本地替身服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=50, help='每个请求的模拟延迟')
+    args = parser.parse_args()
+    server = FakeShareHost(args.host, args.port, args.latency_ms)
+    print(f'替身服务: {server.url}（分享ID 含 dead/gone/busy/slow 时分别模拟失效、404、503、慢响应）')
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+
+
+if __name__ == '__main__':
+    main_cli()
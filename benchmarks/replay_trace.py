@@ -0,0 +1,185 @@
+"""抓取轨迹回放
+
+把 `main.py --capture` 录制的 JSON Lines 轨迹（消息文本、实体与文档元数据，不含媒体内容）
+以最快速度重新送入过滤与链接识别流程，离线、可复现地比较规则调整与优化的效果：
+    classify    逐条经 MessageClassifier.classify（MediaValidator + ResourceExtractor），输出每条消息的决策
+    preprocess  经 MessagePreprocessor.fetch_valid_messages（去重、分类、排队），轨迹由 TelegramClient 替身提供
+
+使用指定的配置文件（默认 data/config/config.json）做决策；运行时使用临时数据目录，不读写真实的进度状态。
+结果 JSON 与 bench_pipeline.py 格式相同，可用 `bench_pipeline.py --compare` 对比。
+
+用法：
+    python main.py --capture data/trace.jsonl
+    python benchmarks/replay_trace.py data/trace.jsonl --decisions /tmp/decisions.jsonl
+    python benchmarks/replay_trace.py data/trace.jsonl --config /tmp/new-rules.json --modes classify
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+
+SOURCE_DATA_DIR = os.getenv('TGDL_DATA_DIR', './data')
+# 回放不应读写真实的进度状态与下载目录；临时数据目录在进程退出时删除
+TMP_DATA_DIR = tempfile.TemporaryDirectory(prefix='tgdl_replay_', ignore_cleanup_errors=True)
+os.environ['TGDL_DATA_DIR'] = TMP_DATA_DIR.name
+os.environ.setdefault('TGDL_DISABLE_TQDM', 'true')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from telethon.tl.types import (  # noqa: E402
+    Message, MessageMediaDocument, Document, DocumentAttributeFilename, PeerChannel, MessageEntityTextUrl, MessageEntityUrl
+)
+import main  # noqa: E402
+from fake_client import FakeTelegramClient  # noqa: E402
+from bench_pipeline import RESULTS_DIR, git_commit, print_result  # noqa: E402
+
+MODES = ('classify', 'preprocess')
+
+
+def load_trace(path: str) -> list:
+    return [(channel_id or 0, desc) for channel_id, desc in main.TraceRecorder.read(path)]
+
+
+def to_message(channel_id: int, desc: 'main.MessageDescriptor', doc_id: int) -> Message:
+    """由轨迹记录还原 telethon Message（文档只含文件名属性，足够过滤与排队使用）"""
+    entities = [
+        MessageEntityTextUrl(offset=offset or 0, length=length or 0, url=url) if url else MessageEntityUrl(offset=offset or 0, length=length or 0)
+        for offset, length, url in desc.entities
+    ]
+    media = None
+    if desc.has_document:
+        media = MessageMediaDocument(document=Document(
+            id=doc_id, access_hash=0, file_reference=b'', date=None, mime_type=desc.mime, size=desc.size, dc_id=1,
+            attributes=[DocumentAttributeFilename(file_name=desc.filename)] if desc.filename else []
+        ))
+    return Message(id=desc.id, peer_id=PeerChannel(channel_id), date=desc.date, message=desc.text, media=media, entities=entities or None)
+
+
+def metric_values(name: str, label: str) -> dict:
+    return {dict(labels).get(label, ''): v for (n, labels), v in main.METRICS.values.items() if n == name}
+
+
+def replay_classify(trace: list, config: dict, decisions_path: str | None) -> dict:
+    descs = [desc for _, desc in trace]
+    start = time.perf_counter()
+    results = main.MessageClassifier.classify_batch(descs, config['media_types'], config)
+    elapsed = time.perf_counter() - start
+    decisions: dict[str, int] = {}
+    providers: dict[str, int] = {}
+    for r in results:
+        key = 'download' if r['download'] else r['skip_reason']
+        decisions[key] = decisions.get(key, 0) + 1
+        for t in r['cloud_tasks']:
+            providers[t.get('provider', '')] = providers.get(t.get('provider', ''), 0) + 1
+    if decisions_path:
+        with open(decisions_path, 'w', encoding='utf-8') as f:
+            for (channel_id, desc), r in zip(trace, results):
+                f.write(json.dumps({
+                    'channel_id': channel_id,
+                    'id': desc.id,
+                    'decision': 'download' if r['download'] else r['skip_reason'],
+                    'links': [t.get('full_url', '') for t in r['cloud_tasks']],
+                    'deeplinks': len(r['deeplinks']),
+                }, ensure_ascii=False) + '\n')
+    return {
+        'messages': len(descs), 'seconds': elapsed, 'messages_per_second': len(descs) / elapsed if elapsed else 0.0,
+        'decisions': decisions, 'links': providers,
+        'deeplinks': sum(len(r['deeplinks']) for r in results),
+    }
+
+
+async def replay_preprocess(trace: list, config: dict) -> dict:
+    # 轨迹中没有机器人回复，不等待 /start 的回复
+    config = {**config, 'bot_interaction': {**config.get('bot_interaction', {}), 'start_reply_wait_seconds': 0}}
+    settings = main.ConfigManager.get_download_settings(config)
+    channels: dict[int, list] = {}
+    for n, (channel_id, desc) in enumerate(trace):
+        channels.setdefault(channel_id, []).append(to_message(channel_id, desc, n + 1))
+    fake = FakeTelegramClient.from_messages(channels, publish_batch=settings['batch_size'] * 2)
+    # 不启用限流，按最快速度回放
+    client = main.RateLimitedClient(fake, main.ApiRateLimiter({'enabled': False}))
+    preprocessor = main.MessagePreprocessor(client, config['media_types'], config)
+    scanned = main.METRICS.values.get(main.Metrics._key('tgdl_messages_scanned_total', {}), 0)
+    filtered = metric_values('tgdl_messages_filtered_total', 'reason')
+    found = metric_values('tgdl_links_found_total', 'provider')
+    media = links = 0
+    start = time.perf_counter()
+    try:
+        for channel in fake.channels.values():
+            while not channel.drained:
+                for t in await preprocessor.fetch_valid_messages(channel.entity, client):
+                    if isinstance(t, main.MediaTask):
+                        media += 1
+                    else:
+                        links += 1
+    finally:
+        preprocessor.classifier.shutdown()
+    elapsed = time.perf_counter() - start
+    scanned = main.METRICS.values.get(main.Metrics._key('tgdl_messages_scanned_total', {}), 0) - scanned
+    return {
+        'messages': scanned, 'seconds': elapsed, 'messages_per_second': scanned / elapsed if elapsed else 0.0,
+        'queued_media': media, 'queued_links': links,
+        'decisions': {k: v - filtered.get(k, 0) for k, v in metric_values('tgdl_messages_filtered_total', 'reason').items() if v - filtered.get(k, 0)},
+        'links': {k: v - found.get(k, 0) for k, v in metric_values('tgdl_links_found_total', 'provider').items() if v - found.get(k, 0)},
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='回放抓取轨迹，离线比较过滤与链接识别规则')
+    parser.add_argument('trace', help='main.py --capture 录制的 JSON Lines 文件')
+    parser.add_argument('--config', default=os.path.join(SOURCE_DATA_DIR, 'config', 'config.json'), help='用于决策的配置文件')
+    parser.add_argument('--modes', default=','.join(MODES), help=f'回放方式（逗号分隔，可选 {",".join(MODES)}）')
+    parser.add_argument('--repeat', type=int, default=1, help='重复回放次数，取最快一次（轨迹较小时减少计时噪声）')
+    parser.add_argument('--decisions', help='classify 方式下把每条消息的决策写入该 JSON Lines 文件，便于逐条对比')
+    parser.add_argument('--log-level', default='WARNING', help='main 的日志级别')
+    parser.add_argument('--output', help='结果 JSON 路径（默认 benchmarks/results/replay-<提交>-<时间>.json）')
+    args = parser.parse_args()
+
+    modes = [m.strip() for m in args.modes.split(',') if m.strip()]
+    unknown = [m for m in modes if m not in MODES]
+    if unknown:
+        parser.error(f'未知回放方式: {", ".join(unknown)}')
+    if not os.path.exists(args.config):
+        parser.error(f'配置文件不存在: {args.config}')
+    with open(args.config, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    main.setup_logging(log_file=None)
+    main.logger.setLevel(args.log_level.upper())
+    trace = load_trace(args.trace)
+    print(f'轨迹: {args.trace}，{len(trace)} 条消息，配置: {args.config}')
+
+    results = {}
+    for mode in modes:
+        best = None
+        for _ in range(max(args.repeat, 1)):
+            if mode == 'classify':
+                result = replay_classify(trace, config, args.decisions)
+            else:
+                result = asyncio.run(replay_preprocess(trace, config))
+            if best is None or result['seconds'] < best['seconds']:
+                best = result
+        results[mode] = best
+        print_result(mode, best)
+        print(f'[{mode}] links: ' + json.dumps(best['links'], ensure_ascii=False))
+
+    commit = git_commit()
+    output = args.output or os.path.join(RESULTS_DIR, f'replay-{commit}-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'commit': commit,
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': {'trace': os.path.abspath(args.trace), 'config': os.path.abspath(args.config), 'modes': modes, 'repeat': args.repeat},
+            'scenarios': results,
+        }, f, ensure_ascii=False, indent=2)
+    print(f'结果已保存: {output}')
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import os
 import json
 import asyncio
@@ -6,20 +8,65 @@ import time
 import signal
 import sys
 import logging
-import psutil
 import argparse
-import requests
-from telethon import TelegramClient
-from telethon.errors import SessionPasswordNeededError
-from telethon.tl.types import MessageMediaDocument, DocumentAttributeFilename
-from telethon.tl.functions.messages import GetDialogsRequest
-from telethon.tl.types import InputPeerEmpty
-from tqdm import tqdm
+import math
+import inspect
+import importlib
+import multiprocessing
+import socket
+import sqlite3
+import errno
+import hashlib
+import io
+import heapq
+import random
+import shutil
+import tarfile
+import tempfile
+import threading
+import traceback
+import bisect
+import gc
+import sysconfig
+import tracemalloc
+import weakref
+from datetime import datetime, timezone
 from asyncio import Semaphore
-from collections import deque
-from mutagen.id3 import ID3NoHeaderError
-from mutagen.flac import FLAC
-from mutagen import File
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+class LazyModule:
+    """首次访问属性时才导入的模块代理
+
+    telethon、requests、tqdm、mutagen、psutil 的导入占启动耗时的大部分，
+    而 --print-config 与离线子命令（retention、pack、retry-queue 等）用不到它们。
+    按名称导入的模块 PyInstaller 分析不到，新增代理时需同步加入 tlgspider.spec 的 HIDDEN_IMPORTS。
+    """
+    def __init__(self, name: str):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr: str):
+        module = self.__dict__['_module']
+        if module is None:
+            module = self.__dict__['_module'] = importlib.import_module(self.__dict__['_name'])
+        return getattr(module, attr)
+
+    def __repr__(self) -> str:
+        return f'<lazy module {self._name!r}>'
+
+psutil = LazyModule('psutil')
+requests = LazyModule('requests')
+telethon = LazyModule('telethon')
+tg_utils = LazyModule('telethon.utils')
+tg_errors = LazyModule('telethon.errors')
+tg_types = LazyModule('telethon.tl.types')
+tg_functions = LazyModule('telethon.tl.functions.messages')
+tqdm_lib = LazyModule('tqdm')
+mutagen = LazyModule('mutagen')
+mutagen_flac = LazyModule('mutagen.flac')
+mutagen_id3 = LazyModule('mutagen.id3')
 
 # 配置常量
 DISABLE_TQDM = os.getenv('TGDL_DISABLE_TQDM', 'false').lower() == 'true'
@@ -27,52 +74,64 @@ DATA_DIR = os.getenv('TGDL_DATA_DIR', './data')
 CONFIG_DIR = os.path.join(DATA_DIR, 'config')
 CONFIG_FILE = os.path.join(CONFIG_DIR, 'config.json')
 CHANNELS_FILE = os.path.join(CONFIG_DIR, 'channels.txt')
-SESSION_DIR = os.path.join(CONFIG_DIR, 'sessions')
+SESSION_DIR = os.getenv('TGDL_SESSION_DIR', os.path.join(CONFIG_DIR, 'sessions'))
 MEDIA_DIR = os.path.join(DATA_DIR, 'downloads')
-
-# 配置时区（支持环境变量配置）
+# 日志文件（相对于工作目录），设为空字符串时只输出到控制台
+LOG_FILE = os.getenv('TGDL_LOG_FILE', 'telegram_downloader.log')
 TIMEZONE = os.getenv('TZ', 'Asia/Shanghai')
-os.environ['TZ'] = TIMEZONE
-try:
-    time.tzset()
-except AttributeError:
-    # Windows系统不支持tzset，使用time.localtime
-    pass
-
-# 配置日志
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-log_file_handler = logging.FileHandler('telegram_downloader.log', encoding='utf-8')
-log_file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
-log_file_handler.formatter.converter = time.localtime
-logger.addHandler(log_file_handler)
-
-if DISABLE_TQDM:
-    class PrintHandler(logging.Handler):
-        def emit(self, record):
-            print(self.format(record), flush=True)
-    print_handler = PrintHandler()
-    print_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
-    print_handler.formatter.converter = time.localtime
-    logger.addHandler(print_handler)
-else:
-    class TqdmHandler(logging.Handler):
-        def emit(self, record):
-            try:
-                tqdm.write(self.format(record))
-            except Exception:
-                self.handleError(record)
-    # 控制台 tqdm 兼容输出
-    tqdm_handler = TqdmHandler()
-    tqdm_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
-    tqdm_handler.formatter.converter = time.localtime
-    logger.addHandler(tqdm_handler)
-
-# 初始化目录
-for directory in [DATA_DIR, CONFIG_DIR, SESSION_DIR, MEDIA_DIR]:
-    os.makedirs(directory, exist_ok=True)
-    logger.debug(f'确保目录存在: {directory}')
+class PrintHandler(logging.Handler):
+    def emit(self, record):
+        print(self.format(record), flush=True)
+
+class TqdmHandler(logging.Handler):
+    def emit(self, record):
+        try:
+            # 尚未导入 tqdm 时不会有进度条，直接输出，避免仅为写日志而导入
+            if 'tqdm' in sys.modules:
+                tqdm_lib.tqdm.write(self.format(record))
+            else:
+                print(self.format(record), flush=True)
+        except Exception:
+            self.handleError(record)
+
+def setup_timezone() -> None:
+    """配置时区（支持环境变量 TZ 配置）"""
+    os.environ['TZ'] = TIMEZONE
+    try:
+        time.tzset()
+    except AttributeError:
+        # Windows系统不支持tzset，使用time.localtime
+        pass
+
+def setup_logging(log_file: str | None = LOG_FILE, stream=None) -> None:
+    """配置日志文件与控制台输出；导入本模块不会产生任何输出或文件，由入口（或基准脚本）显式调用
+
+    指定 stream（如 sys.stderr）时控制台日志写到该流，而不是与进度条共用的标准输出。
+    """
+    if logger.handlers:
+        return
+    handlers = []
+    if log_file:
+        handlers.append(logging.FileHandler(log_file, encoding='utf-8'))
+    if stream is not None:
+        handlers.append(logging.StreamHandler(stream))
+    else:
+        # 控制台 tqdm 兼容输出
+        handlers.append(PrintHandler() if DISABLE_TQDM else TqdmHandler())
+    for handler in handlers:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+        handler.formatter.converter = time.localtime
+        logger.addHandler(handler)
+
+def init_data_dirs() -> None:
+    """初始化数据目录；在构造下载器时调用，而不是导入时"""
+    for directory in [DATA_DIR, CONFIG_DIR, SESSION_DIR, MEDIA_DIR]:
+        os.makedirs(directory, exist_ok=True)
+        logger.debug(f'确保目录存在: {directory}')
 
 # 全局状态
 stop_event = asyncio.Event()
@@ -107,7 +166,11 @@ class ConfigManager:
                     'enabled': False,
                     'check_type': 'size',  # 'size', 'duration' 或 'both'
                     'min_size_mb': 1,  # 最小文件大小（MB）
-                    'min_duration_seconds': 0  # 最小音频时长（秒）
+                    'min_duration_seconds': 0,  # 最小音频时长（秒）
+                    'probe_enabled': False,  # 替换前先探测新文件头尾解析编码参数
+                    'probe_head_kb': 256,
+                    'probe_tail_kb': 128,
+                    'min_bitrate_kbps': 0
                 }
             # 添加下载参数配置（如果不存在）
             if 'download_settings' not in config:
@@ -146,8 +209,229 @@ class ConfigManager:
                     'start_reply_limit': int(os.getenv('TGDL_START_REPLY_LIMIT', '5'))
                 }
                 ConfigManager.save_config(config)
+            if 'rate_limit' not in config:
+                config['rate_limit'] = ConfigManager.default_rate_limit_config()
+                ConfigManager.save_config(config)
+            if 'accounts' not in config:
+                # 额外账号：[{"phone_number": "...", "api_id": 可选, "api_hash": 可选, "proxy": 可选}]
+                config['accounts'] = []
+                ConfigManager.save_config(config)
+            if 'coordination' not in config:
+                config['coordination'] = ConfigManager.default_coordination_config()
+                ConfigManager.save_config(config)
+            if 'adaptive_concurrency' not in config:
+                config['adaptive_concurrency'] = ConfigManager.default_adaptive_concurrency_config()
+                ConfigManager.save_config(config)
+            if 'backfill' not in config:
+                config['backfill'] = ConfigManager.default_backfill_config()
+                ConfigManager.save_config(config)
+            if 'storage' not in config:
+                config['storage'] = ConfigManager.default_storage_config()
+                ConfigManager.save_config(config)
+            if 'metrics' not in config:
+                config['metrics'] = ConfigManager.default_metrics_config()
+                ConfigManager.save_config(config)
+            if 'tracing' not in config:
+                config['tracing'] = ConfigManager.default_tracing_config()
+                ConfigManager.save_config(config)
+            if 'retention' not in config:
+                config['retention'] = ConfigManager.default_retention_config()
+                ConfigManager.save_config(config)
+            if 'retry_queue' not in config:
+                config['retry_queue'] = ConfigManager.default_retry_queue_config()
+                ConfigManager.save_config(config)
+            if 'channel_discovery' not in config:
+                config['channel_discovery'] = ConfigManager.default_channel_discovery_config()
+                ConfigManager.save_config(config)
+            if 'bandwidth' not in config:
+                config['bandwidth'] = ConfigManager.default_bandwidth_config()
+                ConfigManager.save_config(config)
+            if 'control' not in config:
+                config['control'] = ConfigManager.default_control_config()
+                ConfigManager.save_config(config)
+            if 'memory' not in config:
+                config['memory'] = ConfigManager.default_memory_config()
+                ConfigManager.save_config(config)
+            if 'link_probe' not in config:
+                config['link_probe'] = ConfigManager.default_link_probe_config()
+                ConfigManager.save_config(config)
         return config
 
+    @staticmethod
+    def default_metrics_config() -> dict:
+        return {
+            'enabled': os.getenv('TGDL_METRICS_ENABLED', '0').lower() in ('1', 'true', 'yes'),
+            'host': os.getenv('TGDL_METRICS_HOST', '0.0.0.0'),
+            'port': int(os.getenv('TGDL_METRICS_PORT', '9464'))
+        }
+
+    @staticmethod
+    def default_tracing_config() -> dict:
+        return {
+            'enabled': os.getenv('TGDL_TRACING_ENABLED', '0').lower() in ('1', 'true', 'yes'),
+            'path': os.getenv('TGDL_TRACE_FILE', os.path.join(DATA_DIR, 'traces', 'spans.jsonl')),
+            'format': os.getenv('TGDL_TRACE_FORMAT', 'jsonl'),            # jsonl / otlp
+            'sample_rate': float(os.getenv('TGDL_TRACE_SAMPLE_RATE', '1.0')),
+            'include_skipped': os.getenv('TGDL_TRACE_INCLUDE_SKIPPED', '0').lower() in ('1', 'true', 'yes')  # 是否导出未下载消息的追踪
+        }
+
+    @staticmethod
+    def default_channel_discovery_config() -> dict:
+        return {
+            'ids': [],                       # 直接选中的频道ID
+            'title_patterns': [],            # 标题正则（任一匹配）
+            'exclude_title_patterns': [],    # 标题正则，匹配则排除
+            'folders': [],                   # Telegram 文件夹标题，archived 表示归档
+            'include_groups': False,         # 规则匹配时是否包含超级群组（默认只选广播频道）
+            'has_media': False,              # 只选最新消息带文档的频道
+            'media_sample': 0,               # has_media 检查最近的消息条数，0 表示只看对话列表中的最新消息
+            'cache_path': os.getenv('TGDL_DIALOGS_CACHE', os.path.join(CONFIG_DIR, 'dialogs.json')),
+            'cache_ttl_seconds': 86400       # 对话列表缓存有效期
+        }
+
+    @staticmethod
+    def default_control_config() -> dict:
+        return {
+            'enabled': os.getenv('TGDL_CONTROL_ENABLED', '0').lower() in ('1', 'true', 'yes'),
+            'host': os.getenv('TGDL_CONTROL_HOST', '127.0.0.1'),    # 只监听本机；改为其他地址时务必设置 token
+            'port': int(os.getenv('TGDL_CONTROL_PORT', '9465')),
+            'token': ''                                               # 非空时要求 Authorization: Bearer <token>，也可用 TGDL_CONTROL_TOKEN
+        }
+
+    @staticmethod
+    def default_bandwidth_config() -> dict:
+        return {
+            'global_mbps': float(os.getenv('TGDL_BANDWIDTH_MBPS', '0')),                   # 全部下载的总限速（Mbps），0 表示不限
+            'channel_mbps': float(os.getenv('TGDL_BANDWIDTH_CHANNEL_MBPS', '0')),          # 单个频道的默认限速
+            'channels': {},                  # 按频道覆盖限速：{"频道ID": Mbps}
+            'schedule': [],                  # 按时间段覆盖：[{"start": "09:00", "end": "23:00", "days": [0-6 可选], "global_mbps": 20, "channel_mbps": 5}]
+            'burst_seconds': 1.0             # 令牌桶容量（秒的流量），越小越平滑
+        }
+
+    @staticmethod
+    def default_memory_config() -> dict:
+        return {
+            'budget_mb': int(os.getenv('TGDL_MEMORY_BUDGET_MB', '0')),   # 进程 RSS 预算（MB），超出时收缩缓存；0 表示不限制
+            'check_seconds': 60,                 # 检查预算与清理过期缓存条目的间隔
+            'shrink_fraction': 0.5,              # 超出预算时每个缓存淘汰的比例（最久未使用的条目）
+            'seen_ids_per_channel': 500,         # 每个频道记录的已见消息ID数
+            'progress_entries': 1000,            # 下载进度记录上限
+            'progress_ttl_seconds': 21600,       # 下载进度记录的过期时间
+            'heap_report_seconds': int(os.getenv('TGDL_HEAP_REPORT_SECONDS', '0')),   # 按间隔输出 tracemalloc 快照差异，0 表示只在收到 SIGUSR2 时输出
+            'heap_report_top': 15,
+            'tracemalloc_frames': 4
+        }
+
+    @staticmethod
+    def default_link_probe_config() -> dict:
+        return {
+            'enabled': os.getenv('TGDL_LINK_PROBE_ENABLED', '0').lower() in ('1', 'true', 'yes'),
+            'skip_dead': True,               # 失效链接不提交，视为已处理（推进进度、移出重试队列）
+            'timeout_seconds': 10,
+            'per_host_concurrency': 4,       # 每个主机同时进行的探测数
+            'max_connections': 32,           # 全部主机同时进行的探测数
+            'cache_ttl_seconds': 3600,       # alive/dead 结果的缓存时间；unknown 不缓存
+            'cache_entries': 10000,
+            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36',
+            'endpoint': '',                  # 把全部探测请求改发到该地址（协议+主机），用于本地替身服务；也可用 TGDL_LINK_PROBE_ENDPOINT
+            'endpoints': {},                 # 按提供方改写：{"quark": "http://127.0.0.1:8081"}
+            'rules': {}                      # 按提供方覆盖探测规则：{"baidupan": {"dead": ["..."]}}（method/url/json/alive/dead）
+        }
+
+    @staticmethod
+    def default_retry_queue_config() -> dict:
+        return {
+            'enabled': os.getenv('TGDL_RETRY_QUEUE_ENABLED', '1').lower() in ('1', 'true', 'yes'),
+            'path': os.getenv('TGDL_RETRY_QUEUE_DB', os.path.join(CONFIG_DIR, 'retry_queue.db')),
+            'concurrency': 0,        # 重试下载的总并发，0 表示使用 max_concurrent_downloads
+            'poll_seconds': 60,      # 重新读取队列的间隔（命令行重新入队的任务在此间隔内生效）
+            'claim_seconds': 300     # 多节点共享队列时认领任务的期限，执行期间按其三分之一续期
+        }
+
+    @staticmethod
+    def default_retention_config() -> dict:
+        return {
+            'enabled': os.getenv('TGDL_RETENTION_ENABLED', '0').lower() in ('1', 'true', 'yes'),
+            'dry_run': os.getenv('TGDL_RETENTION_DRY_RUN', '0').lower() in ('1', 'true', 'yes'),  # 只报告将被淘汰的文件，不删除
+            'index_path': os.getenv('TGDL_RETENTION_DB', os.path.join(CONFIG_DIR, 'retention.db')),
+            'max_age_days': 0,           # 完成超过该天数的文件被淘汰，0 表示不限
+            'max_total_gb': 0,           # 已完成文件总大小配额，0 表示不限
+            'per_channel_gb': 0,         # 单频道默认配额，0 表示不限
+            'channel_quotas_gb': {},     # 按频道覆盖配额：{"频道ID": GB}
+            'use_atime': True,           # 按最近访问淘汰时参考文件 atime（外部播放、读取也算访问）
+            'interval_seconds': 3600     # 按年龄与配额定期清理的间隔
+        }
+
+    @staticmethod
+    def default_storage_config() -> dict:
+        return {
+            'backend': os.getenv('TGDL_STORAGE_BACKEND', 'local'),   # local / s3
+            's3': {
+                'endpoint_url': os.getenv('TGDL_S3_ENDPOINT', ''),   # MinIO 等兼容服务地址，留空使用 AWS
+                'region': os.getenv('TGDL_S3_REGION', ''),
+                'bucket': os.getenv('TGDL_S3_BUCKET', ''),
+                'prefix': os.getenv('TGDL_S3_PREFIX', ''),
+                'access_key': '',                                     # 留空时使用 TGDL_S3_ACCESS_KEY 或 boto3 默认凭证链
+                'secret_key': '',
+                'part_size_mb': 8                                     # 分片大小，同时是单个下载的内存缓冲上限
+            },
+            'pack': {
+                'dir': os.getenv('TGDL_PACK_DIR', os.path.join(MEDIA_DIR, 'shards')),
+                'threshold_mb': 16,           # 不超过该大小的文件打包进分片，更大的文件照常放入 completed_dir
+                'shard_size_mb': 1024,        # 分片写满该大小后封装并开始新分片
+                'max_open_hours': 24,         # 分片打开超过该时长后，下次追加前先封装（便于备份只同步已封装分片）
+                'index_path': os.path.join(CONFIG_DIR, 'packs.db')
+            }
+        }
+
+    @staticmethod
+    def default_backfill_config() -> dict:
+        return {
+            'enabled': os.getenv('TGDL_BACKFILL_ENABLED', '0').lower() in ('1', 'true', 'yes'),
+            'page_size': 100,        # 每页历史消息数（Telegram 单次上限 100）
+            'concurrency': 1,        # 全部频道回溯下载的总并发
+            'use_takeout': False     # 使用 takeout 会话拉取历史，享受更宽松的批量导出限额
+        }
+
+    @staticmethod
+    def default_adaptive_concurrency_config() -> dict:
+        return {
+            'enabled': os.getenv('TGDL_ADAPTIVE_CONCURRENCY', '0').lower() in ('1', 'true', 'yes'),
+            'min_concurrency': 1,
+            'max_concurrency': 16,
+            'initial_concurrency': 0,        # 0 表示使用 max_concurrent_downloads
+            'interval_seconds': 10,          # 吞吐采样周期
+            'increase_step': 1,              # 加性增加步长
+            'decrease_factor': 0.5,          # 乘性减少系数
+            'improve_threshold': 0.05,       # 吞吐提升超过该比例才继续增加
+            'regression_threshold': 0.2      # 吞吐下降超过该比例视为退化
+        }
+
+    @staticmethod
+    def default_coordination_config() -> dict:
+        return {
+            'enabled': os.getenv('TGDL_COORDINATION_ENABLED', '0').lower() in ('1', 'true', 'yes'),
+            'backend': os.getenv('TGDL_LEASE_BACKEND', 'sqlite'),
+            'sqlite_path': os.getenv('TGDL_LEASE_DB', os.path.join(CONFIG_DIR, 'leases.db')),
+            'lease_ttl_seconds': int(os.getenv('TGDL_LEASE_TTL_SECONDS', '60')),
+            'heartbeat_seconds': int(os.getenv('TGDL_LEASE_HEARTBEAT_SECONDS', '20')),
+            'worker_id': os.getenv('TGDL_WORKER_ID', '')
+        }
+
+    @staticmethod
+    def default_rate_limit_config() -> dict:
+        return {
+            'enabled': os.getenv('TGDL_RATE_LIMIT_ENABLED', '1').lower() in ('1', 'true', 'yes'),
+            'flood_sleep_threshold': int(os.getenv('TGDL_FLOOD_SLEEP_THRESHOLD', '0')),
+            'methods': {
+                'history': {'rate': 2.0, 'burst': 5},    # iter_messages / get_messages
+                'entity': {'rate': 1.0, 'burst': 5},     # get_entity
+                'send': {'rate': 0.5, 'burst': 2},       # send_message（机器人交互）
+                'download': {'rate': 4.0, 'burst': 8},   # download_media
+                'request': {'rate': 1.0, 'burst': 3},    # 其他原始请求（如 GetDialogsRequest）
+            }
+        }
+
     @staticmethod
     def _create_initial_config() -> dict:
         print("[首次配置] 请填写以下信息：")
@@ -169,7 +453,11 @@ class ConfigManager:
                 'enabled': input("是否启用音频质量检查(yes/no): ").lower() == 'yes',
                 'check_type': input("质量检查方式(size/duration/both): ") if input("是否启用音频质量检查(yes/no): ").lower() == 'yes' else 'size',
                 'min_size_mb': float(input("最小文件大小(MB): ")) if input("是否启用音频质量检查(yes/no): ").lower() == 'yes' else 1,
-                'min_duration_seconds': float(input("最小音频时长(秒): ")) if input("是否启用音频质量检查(yes/no): ").lower() == 'yes' else 0
+                'min_duration_seconds': float(input("最小音频时长(秒): ")) if input("是否启用音频质量检查(yes/no): ").lower() == 'yes' else 0,
+                'probe_enabled': False,
+                'probe_head_kb': 256,
+                'probe_tail_kb': 128,
+                'min_bitrate_kbps': 0
             },
             'download_settings': {
                 'max_file_size_mb': int(os.getenv('TGDL_MAX_FILE_SIZE_MB', '500')),
@@ -184,7 +472,9 @@ class ConfigManager:
                 'exclude_patterns': os.getenv('TGDL_EXCLUDE_PATTERNS', '').split(',') if os.getenv('TGDL_EXCLUDE_PATTERNS') else [],
                 'downloading_dir': os.getenv('TGDL_DOWNLOADING_DIR', os.path.join(MEDIA_DIR, 'downloading')),
                 'completed_dir': os.getenv('TGDL_COMPLETED_DIR', os.path.join(MEDIA_DIR, 'completed')),
-                'min_disk_space_mb': int(os.getenv('TGDL_MIN_DISK_SPACE_MB', '500'))
+                'min_disk_space_mb': int(os.getenv('TGDL_MIN_DISK_SPACE_MB', '500')),
+                'cpu_workers': int(os.getenv('TGDL_CPU_WORKERS', '0')),
+                'cpu_batch_size': int(os.getenv('TGDL_CPU_BATCH_SIZE', '256'))
             },
             'language_filter': {
                 'enabled': input("是否启用语言过滤(yes/no): ").lower() == 'yes',
@@ -200,6 +490,21 @@ class ConfigManager:
                 'start_reply_wait_seconds': int(os.getenv('TGDL_START_REPLY_WAIT_SECONDS', '3')),
                 'start_reply_limit': int(os.getenv('TGDL_START_REPLY_LIMIT', '5'))
             },
+            'rate_limit': ConfigManager.default_rate_limit_config(),
+            'accounts': [],
+            'coordination': ConfigManager.default_coordination_config(),
+            'adaptive_concurrency': ConfigManager.default_adaptive_concurrency_config(),
+            'backfill': ConfigManager.default_backfill_config(),
+            'storage': ConfigManager.default_storage_config(),
+            'metrics': ConfigManager.default_metrics_config(),
+            'tracing': ConfigManager.default_tracing_config(),
+            'retention': ConfigManager.default_retention_config(),
+            'retry_queue': ConfigManager.default_retry_queue_config(),
+            'channel_discovery': ConfigManager.default_channel_discovery_config(),
+            'bandwidth': ConfigManager.default_bandwidth_config(),
+            'control': ConfigManager.default_control_config(),
+            'memory': ConfigManager.default_memory_config(),
+            'link_probe': ConfigManager.default_link_probe_config(),
         }
         logger.info('创建新的配置文件')
         ConfigManager.save_config(config)
@@ -208,6 +513,7 @@ class ConfigManager:
     @staticmethod
     def save_config(config: dict) -> None:
         logger.debug('保存配置文件')
+        os.makedirs(CONFIG_DIR, exist_ok=True)
         with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
             json.dump(config, f, indent=2, ensure_ascii=False)
 
@@ -290,11 +596,316 @@ class ConfigManager:
             'exclude_patterns': patterns,
             'downloading_dir': os.getenv('TGDL_DOWNLOADING_DIR', download_settings.get('downloading_dir', os.path.join(MEDIA_DIR, 'downloading'))),
             'completed_dir': os.getenv('TGDL_COMPLETED_DIR', download_settings.get('completed_dir', os.path.join(MEDIA_DIR, 'completed'))),
-            'min_disk_space_mb': int(os.getenv('TGDL_MIN_DISK_SPACE_MB', str(download_settings.get('min_disk_space_mb', 500))))
+            'min_disk_space_mb': int(os.getenv('TGDL_MIN_DISK_SPACE_MB', str(download_settings.get('min_disk_space_mb', 500)))),
+            'cpu_workers': int(os.getenv('TGDL_CPU_WORKERS', str(download_settings.get('cpu_workers', 0)))),
+            'cpu_batch_size': int(os.getenv('TGDL_CPU_BATCH_SIZE', str(download_settings.get('cpu_batch_size', 256))))
+        }
+
+    @staticmethod
+    def get_rate_limit_settings(config: dict) -> dict:
+        """获取 API 限流设置，环境变量优先，其次配置文件，最后默认值"""
+        defaults = ConfigManager.default_rate_limit_config()
+        rate_limit = config.get('rate_limit', {})
+        methods = dict(defaults['methods'])
+        for name, spec in (rate_limit.get('methods') or {}).items():
+            methods[name] = {**methods.get(name, {'rate': 1.0, 'burst': 1}), **(spec or {})}
+        enabled_env = os.getenv('TGDL_RATE_LIMIT_ENABLED', None)
+        return {
+            'enabled': enabled_env.lower() in ('1', 'true', 'yes') if enabled_env is not None else bool(rate_limit.get('enabled', True)),
+            'flood_sleep_threshold': int(os.getenv('TGDL_FLOOD_SLEEP_THRESHOLD', str(rate_limit.get('flood_sleep_threshold', 0)))),
+            'methods': methods
+        }
+
+    @staticmethod
+    def get_accounts(config: dict) -> list:
+        """返回全部账号配置，主账号在前；额外账号未填写 api_id/api_hash/proxy 时沿用主账号"""
+        accounts = [{
+            'phone_number': config['phone_number'],
+            'api_id': config['api_id'],
+            'api_hash': config['api_hash'],
+            'proxy': config.get('proxy', {})
+        }]
+        seen = {str(config['phone_number'])}
+        for acc in config.get('accounts', []) or []:
+            phone = str(acc.get('phone_number') or '')
+            if not phone or phone in seen:
+                continue
+            seen.add(phone)
+            accounts.append({
+                'phone_number': phone,
+                'api_id': acc.get('api_id', config['api_id']),
+                'api_hash': acc.get('api_hash', config['api_hash']),
+                'proxy': acc.get('proxy', config.get('proxy', {}))
+            })
+        return accounts
+
+    @staticmethod
+    def effective_runtime_config(config: dict) -> dict:
+        """汇总各项设置解析后的有效值（敏感字段脱敏），供启动日志与 --print-config 使用，不连接 Telegram"""
+        def mask(phone) -> str:
+            return re.sub(r'(\d{3})\d+(\d{2})', r'\1***\2', str(phone))
+        storage = ConfigManager.get_storage_settings(config)
+        control = ConfigManager.get_control_settings(config)
+        return {
+            'api_id': config.get('api_id'),
+            'api_hash': config.get('api_hash'),
+            'phone_number': mask(config.get('phone_number', '')),
+            'media_types': config.get('media_types'),
+            'audio_quality_check': config.get('audio_quality_check'),
+            'language_filter': config.get('language_filter'),
+            'selected_channels': config.get('selected_channels', []),
+            'download_settings': ConfigManager.get_download_settings(config),
+            'rate_limit': ConfigManager.get_rate_limit_settings(config),
+            'adaptive_concurrency': ConfigManager.get_adaptive_concurrency_settings(config),
+            'backfill': ConfigManager.get_backfill_settings(config),
+            'storage': {'backend': storage['backend'], 'bucket': storage['s3']['bucket'], 'pack': storage['pack']},
+            'tracing': ConfigManager.get_tracing_settings(config),
+            'retention': ConfigManager.get_retention_settings(config),
+            'retry_queue': ConfigManager.get_retry_queue_settings(config),
+            'channel_discovery': ConfigManager.get_channel_discovery_settings(config),
+            'bandwidth': ConfigManager.get_bandwidth_settings(config),
+            'control': {**control, 'token': '***' if control['token'] else ''},
+            'memory': ConfigManager.get_memory_settings(config),
+            'link_probe': ConfigManager.get_link_probe_settings(config),
+            'accounts': [mask(a['phone_number']) for a in ConfigManager.get_accounts(config)] if 'phone_number' in config else [],
+        }
+
+    @staticmethod
+    def get_coordination_settings(config: dict) -> dict:
+        """获取多节点协调设置，环境变量优先，其次配置文件，最后默认值"""
+        coordination = config.get('coordination', {})
+        enabled_env = os.getenv('TGDL_COORDINATION_ENABLED', None)
+        worker_id = os.getenv('TGDL_WORKER_ID', coordination.get('worker_id', '')) or f'{socket.gethostname()}-{os.getpid()}'
+        return {
+            'enabled': enabled_env.lower() in ('1', 'true', 'yes') if enabled_env is not None else bool(coordination.get('enabled', False)),
+            'backend': os.getenv('TGDL_LEASE_BACKEND', coordination.get('backend', 'sqlite')),
+            'sqlite_path': os.getenv('TGDL_LEASE_DB', coordination.get('sqlite_path', os.path.join(CONFIG_DIR, 'leases.db'))),
+            'lease_ttl_seconds': int(os.getenv('TGDL_LEASE_TTL_SECONDS', str(coordination.get('lease_ttl_seconds', 60)))),
+            'heartbeat_seconds': int(os.getenv('TGDL_LEASE_HEARTBEAT_SECONDS', str(coordination.get('heartbeat_seconds', 20)))),
+            'worker_id': worker_id
         }
 
+    @staticmethod
+    def get_adaptive_concurrency_settings(config: dict) -> dict:
+        """获取自适应并发设置，环境变量优先，其次配置文件，最后默认值"""
+        settings = {**ConfigManager.default_adaptive_concurrency_config(), **config.get('adaptive_concurrency', {})}
+        enabled_env = os.getenv('TGDL_ADAPTIVE_CONCURRENCY', None)
+        if enabled_env is not None:
+            settings['enabled'] = enabled_env.lower() in ('1', 'true', 'yes')
+        settings['min_concurrency'] = max(int(os.getenv('TGDL_MIN_CONCURRENCY', str(settings['min_concurrency']))), 1)
+        settings['max_concurrency'] = max(int(os.getenv('TGDL_MAX_CONCURRENCY', str(settings['max_concurrency']))), settings['min_concurrency'])
+        return settings
+
+    @staticmethod
+    def get_backfill_settings(config: dict) -> dict:
+        """获取历史回溯设置，环境变量优先，其次配置文件，最后默认值"""
+        settings = {**ConfigManager.default_backfill_config(), **config.get('backfill', {})}
+        enabled_env = os.getenv('TGDL_BACKFILL_ENABLED', None)
+        if enabled_env is not None:
+            settings['enabled'] = enabled_env.lower() in ('1', 'true', 'yes')
+        settings['page_size'] = min(max(int(settings['page_size']), 1), 100)
+        settings['concurrency'] = max(int(os.getenv('TGDL_BACKFILL_CONCURRENCY', str(settings['concurrency']))), 1)
+        return settings
+
+    @staticmethod
+    def get_storage_settings(config: dict) -> dict:
+        """获取下载落地存储设置，环境变量优先，其次配置文件，最后默认值"""
+        storage = config.get('storage', {})
+        s3 = {**ConfigManager.default_storage_config()['s3'], **storage.get('s3', {})}
+        for key, env in (('endpoint_url', 'TGDL_S3_ENDPOINT'), ('region', 'TGDL_S3_REGION'), ('bucket', 'TGDL_S3_BUCKET'),
+                         ('prefix', 'TGDL_S3_PREFIX'), ('access_key', 'TGDL_S3_ACCESS_KEY'), ('secret_key', 'TGDL_S3_SECRET_KEY')):
+            if os.getenv(env):
+                s3[key] = os.getenv(env)
+        # S3 要求除最后一个分片外每片至少 5MB
+        s3['part_size_mb'] = max(int(os.getenv('TGDL_S3_PART_SIZE_MB', str(s3['part_size_mb']))), 5)
+        pack = {**ConfigManager.default_storage_config()['pack'], **storage.get('pack', {})}
+        pack['dir'] = os.getenv('TGDL_PACK_DIR', pack['dir'])
+        pack['threshold_mb'] = float(os.getenv('TGDL_PACK_THRESHOLD_MB', str(pack['threshold_mb'])))
+        pack['shard_size_mb'] = max(float(os.getenv('TGDL_PACK_SHARD_MB', str(pack['shard_size_mb']))), 1)
+        pack['max_open_hours'] = float(pack['max_open_hours'])
+        return {'backend': os.getenv('TGDL_STORAGE_BACKEND', storage.get('backend', 'local')), 's3': s3, 'pack': pack}
+
+    @staticmethod
+    def get_control_settings(config: dict) -> dict:
+        """获取控制接口设置，环境变量优先，其次配置文件，最后默认值"""
+        settings = {**ConfigManager.default_control_config(), **config.get('control', {})}
+        enabled_env = os.getenv('TGDL_CONTROL_ENABLED', None)
+        if enabled_env is not None:
+            settings['enabled'] = enabled_env.lower() in ('1', 'true', 'yes')
+        settings['host'] = os.getenv('TGDL_CONTROL_HOST', settings['host'])
+        settings['port'] = int(os.getenv('TGDL_CONTROL_PORT', str(settings['port'])))
+        settings['token'] = os.getenv('TGDL_CONTROL_TOKEN', settings['token'] or '')
+        return settings
+
+    @staticmethod
+    def get_bandwidth_settings(config: dict) -> dict:
+        """获取下载带宽限制，环境变量优先，其次配置文件，最后默认值"""
+        settings = {**ConfigManager.default_bandwidth_config(), **config.get('bandwidth', {})}
+        for key, env in (('global_mbps', 'TGDL_BANDWIDTH_MBPS'), ('channel_mbps', 'TGDL_BANDWIDTH_CHANNEL_MBPS')):
+            settings[key] = max(float(os.getenv(env, str(settings[key]))), 0.0)
+        settings['channels'] = {str(k): float(v) for k, v in (settings['channels'] or {}).items()}
+        settings['schedule'] = list(settings['schedule'] or [])
+        settings['burst_seconds'] = max(float(settings['burst_seconds']), 0.1)
+        return settings
+
+    @staticmethod
+    def get_memory_settings(config: dict) -> dict:
+        """获取内存预算与堆报告设置，环境变量优先，其次配置文件，最后默认值"""
+        settings = {**ConfigManager.default_memory_config(), **config.get('memory', {})}
+        for key, env in (('budget_mb', 'TGDL_MEMORY_BUDGET_MB'), ('heap_report_seconds', 'TGDL_HEAP_REPORT_SECONDS')):
+            settings[key] = max(int(os.getenv(env, str(settings[key]))), 0)
+        for key in ('check_seconds', 'seen_ids_per_channel', 'progress_entries', 'progress_ttl_seconds', 'heap_report_top', 'tracemalloc_frames'):
+            settings[key] = max(int(settings[key]), 1)
+        settings['shrink_fraction'] = min(max(float(settings['shrink_fraction']), 0.0), 1.0)
+        return settings
+
+    @staticmethod
+    def get_link_probe_settings(config: dict) -> dict:
+        """获取云盘链接探测设置，环境变量优先，其次配置文件，最后默认值"""
+        settings = {**ConfigManager.default_link_probe_config(), **config.get('link_probe', {})}
+        enabled_env = os.getenv('TGDL_LINK_PROBE_ENABLED', None)
+        if enabled_env is not None:
+            settings['enabled'] = enabled_env.lower() in ('1', 'true', 'yes')
+        settings['endpoint'] = os.getenv('TGDL_LINK_PROBE_ENDPOINT', settings['endpoint'] or '')
+        settings['timeout_seconds'] = max(float(settings['timeout_seconds']), 0.1)
+        for key in ('per_host_concurrency', 'max_connections', 'cache_entries'):
+            settings[key] = max(int(settings[key]), 1)
+        settings['cache_ttl_seconds'] = max(float(settings['cache_ttl_seconds']), 0)
+        settings['endpoints'] = dict(settings['endpoints'] or {})
+        settings['rules'] = dict(settings['rules'] or {})
+        return settings
+
+    @staticmethod
+    def get_channel_discovery_settings(config: dict) -> dict:
+        """获取频道发现与选择规则，环境变量优先，其次配置文件，最后默认值"""
+        settings = {**ConfigManager.default_channel_discovery_config(), **config.get('channel_discovery', {})}
+        for key, env in (('ids', 'TGDL_CHANNEL_IDS'), ('title_patterns', 'TGDL_CHANNEL_TITLE_PATTERNS'), ('folders', 'TGDL_CHANNEL_FOLDERS')):
+            if os.getenv(env):
+                settings[key] = os.getenv(env).split(',')
+        for key in ('ids', 'title_patterns', 'exclude_title_patterns', 'folders'):
+            settings[key] = [str(v).strip() for v in settings[key] or [] if str(v).strip()]
+        if os.getenv('TGDL_CHANNEL_HAS_MEDIA') is not None:
+            settings['has_media'] = os.getenv('TGDL_CHANNEL_HAS_MEDIA').lower() in ('1', 'true', 'yes')
+        settings['cache_path'] = os.getenv('TGDL_DIALOGS_CACHE', settings['cache_path'])
+        # 抽样只发一次 GetHistory 请求（限流按请求取令牌），最多一页
+        settings['media_sample'] = min(max(int(settings['media_sample']), 0), ApiRateLimiter.PAGE_SIZE)
+        return settings
+
+    @staticmethod
+    def get_retry_queue_settings(config: dict) -> dict:
+        """获取重试队列设置，环境变量优先，其次配置文件，最后默认值"""
+        settings = {**ConfigManager.default_retry_queue_config(), **config.get('retry_queue', {})}
+        enabled_env = os.getenv('TGDL_RETRY_QUEUE_ENABLED', None)
+        if enabled_env is not None:
+            settings['enabled'] = enabled_env.lower() in ('1', 'true', 'yes')
+        settings['path'] = os.getenv('TGDL_RETRY_QUEUE_DB', settings['path'])
+        settings['concurrency'] = max(int(settings['concurrency']), 0)
+        settings['poll_seconds'] = max(int(settings['poll_seconds']), 1)
+        settings['claim_seconds'] = max(float(settings['claim_seconds']), 3.0)
+        return settings
+
+    @staticmethod
+    def get_retention_settings(config: dict) -> dict:
+        """获取磁盘保留策略设置，环境变量优先，其次配置文件，最后默认值"""
+        settings = {**ConfigManager.default_retention_config(), **config.get('retention', {})}
+        for key, env in (('enabled', 'TGDL_RETENTION_ENABLED'), ('dry_run', 'TGDL_RETENTION_DRY_RUN')):
+            if os.getenv(env) is not None:
+                settings[key] = os.getenv(env).lower() in ('1', 'true', 'yes')
+        settings['index_path'] = os.getenv('TGDL_RETENTION_DB', settings['index_path'])
+        for key, env in (('max_age_days', 'TGDL_RETENTION_MAX_AGE_DAYS'), ('max_total_gb', 'TGDL_RETENTION_MAX_TOTAL_GB'),
+                         ('per_channel_gb', 'TGDL_RETENTION_PER_CHANNEL_GB')):
+            settings[key] = max(float(os.getenv(env, str(settings[key]))), 0.0)
+        settings['channel_quotas_gb'] = {str(k): float(v) for k, v in (settings.get('channel_quotas_gb') or {}).items()}
+        settings['interval_seconds'] = max(int(settings['interval_seconds']), 60)
+        return settings
+
+    @staticmethod
+    def get_metrics_settings(config: dict) -> dict:
+        """获取指标端点设置，环境变量优先，其次配置文件，最后默认值"""
+        settings = {**ConfigManager.default_metrics_config(), **config.get('metrics', {})}
+        enabled_env = os.getenv('TGDL_METRICS_ENABLED', None)
+        if enabled_env is not None:
+            settings['enabled'] = enabled_env.lower() in ('1', 'true', 'yes')
+        settings['host'] = os.getenv('TGDL_METRICS_HOST', settings['host'])
+        settings['port'] = int(os.getenv('TGDL_METRICS_PORT', str(settings['port'])))
+        return settings
+
+    @staticmethod
+    def get_tracing_settings(config: dict) -> dict:
+        """获取逐消息追踪设置，环境变量优先，其次配置文件，最后默认值"""
+        settings = {**ConfigManager.default_tracing_config(), **config.get('tracing', {})}
+        for key, env in (('enabled', 'TGDL_TRACING_ENABLED'), ('include_skipped', 'TGDL_TRACE_INCLUDE_SKIPPED')):
+            if os.getenv(env) is not None:
+                settings[key] = os.getenv(env).lower() in ('1', 'true', 'yes')
+        settings['path'] = os.getenv('TGDL_TRACE_FILE', settings['path'])
+        settings['format'] = os.getenv('TGDL_TRACE_FORMAT', settings['format'])
+        settings['sample_rate'] = min(max(float(os.getenv('TGDL_TRACE_SAMPLE_RATE', str(settings['sample_rate']))), 0.0), 1.0)
+        return settings
+
+class FileLock:
+    """跨进程的排他文件锁（POSIX 用 flock，Windows 用 msvcrt.locking），锁在单独的 .lock 文件上
+
+    同一进程内用不同的 FileLock 实例锁同一路径同样互斥。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.fd: int | None = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """获取锁；blocking 为 False 且锁已被占用时返回 False"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                while True:
+                    try:
+                        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not blocking:
+                            raise
+                        time.sleep(0.05)
+            else:
+                import fcntl
+                fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            os.close(fd)
+            if blocking:
+                raise
+            return False
+        self.fd = fd
+        return True
+
+    def release(self) -> None:
+        if self.fd is None:
+            return
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self) -> 'FileLock':
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
 class StateManager:
-    """用于持久化每个频道的 last_id，避免重复处理已处理消息"""
+    """用于持久化每个频道的 last_id，避免重复处理已处理消息
+
+    多个节点可共享同一状态文件：每次修改都在 state.json.lock 的跨进程锁内完成"读取-修改-写回"，
+    写回时使用同目录下唯一的临时文件再原子替换，不会覆盖其他节点刚写入的频道进度。
+    等锁与读写共享卷都会阻塞，协程中经 asyncio.to_thread 调用，避免其他节点持锁时拖住整个事件循环。
+    """
     STATE_FILE = os.path.join(CONFIG_DIR, 'state.json')
 
     @staticmethod
@@ -302,8 +913,10 @@ class StateManager:
         os.makedirs(CONFIG_DIR, exist_ok=True)
         if not os.path.exists(StateManager.STATE_FILE):
             try:
-                with open(StateManager.STATE_FILE, 'w', encoding='utf-8') as f:
+                with open(StateManager.STATE_FILE, 'x', encoding='utf-8') as f:
                     json.dump({'channels': {}}, f, ensure_ascii=False, indent=2)
+            except FileExistsError:
+                pass
             except Exception as e:
                 logger.error(f'创建状态文件失败: {e}')
 
@@ -317,6 +930,15 @@ class StateManager:
             logger.error(f'读取状态文件失败，使用空状态: {e}')
             return {'channels': {}}
 
+    @staticmethod
+    @contextmanager
+    def _update():
+        """持有跨进程锁读取状态，with 块内修改后写回"""
+        with FileLock(StateManager.STATE_FILE + '.lock'):
+            state = StateManager.load_state()
+            yield state
+            StateManager._write_state(state)
+
     @staticmethod
     def get_last_id(channel_id: int) -> int:
         state = StateManager.load_state()
@@ -326,17 +948,454 @@ class StateManager:
             return 0
 
     @staticmethod
-    def set_last_id(channel_id: int, last_id: int) -> None:
-        StateManager._ensure_state_file()
+    def get_backfill(channel_id: int) -> dict:
+        """历史回溯检查点：offset_id 为已处理到的最旧消息ID，done 表示已回溯到频道开头"""
         state = StateManager.load_state()
-        channels = state.setdefault('channels', {})
-        ch = channels.setdefault(str(channel_id), {})
-        ch['last_id'] = int(last_id)
+        backfill = state.get('channels', {}).get(str(channel_id), {}).get('backfill', {})
+        return {'offset_id': int(backfill.get('offset_id', 0) or 0), 'done': bool(backfill.get('done', False))}
+
+    @staticmethod
+    def set_backfill(channel_id: int, offset_id: int, done: bool = False) -> None:
+        with StateManager._update() as state:
+            ch = state.setdefault('channels', {}).setdefault(str(channel_id), {})
+            ch['backfill'] = {'offset_id': int(offset_id), 'done': done}
+
+    @staticmethod
+    def get_upload(key: str) -> dict | None:
+        """对象存储中未完成的分片上传：upload_id、文件大小与已上传分片 [[编号, ETag, 字节数], ...]"""
+        return StateManager.load_state().get('uploads', {}).get(key)
+
+    @staticmethod
+    def set_upload(key: str, upload: dict | None) -> None:
+        with StateManager._update() as state:
+            uploads = state.setdefault('uploads', {})
+            if upload is None:
+                uploads.pop(key, None)
+            else:
+                uploads[key] = upload
+
+    @staticmethod
+    def _write_state(state: dict) -> None:
+        """写入同目录下唯一命名的临时文件后原子替换，调用方需持有状态锁"""
+        state_dir = os.path.dirname(os.path.abspath(StateManager.STATE_FILE))
+        tmp_file = None
         try:
-            with open(StateManager.STATE_FILE, 'w', encoding='utf-8') as f:
+            fd, tmp_file = tempfile.mkstemp(prefix='state.', suffix='.tmp', dir=state_dir)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
                 json.dump(state, f, ensure_ascii=False, indent=2)
+            # mkstemp 创建的文件仅属主可读，共享卷上的其他节点可能以不同用户运行
+            os.chmod(tmp_file, 0o644)
+            os.replace(tmp_file, StateManager.STATE_FILE)
         except Exception as e:
             logger.error(f'写入状态文件失败: {e}')
+            if tmp_file and os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+
+    @staticmethod
+    def set_last_id(channel_id: int, last_id: int) -> None:
+        """只前进不回退；在状态锁内基于最新内容修改，多账号、多节点共享同一状态文件时保持一致"""
+        with StateManager._update() as state:
+            ch = state.setdefault('channels', {}).setdefault(str(channel_id), {})
+            ch['last_id'] = max(int(ch.get('last_id', 0) or 0), int(last_id))
+
+class LeaseBackend:
+    """频道租约存储后端接口，多个节点通过同一存储竞争频道的处理权"""
+    def heartbeat(self, worker_id: str, now: float) -> None:
+        raise NotImplementedError
+
+    def active_workers(self, since: float) -> int:
+        raise NotImplementedError
+
+    def acquire(self, channel: str, worker_id: str, now: float, ttl: float) -> bool:
+        """租约空闲、已过期或本就属于 worker_id 时获取（续租）成功"""
+        raise NotImplementedError
+
+    def release(self, channel: str, worker_id: str) -> None:
+        raise NotImplementedError
+
+class SQLiteLeaseBackend(LeaseBackend):
+    """基于 SQLite 文件的租约存储，可放在多个容器共享的数据卷上"""
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS leases (channel TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, last_seen REAL NOT NULL)')
+
+    @contextmanager
+    def _connect(self):
+        # 共享卷上不使用 WAL，保持默认回滚日志；每次调用独立连接，便于在线程中执行
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level='IMMEDIATE')
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def heartbeat(self, worker_id: str, now: float) -> None:
+        with self._connect() as conn:
+            conn.execute('INSERT INTO workers (worker_id, last_seen) VALUES (?, ?) '
+                         'ON CONFLICT(worker_id) DO UPDATE SET last_seen = excluded.last_seen', (worker_id, now))
+
+    def active_workers(self, since: float) -> int:
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM workers WHERE last_seen >= ?', (since,)).fetchone()[0]
+
+    def acquire(self, channel: str, worker_id: str, now: float, ttl: float) -> bool:
+        with self._connect() as conn:
+            cur = conn.execute('INSERT INTO leases (channel, owner, expires_at) VALUES (?, ?, ?) '
+                               'ON CONFLICT(channel) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at '
+                               'WHERE leases.owner = excluded.owner OR leases.expires_at < ?',
+                               (channel, worker_id, now + ttl, now))
+            return cur.rowcount == 1
+
+    def release(self, channel: str, worker_id: str) -> None:
+        with self._connect() as conn:
+            conn.execute('DELETE FROM leases WHERE channel = ? AND owner = ?', (channel, worker_id))
+
+class LeaseCoordinator:
+    """多节点频道分片：每个节点按心跳续租已持有的频道，接管过期租约，并按活跃节点数均分频道"""
+    BACKENDS = {
+        'sqlite': lambda settings: SQLiteLeaseBackend(settings['sqlite_path']),
+    }
+
+    def __init__(self, settings: dict):
+        backend = settings.get('backend', 'sqlite')
+        if backend not in LeaseCoordinator.BACKENDS:
+            raise ValueError(f'不支持的租约后端: {backend}')
+        self.backend = LeaseCoordinator.BACKENDS[backend](settings)
+        self.worker_id = settings['worker_id']
+        self.ttl = settings['lease_ttl_seconds']
+        self.heartbeat_seconds = settings['heartbeat_seconds']
+        self.held: list[str] = []
+
+    def _sync_blocking(self, channels: list) -> list:
+        now = time.time()
+        self.backend.heartbeat(self.worker_id, now)
+        workers = max(self.backend.active_workers(now - self.ttl), 1)
+        share = math.ceil(len(channels) / workers)
+
+        # 续租已持有的频道，续租失败说明租约已被其他节点接管
+        held = []
+        for ch in self.held:
+            if ch in channels and self.backend.acquire(ch, self.worker_id, now, self.ttl):
+                held.append(ch)
+            else:
+                logger.warning(f'节点 {self.worker_id} 失去频道 {ch} 的租约')
+        # 新节点加入后释放超出均分份额的频道
+        while len(held) > share:
+            ch = held.pop()
+            self.backend.release(ch, self.worker_id)
+            logger.info(f'节点 {self.worker_id} 释放频道 {ch} 的租约（均分份额 {share}）')
+        for ch in channels:
+            if len(held) >= share:
+                break
+            if ch not in held and self.backend.acquire(ch, self.worker_id, now, self.ttl):
+                held.append(ch)
+                logger.info(f'节点 {self.worker_id} 获得频道 {ch} 的租约')
+        self.held = held
+        return list(held)
+
+    async def sync(self, channels: list) -> list:
+        """续租、均衡并获取租约，返回当前持有的频道列表"""
+        return await asyncio.to_thread(self._sync_blocking, [str(c) for c in channels])
+
+    async def release_all(self) -> None:
+        def _release():
+            for ch in self.held:
+                self.backend.release(ch, self.worker_id)
+            self.held = []
+        await asyncio.to_thread(_release)
+
+class RetryQueue:
+    """单个下载与链接任务的持久化重试队列（SQLite）与死信存储
+
+    失败的任务记录尝试次数、错误分类与下次可执行时间（带抖动的指数退避，沿用
+    initial_retry_delay / max_retry_delay）；调度器按最小堆在到期时重新送入下载流程。
+    超过 max_retries（0 表示不限）或属于不可重试的错误时移入死信，可通过命令行列出与重新入队。
+
+    多节点共享同一数据库时传入 owner（节点ID）：执行前原子地认领到期任务（owner / owner_expires 列），
+    同一任务只由一个节点重试；执行期间续期，节点宕机后认领过期，其他节点接手。
+    """
+    # 不可重试的错误分类，直接移入死信
+    PERMANENT = ('permanent',)
+
+    def __init__(self, settings: dict, download_settings: dict, owner: str | None = None):
+        self.path = settings['path']
+        self.poll_seconds = settings['poll_seconds']
+        self.owner = owner
+        self.claim_seconds = settings.get('claim_seconds', 300)
+        self.initial_delay = download_settings['initial_retry_delay']
+        self.max_delay = download_settings['max_retry_delay']
+        self.max_retries = download_settings['max_retries']
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, kind TEXT NOT NULL, channel_id INTEGER, message_id INTEGER, '
+                         'channel_title TEXT, payload TEXT NOT NULL, attempts INTEGER NOT NULL, next_at REAL NOT NULL, error_class TEXT, '
+                         'last_error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL, dead INTEGER NOT NULL DEFAULT 0, '
+                         'owner TEXT, owner_expires REAL NOT NULL DEFAULT 0)')
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(jobs)')}
+            if 'owner' not in columns:
+                # 早期版本创建的数据库没有认领列
+                conn.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+                conn.execute('ALTER TABLE jobs ADD COLUMN owner_expires REAL NOT NULL DEFAULT 0')
+        # 最小堆 (下次执行时间, key)；next_at 记录每个待执行任务的最新时间，堆中过期的条目出堆时丢弃
+        self.heap: list[tuple] = []
+        self.next_at: dict[str, float] = {}
+        self.running: set[str] = set()
+        self.dispatched: set[asyncio.Task] = set()
+        self.wakeup = asyncio.Event()
+
+    @contextmanager
+    def _connect(self):
+        # 每次调用独立连接，便于在线程中执行，也允许命令行与运行中的进程同时访问
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def media_key(task: 'MediaTask') -> str:
+        return f'media:{task.channel_id}:{task.message_id}'
+
+    @staticmethod
+    def link_key(task: dict) -> str:
+        return 'link:' + hashlib.sha1(task.get('full_url', task.get('url', '')).encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def classify(e: BaseException) -> str:
+        """错误分类：permanent 不重试，其余按退避重试"""
+        if isinstance(e, tg_errors.FloodWaitError):
+            return 'flood_wait'
+        if isinstance(e, tg_errors.FileReferenceExpiredError):
+            return 'file_reference'
+        if isinstance(e, requests.HTTPError):
+            status = e.response.status_code if e.response is not None else 0
+            return 'server' if status == 429 or status >= 500 else 'permanent'
+        if isinstance(e, (ConnectionError, TimeoutError, asyncio.TimeoutError, requests.ConnectionError, requests.Timeout)):
+            return 'network'
+        if isinstance(e, tg_errors.ServerError):
+            return 'server'
+        if isinstance(e, (tg_errors.BadRequestError, tg_errors.ForbiddenError, tg_errors.UnauthorizedError)):
+            return 'permanent'
+        if isinstance(e, OSError):
+            return 'disk_space' if e.errno == errno.ENOSPC else 'io'
+        return 'unknown'
+
+    def backoff(self, attempts: int) -> float:
+        """第 attempts 次失败后的等待秒数：指数增长到 max_retry_delay，在后一半区间内随机抖动"""
+        base = min(self.initial_delay * 2 ** min(attempts - 1, 32), self.max_delay)
+        return base / 2 + random.uniform(0, base / 2)
+
+    def _record_failure(self, kind: str, key: str, payload: dict, channel_id, message_id, title: str,
+                        error_class: str, message: str, min_delay: float) -> tuple:
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute('SELECT attempts FROM jobs WHERE key = ?', (key,)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            dead = error_class in RetryQueue.PERMANENT or (self.max_retries > 0 and attempts > self.max_retries)
+            next_at = now + max(self.backoff(attempts), min_delay)
+            conn.execute('INSERT INTO jobs (key, kind, channel_id, message_id, channel_title, payload, attempts, next_at, error_class, last_error, '
+                         'created_at, updated_at, dead) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+                         'ON CONFLICT(key) DO UPDATE SET payload = excluded.payload, attempts = excluded.attempts, next_at = excluded.next_at, '
+                         'error_class = excluded.error_class, last_error = excluded.last_error, updated_at = excluded.updated_at, dead = excluded.dead, '
+                         'owner = NULL, owner_expires = 0',
+                         (key, kind, channel_id, message_id, title, json.dumps(payload, ensure_ascii=False), attempts, next_at,
+                          error_class, message[:1000], now, now, int(dead)))
+        return attempts, dead, next_at
+
+    async def fail(self, kind: str, key: str, payload: dict, channel_id, message_id, title: str, error: BaseException) -> None:
+        """记录一次失败并安排重试，或移入死信"""
+        error_class = RetryQueue.classify(error)
+        min_delay = getattr(error, 'seconds', 0) if error_class == 'flood_wait' else 0
+        attempts, dead, next_at = await asyncio.to_thread(
+            self._record_failure, kind, key, payload, channel_id, message_id, title, error_class, str(error), min_delay)
+        METRICS.inc('tgdl_retry_failures_total', kind=kind, error_class=error_class)
+        if dead:
+            self.next_at.pop(key, None)
+            METRICS.inc('tgdl_dead_letters_total', kind=kind)
+            logger.error(f'任务 {key} 第 {attempts} 次失败（{error_class}），移入死信队列: {error}')
+            return
+        self.next_at[key] = next_at
+        heapq.heappush(self.heap, (next_at, key))
+        self.wakeup.set()
+        logger.warning(f'任务 {key} 第 {attempts} 次失败（{error_class}），{max(next_at - time.time(), 0):.0f} 秒后重试: {error}')
+
+    def _delete(self, key: str) -> None:
+        with self._connect() as conn:
+            conn.execute('DELETE FROM jobs WHERE key = ? AND dead = 0', (key,))
+
+    def _defer(self, key: str, next_at: float) -> None:
+        with self._connect() as conn:
+            conn.execute('UPDATE jobs SET next_at = ?, owner = NULL, owner_expires = 0 WHERE key = ? AND dead = 0', (next_at, key))
+
+    async def defer(self, key: str, delay: float) -> None:
+        """推迟任务而不计入失败次数（如所属频道已暂停）"""
+        next_at = time.time() + delay
+        await asyncio.to_thread(self._defer, key, next_at)
+        self.next_at[key] = next_at
+        heapq.heappush(self.heap, (next_at, key))
+        self.wakeup.set()
+
+    async def complete(self, key: str) -> None:
+        """任务成功后移出队列；不在队列中的任务无需访问数据库"""
+        if key in self.next_at or key in self.running:
+            self.next_at.pop(key, None)
+            await asyncio.to_thread(self._delete, key)
+
+    def _load(self) -> list:
+        with self._connect() as conn:
+            if self.owner is None:
+                return conn.execute('SELECT key, next_at FROM jobs WHERE dead = 0').fetchall()
+            # 其他节点正在执行（认领未过期）的任务不加载
+            return conn.execute('SELECT key, next_at FROM jobs WHERE dead = 0 AND (owner IS NULL OR owner = ? OR owner_expires < ?)',
+                                (self.owner, time.time())).fetchall()
+
+    def _claim(self, key: str) -> dict | None:
+        """原子地认领已到期的任务：无人认领、认领已过期或本就属于本节点时成功，返回任务；否则返回 None"""
+        if self.owner is None:
+            return self._get(key)
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute('UPDATE jobs SET owner = ?, owner_expires = ? WHERE key = ? AND dead = 0 AND next_at <= ? '
+                               'AND (owner IS NULL OR owner = ? OR owner_expires < ?)',
+                               (self.owner, now + self.claim_seconds, key, now, self.owner, now))
+            if cur.rowcount != 1:
+                return None
+        return self._get(key)
+
+    def _renew_claim(self, key: str) -> None:
+        with self._connect() as conn:
+            conn.execute('UPDATE jobs SET owner_expires = ? WHERE key = ? AND owner = ?', (time.time() + self.claim_seconds, key, self.owner))
+
+    def _release_claims(self) -> None:
+        with self._connect() as conn:
+            conn.execute('UPDATE jobs SET owner = NULL, owner_expires = 0 WHERE owner = ?', (self.owner,))
+
+    async def _keep_claim(self, key: str) -> None:
+        while True:
+            await asyncio.sleep(self.claim_seconds / 3)
+            try:
+                await asyncio.to_thread(self._renew_claim, key)
+            except Exception as e:
+                logger.warning(f'重试任务 {key} 续期认领失败: {e}')
+
+    def _get(self, key: str) -> dict | None:
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute('SELECT * FROM jobs WHERE key = ? AND dead = 0', (key,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        return job
+
+    async def reload(self) -> None:
+        """从数据库补充堆中没有的任务（启动时的遗留任务、命令行重新入队的任务）"""
+        for key, next_at in await asyncio.to_thread(self._load):
+            if key not in self.running and self.next_at.get(key) != next_at:
+                self.next_at[key] = next_at
+                heapq.heappush(self.heap, (next_at, key))
+
+    async def _dispatch(self, key: str, handler) -> None:
+        finished = False
+        keeper = None
+        try:
+            job = await asyncio.to_thread(self._claim, key)
+            if job is None:
+                # 已完成、已移入死信，或已被其他节点认领
+                return
+            if self.owner is not None:
+                keeper = asyncio.create_task(self._keep_claim(key), name=f'retry-claim-{key}')
+            logger.info(f'重试任务 {key}（已失败 {job["attempts"]} 次，上次错误 {job["error_class"]}）')
+            await handler(job)
+            finished = True
+        except Exception as e:
+            logger.error(f'重试任务 {key} 出错: {e}')
+        finally:
+            if keeper:
+                keeper.cancel()
+            self.running.discard(key)
+        # 处理方没有重新安排（成功、或已被跳过）时移出队列；中途取消时保留，下次启动继续
+        if finished and key not in self.next_at:
+            await asyncio.to_thread(self._delete, key)
+
+    async def run(self, handler) -> None:
+        """调度循环：到期任务交给 handler(job) 重新执行"""
+        await self.reload()
+        if self.next_at:
+            logger.info(f'重试队列中有 {len(self.next_at)} 个待重试任务')
+        last_reload = time.monotonic()
+        try:
+            while True:
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    next_at, key = heapq.heappop(self.heap)
+                    if self.next_at.get(key) != next_at:
+                        continue
+                    del self.next_at[key]
+                    self.running.add(key)
+                    task = asyncio.create_task(self._dispatch(key, handler), name=f'retry-{key}')
+                    self.dispatched.add(task)
+                    task.add_done_callback(self.dispatched.discard)
+                timeout = self.poll_seconds - (time.monotonic() - last_reload)
+                if self.heap:
+                    timeout = min(timeout, self.heap[0][0] - now)
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+                if time.monotonic() - last_reload >= self.poll_seconds:
+                    await self.reload()
+                    last_reload = time.monotonic()
+        finally:
+            for task in list(self.dispatched):
+                task.cancel()
+            await asyncio.gather(*self.dispatched, return_exceptions=True)
+            if self.owner is not None:
+                # 中途取消的任务留在队列中，释放认领使其他节点无需等认领过期即可接手
+                try:
+                    await asyncio.to_thread(self._release_claims)
+                except Exception as e:
+                    logger.warning(f'释放重试任务认领失败: {e}')
+
+    def counts(self) -> dict:
+        with self._connect() as conn:
+            rows = dict(conn.execute('SELECT dead, COUNT(*) FROM jobs GROUP BY dead').fetchall())
+        return {'pending': rows.get(0, 0), 'dead': rows.get(1, 0)}
+
+    def list_jobs(self, dead: bool) -> list:
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            return [dict(r) for r in conn.execute('SELECT key, kind, channel_id, message_id, channel_title, attempts, next_at, error_class, '
+                                                  'last_error, updated_at FROM jobs WHERE dead = ? ORDER BY next_at', (int(dead),))]
+
+    def requeue(self, keys: list | None) -> int:
+        """死信重新入队：清零尝试次数并立即可执行；keys 为 None 时重新入队全部死信"""
+        now = time.time()
+        with self._connect() as conn:
+            if keys is None:
+                cur = conn.execute('UPDATE jobs SET dead = 0, attempts = 0, next_at = ?, updated_at = ?, owner = NULL, owner_expires = 0 '
+                                   'WHERE dead = 1', (now, now))
+            else:
+                cur = conn.executemany('UPDATE jobs SET dead = 0, attempts = 0, next_at = ?, updated_at = ?, owner = NULL, owner_expires = 0 '
+                                       'WHERE key = ? AND dead = 1',
+                                       [(now, now, k) for k in keys])
+            return cur.rowcount
+
+    @staticmethod
+    def format_jobs(jobs: list, dead: bool) -> str:
+        if not jobs:
+            return '死信队列为空' if dead else '重试队列为空'
+        lines = [f'{"key":<32} {"类型":<6} {"次数":>4}  {"错误分类":<14} {"更新时间" if dead else "下次重试":<16}  频道 / 错误']
+        for j in jobs:
+            at = datetime.fromtimestamp(j['updated_at'] if dead else j['next_at']).strftime('%Y-%m-%d %H:%M')
+            lines.append(f'{j["key"]:<32} {j["kind"]:<6} {j["attempts"]:>4}  {j["error_class"] or "":<14} {at:<16}  '
+                         f'{j["channel_title"] or j["channel_id"] or ""} / {(j["last_error"] or "")[:80]}')
+        return '\n'.join(lines)
 
 class FileManager:
     @staticmethod
@@ -379,13 +1438,17 @@ class FileManager:
         mime = doc.mime_type or ''
         filename = None
         for attr in doc.attributes:
-            if isinstance(attr, DocumentAttributeFilename):
+            if isinstance(attr, tg_types.DocumentAttributeFilename):
                 filename = attr.file_name
                 break
+        return FileManager.build_filepath(msg.id, filename, mime)
+
+    @staticmethod
+    def build_filepath(message_id: int, filename: str | None, mime: str) -> tuple:
         if not filename:
             filename = f"{mime.replace('/', '_')}"
         safe_name = FileManager.sanitize_filename(f"{filename}")
-        tmp_name = FileManager.sanitize_filename(f"{msg.id}_{filename}")
+        tmp_name = FileManager.sanitize_filename(f"{message_id}_{filename}")
         
         # 获取下载设置
         config = ConfigManager.load_config()
@@ -456,30 +1519,1128 @@ class FileManager:
         logger.info(f'启动前清理未完成文件: {removed} 个')
         return removed
 
-class MediaValidator:
     @staticmethod
-    def should_download_media(message, media_types: list, config: dict) -> bool:
-        if not message.media or not isinstance(message.media, MessageMediaDocument):
-            logger.debug(f'消息 {message.id} 不包含可下载的媒体')
-            return False
+    def move_file(src: str, dst: str) -> None:
+        """移动已完成文件：同一文件系统内直接重命名；跨设备（EXDEV，如不同 Docker 卷）时复制并 fsync 后原子替换到目标，再删除源文件"""
+        try:
+            os.rename(src, dst)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        tmp_dst = dst + '.part'
+        try:
+            with open(src, 'rb') as fin, open(tmp_dst, 'wb') as fout:
+                FileManager._copy_file(fin, fout, os.fstat(fin.fileno()).st_size)
+                fout.flush()
+                os.fsync(fout.fileno())
+            os.replace(tmp_dst, dst)
+        except BaseException:
+            if os.path.exists(tmp_dst):
+                os.remove(tmp_dst)
+            raise
+        os.remove(src)
 
-        doc = message.media.document
-        mime = doc.mime_type or ''
-        
-        # 获取文件名
-        filename = None
-        for attr in doc.attributes:
-            if isinstance(attr, DocumentAttributeFilename):
-                filename = attr.file_name
-                break
-        if not filename:
-            # filename = f"{mime.replace('/', '_')}"
-            return False  # 如果没有文件名，则不下载
-            
+    @staticmethod
+    def _copy_file(fin, fout, size: int) -> None:
+        """优先用 copy_file_range/sendfile 在内核中复制，不支持时退回普通读写"""
+        src, dst = fin.fileno(), fout.fileno()
+        copied = 0
+        for kernel_copy in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+            if kernel_copy is None:
+                continue
+            try:
+                os.lseek(dst, copied, os.SEEK_SET)
+                while copied < size:
+                    if kernel_copy is os.sendfile:
+                        n = os.sendfile(dst, src, copied, size - copied)
+                    else:
+                        n = kernel_copy(src, dst, size - copied, copied, copied)
+                    if n == 0:
+                        break
+                    copied += n
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSOCK):
+                    raise
+        fin.seek(copied)
+        fout.seek(copied)
+        shutil.copyfileobj(fin, fout, 1024 * 1024)
+
+class Manifest:
+    """已完成文件清单（JSON Lines），记录下载时流式计算的 SHA-256、大小与来源消息，供去重与校验"""
+    MANIFEST_FILE = os.path.join(CONFIG_DIR, 'manifest.jsonl')
+    _lock = threading.Lock()
+
+    @staticmethod
+    def append(entry: dict) -> None:
+        with Manifest._lock:
+            with open(Manifest.MANIFEST_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+class RetentionIndex:
+    """已完成文件索引（SQLite），从文件清单增量同步，保留策略只查询索引，不扫描下载目录"""
+    ORDERS = ('accessed_at', 'finished_at')
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # 单个连接由 RetentionManager 的锁串行使用，可在工作线程间共享
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, channel_id INTEGER, size INTEGER NOT NULL, '
+                              'finished_at REAL NOT NULL, accessed_at REAL NOT NULL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS files_accessed ON files (accessed_at, path)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS files_finished ON files (finished_at, path)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS files_channel ON files (channel_id, accessed_at, path)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def sync_manifest(self, manifest_path: str) -> int:
+        """从上次读到的位置继续读取文件清单，把新完成的本地文件加入索引，返回新增条目数"""
+        if not os.path.exists(manifest_path):
+            return 0
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'manifest_offset'").fetchone()
+        offset = int(row[0]) if row else 0
+        if os.path.getsize(manifest_path) < offset:
+            # 清单被截断或替换，从头重新同步（已有条目按路径覆盖）
+            offset = 0
+        added = 0
+        with open(manifest_path, 'rb') as f, self.conn:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # 正在写入的半行留到下次同步
+                    break
+                offset += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                location = entry.get('location') or ''
+                # 对象存储等非本地位置不参与磁盘保留策略
+                if not location or '://' in location:
+                    continue
+                finished_at = float(entry.get('finished_at') or time.time())
+                self.conn.execute('INSERT INTO files (path, channel_id, size, finished_at, accessed_at) VALUES (?, ?, ?, ?, ?) '
+                                  'ON CONFLICT(path) DO UPDATE SET channel_id = excluded.channel_id, size = excluded.size, '
+                                  'finished_at = excluded.finished_at, accessed_at = MAX(files.accessed_at, excluded.accessed_at)',
+                                  (location, entry.get('channel_id'), int(entry.get('size') or 0), finished_at, finished_at))
+                added += 1
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('manifest_offset', ?)", (str(offset),))
+        return added
+
+    def totals(self) -> tuple:
+        """返回 (总字节数, {频道ID: 字节数})"""
+        per_channel = {ch: used for ch, used in self.conn.execute('SELECT channel_id, SUM(size) FROM files GROUP BY channel_id')}
+        return sum(per_channel.values()), per_channel
+
+    def candidates(self, order: str, limit: int, channel_id: int | None = None, before: float | None = None, after: tuple | None = None) -> list:
+        """按 order 列升序取下一批候选 (path, channel_id, size, finished_at, accessed_at)，after 为上一批最后的 (值, 路径)"""
+        if order not in RetentionIndex.ORDERS:
+            raise ValueError(f'不支持的排序: {order}')
+        where, params = [], []
+        if channel_id is not None:
+            where.append('channel_id = ?')
+            params.append(channel_id)
+        if before is not None:
+            where.append(f'{order} < ?')
+            params.append(before)
+        if after is not None:
+            where.append(f'({order} > ? OR ({order} = ? AND path > ?))')
+            params.extend([after[0], after[0], after[1]])
+        sql = 'SELECT path, channel_id, size, finished_at, accessed_at FROM files'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += f' ORDER BY {order}, path LIMIT ?'
+        return self.conn.execute(sql, params + [limit]).fetchall()
+
+    def touch(self, path: str, at: float) -> None:
+        with self.conn:
+            self.conn.execute('UPDATE files SET accessed_at = ? WHERE path = ? AND accessed_at < ?', (at, path, at))
+
+    def remove(self, path: str) -> None:
+        with self.conn:
+            self.conn.execute('DELETE FROM files WHERE path = ?', (path,))
+
+    def close(self) -> None:
+        self.conn.close()
+
+class RetentionManager:
+    """磁盘保留策略：按年龄、总配额、单频道配额淘汰已完成文件，并在下载开始前为其预留空间
+
+    规则依次为：
+        age            完成时间早于 max_age_days 的文件
+        channel_quota  单频道已完成文件超出配额时，淘汰该频道最久未访问的文件
+        total_quota    全部已完成文件超出 max_total_gb 时，淘汰最久未访问的文件
+        disk_space     剩余空间不足 min_disk_space_mb（加上已预留下载尚未写入的部分）时，淘汰最久未访问的文件；
+                       downloading_dir 与 completed_dir 不在同一文件系统时淘汰无法释放下载盘空间，跳过该规则
+    候选文件只从索引按序分批读取；dry_run 时只记录和报告，不删除文件。
+    """
+    RULES = ('age', 'channel_quota', 'total_quota', 'disk_space')
+    GB = 1024 ** 3
+
+    def __init__(self, settings: dict, download_settings: dict, manifest_path: str = Manifest.MANIFEST_FILE):
+        self.settings = settings
+        self.dry_run = settings['dry_run']
+        self.manifest_path = manifest_path
+        self.disk_path = download_settings['downloading_dir']
+        self.completed_path = download_settings['completed_dir']
+        self.min_free = download_settings['min_disk_space_mb'] * 1024 * 1024
+        self.index = RetentionIndex(settings['index_path'])
+        self._lock = threading.Lock()
+        # 预留中的下载：目标路径 -> (大小, 频道ID, .part 路径)；预留路径上的已有文件（待替换的音频）不会被淘汰
+        self.reserved: dict[str, tuple] = {}
+        self._warned_device = False
+        self.total, self.per_channel = self.index.totals()
+        # dry_run 时本轮已计划淘汰的文件
+        self.planned: set[str] = set()
+
+    def _quota(self, channel_id) -> int:
+        gb = self.settings['channel_quotas_gb'].get(str(channel_id), self.settings['per_channel_gb'])
+        return int(gb * RetentionManager.GB)
+
+    @staticmethod
+    def _existing(path: str) -> str:
+        while not os.path.exists(path) and os.path.dirname(path) != path:
+            path = os.path.dirname(path)
+        return path or '.'
+
+    def _free_bytes(self) -> int:
+        return psutil.disk_usage(RetentionManager._existing(self.disk_path)).free
+
+    def _same_device(self) -> bool:
+        """淘汰 completed_dir 中的文件能否释放 downloading_dir 所在磁盘的空间"""
+        try:
+            same = os.stat(RetentionManager._existing(self.disk_path)).st_dev == os.stat(RetentionManager._existing(self.completed_path)).st_dev
+        except OSError:
+            same = False
+        if not same and not self._warned_device:
+            self._warned_device = True
+            logger.warning(f'downloading_dir 与 completed_dir 不在同一文件系统，保留策略不会为剩余空间不足淘汰文件: '
+                           f'{self.disk_path}, {self.completed_path}')
+        return same
+
+    def _unwritten(self) -> int:
+        """已预留下载尚未写入磁盘的字节数：.part 中已写入的部分已计入剩余空间，不重复预留"""
+        total = 0
+        for size, _, tmp_path in self.reserved.values():
+            try:
+                written = os.path.getsize(tmp_path) if tmp_path else 0
+            except OSError:
+                written = 0
+            total += max(size - written, 0)
+        return total
+
+    def _sync(self) -> None:
+        if self.index.sync_manifest(self.manifest_path):
+            self.total, self.per_channel = self.index.totals()
+
+    def _begin(self) -> None:
+        self._sync()
+        self.planned = set()
+
+    def _end(self) -> None:
+        # dry_run 不删除文件，计划淘汰时扣减的用量恢复为索引中的实际值
+        if self.dry_run:
+            self.total, self.per_channel = self.index.totals()
+
+    def _drop(self, path: str, channel_id, size: int) -> None:
+        self.index.remove(path)
+        self.total -= size
+        self.per_channel[channel_id] = self.per_channel.get(channel_id, 0) - size
+
+    def _evict(self, need: int | None, rule: str, evicted: list, channel_id: int | None = None, before: float | None = None) -> int:
+        """按规则顺序淘汰文件直到释放 need 字节（need 为 None 时淘汰全部符合条件的文件），返回释放的字节数"""
+        order = 'finished_at' if rule == 'age' else 'accessed_at'
+        freed = 0
+        after = None
+        # disk_space 按实际增加的剩余空间计算释放量（文件仍被占用、存在硬链接等情况下删除不一定释放空间）
+        measure = rule == 'disk_space' and not self.dry_run
+        free_before = self._free_bytes() if measure else 0
+        while need is None or freed < need:
+            rows = self.index.candidates(order, 200, channel_id=channel_id, before=before, after=after)
+            if not rows:
+                break
+            for path, ch, size, finished_at, accessed_at in rows:
+                after = (finished_at if order == 'finished_at' else accessed_at, path)
+                if need is not None and freed >= need:
+                    break
+                if path in self.planned or path in self.reserved:
+                    continue
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    # 已被手动删除，只清理索引
+                    self._drop(path, ch, size)
+                    continue
+                if order == 'accessed_at' and self.settings['use_atime'] and st.st_atime > accessed_at + 1:
+                    # 索引后被访问过：更新访问时间，按新的位置排序（同一轮内仍可能轮到它）
+                    self.index.touch(path, st.st_atime)
+                    continue
+                if self.dry_run:
+                    self.planned.add(path)
+                    self.total -= size
+                    self.per_channel[ch] = self.per_channel.get(ch, 0) - size
+                    logger.info(f'[dry-run] 保留策略 {rule} 将淘汰: {path} ({size/1024/1024:.2f}MB)')
+                else:
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        logger.warning(f'保留策略淘汰文件失败: {path}, 错误: {e}')
+                        continue
+                    self._drop(path, ch, size)
+                    logger.info(f'保留策略 {rule} 淘汰: {path} ({size/1024/1024:.2f}MB)')
+                freed = self._free_bytes() - free_before if measure else freed + size
+                evicted.append({'path': path, 'channel_id': ch, 'size': size, 'rule': rule,
+                                'finished_at': finished_at, 'accessed_at': max(accessed_at, st.st_atime if self.settings['use_atime'] else 0)})
+                METRICS.inc('tgdl_retention_evicted_files_total', rule=rule, dry_run=str(self.dry_run).lower())
+                METRICS.inc('tgdl_retention_evicted_bytes_total', size, rule=rule, dry_run=str(self.dry_run).lower())
+        return freed
+
+    def enforce(self, now: float | None = None) -> list:
+        """执行一轮按年龄、配额与剩余空间的清理，返回淘汰（dry_run 时为计划淘汰）的文件列表"""
+        now = now or time.time()
+        evicted = []
+        with self._lock:
+            self._begin()
+            try:
+                if self.settings['max_age_days']:
+                    self._evict(None, 'age', evicted, before=now - self.settings['max_age_days'] * 86400)
+                for ch, used in list(self.per_channel.items()):
+                    quota = self._quota(ch)
+                    if quota and used > quota:
+                        self._evict(used - quota, 'channel_quota', evicted, channel_id=ch)
+                max_total = int(self.settings['max_total_gb'] * RetentionManager.GB)
+                if max_total and self.total > max_total:
+                    self._evict(self.total - max_total, 'total_quota', evicted)
+                need = self.min_free + self._unwritten() - self._free_bytes()
+                if need > 0 and self._same_device():
+                    self._evict(need, 'disk_space', evicted)
+            finally:
+                self._end()
+        return evicted
+
+    def reserve(self, path: str, size: int, channel_id: int | None, tmp_path: str | None = None) -> bool:
+        """为即将开始的下载预留空间，必要时先淘汰文件；剩余空间仍不足时返回 False
+
+        配额是软限制：腾不出配额空间时仍允许下载，只有磁盘剩余空间是硬性要求。
+        tmp_path 为下载写入的 .part 文件，剩余空间只为其中尚未写入的部分预留（续传时已有的字节不再计入）。
+        """
+        evicted = []
+        with self._lock:
+            self._begin()
+            try:
+                pending = sum(s for s, _, _ in self.reserved.values())
+                quota = self._quota(channel_id)
+                if quota:
+                    channel_pending = sum(s for s, ch, _ in self.reserved.values() if ch == channel_id)
+                    over = self.per_channel.get(channel_id, 0) + channel_pending + size - quota
+                    if over > 0:
+                        self._evict(over, 'channel_quota', evicted, channel_id=channel_id)
+                max_total = int(self.settings['max_total_gb'] * RetentionManager.GB)
+                if max_total and self.total + pending + size > max_total:
+                    self._evict(self.total + pending + size - max_total, 'total_quota', evicted)
+                self.reserved[path] = (size, channel_id, tmp_path)
+                need = self.min_free + self._unwritten() - self._free_bytes()
+                if need > 0 and self._same_device():
+                    self._evict(need, 'disk_space', evicted)
+                    # dry_run 不会真正释放空间
+                    need = self.min_free + self._unwritten() - self._free_bytes()
+                if need > 0:
+                    del self.reserved[path]
+                    return False
+                return True
+            finally:
+                self._end()
+                if evicted:
+                    self.log_report(evicted)
+
+    def release(self, path: str) -> None:
+        with self._lock:
+            self.reserved.pop(path, None)
+
+    def touch(self, path: str) -> None:
+        """已有文件被再次命中（如重复消息跳过）时记为一次访问"""
+        with self._lock:
+            self.index.touch(path, time.time())
+
+    def log_report(self, evicted: list) -> None:
+        prefix = '[dry-run] 保留策略将淘汰' if self.dry_run else '保留策略已淘汰'
+        for rule in RetentionManager.RULES:
+            items = [e for e in evicted if e['rule'] == rule]
+            if items:
+                logger.info(f'{prefix} {rule}: {len(items)} 个文件，共 {sum(e["size"] for e in items)/1024/1024:.2f}MB')
+
+    def report(self, evicted: list, limit: int = 50) -> str:
+        """命令行报告：索引用量、各规则淘汰汇总与文件明细"""
+        lines = [f'索引: {self.index.path}，已完成文件 {self.total/1024/1024:.2f}MB，频道 {len(self.per_channel)} 个，'
+                 f'剩余空间 {self._free_bytes()/1024/1024:.2f}MB（最低 {self.min_free/1024/1024:.0f}MB）']
+        for ch, used in sorted(self.per_channel.items(), key=lambda kv: kv[1], reverse=True):
+            quota = self._quota(ch)
+            lines.append(f'  频道 {ch}: {used/1024/1024:.2f}MB' + (f' / 配额 {quota/1024/1024:.0f}MB' if quota else ''))
+        if not evicted:
+            lines.append('没有需要淘汰的文件')
+            return '\n'.join(lines)
+        verb = '将淘汰' if self.dry_run else '已淘汰'
+        lines.append(f'{verb} {len(evicted)} 个文件，共 {sum(e["size"] for e in evicted)/1024/1024:.2f}MB:')
+        for rule in RetentionManager.RULES:
+            items = [e for e in evicted if e['rule'] == rule]
+            if items:
+                lines.append(f'  {rule:<14} {len(items):6d} 个 {sum(e["size"] for e in items)/1024/1024:12.2f}MB')
+        for e in evicted[:limit]:
+            accessed = datetime.fromtimestamp(e['accessed_at']).strftime('%Y-%m-%d %H:%M')
+            lines.append(f'  [{e["rule"]}] {e["size"]/1024/1024:10.2f}MB  访问 {accessed}  {e["path"]}')
+        if len(evicted) > limit:
+            lines.append(f'  ... 另有 {len(evicted) - limit} 个文件')
+        return '\n'.join(lines)
+
+    async def run(self) -> None:
+        """后台定期清理"""
+        while True:
+            try:
+                evicted = await asyncio.to_thread(self.enforce)
+                if evicted:
+                    self.log_report(evicted)
+            except Exception as e:
+                logger.error(f'执行保留策略失败: {e}')
+            await asyncio.sleep(self.settings['interval_seconds'])
+
+    def close(self) -> None:
+        with self._lock:
+            self.index.close()
+
+class SinkWriter:
+    """单个下载文件的流式写入句柄
+
+    telethon 通过 write/tell 逐块写入；下载成功后 commit 落地，失败时 abort。
+    tell() 从已持久化的位置开始计数，下载方据此从该偏移续传。
+    写入时顺带计算 SHA-256，无需落地后再读一遍；从中途续传的文件由实现在落地后补算摘要。
+    """
+    location = ''
+    sha256 = None
+
+    def hexdigest(self) -> str | None:
+        return self.sha256.hexdigest() if self.sha256 is not None else None
+
+    async def write(self, chunk: bytes) -> None:
+        raise NotImplementedError
+
+    def tell(self) -> int:
+        raise NotImplementedError
+
+    async def commit(self) -> None:
+        raise NotImplementedError
+
+    async def abort(self) -> None:
+        raise NotImplementedError
+
+class MediaSink:
+    """下载文件的落地存储接口，按 storage.backend 选择实现"""
+    BACKENDS = {
+        'local': lambda settings: LocalDiskSink(),
+        's3': lambda settings: S3Sink(settings['s3']),
+        'pack': lambda settings: PackSink(settings['pack']),
+    }
+    # 是否落地到本地磁盘（决定是否检查磁盘空间、能否读取已有文件做音频质量对比）
+    local = True
+
+    @staticmethod
+    def create(settings: dict) -> 'MediaSink':
+        backend = settings.get('backend', 'local')
+        if backend not in MediaSink.BACKENDS:
+            raise ValueError(f'不支持的存储后端: {backend}')
+        return MediaSink.BACKENDS[backend](settings)
+
+    async def exists(self, save_path: str, name: str) -> bool:
+        raise NotImplementedError
+
+    async def open(self, tmp_path: str, save_path: str, name: str, size: int, meta: dict | None = None) -> SinkWriter:
+        """meta 为来源消息（channel_id、message_id、document_id），供需要按消息定位文件的实现使用"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+class LocalFileWriter(SinkWriter):
+    def __init__(self, tmp_path: str, save_path: str):
+        self.tmp_path = tmp_path
+        self.save_path = save_path
+        self.location = save_path
+        self.sha256 = hashlib.sha256()
+        self.f = open(tmp_path, 'wb')
+
+    async def write(self, chunk: bytes) -> None:
+        self.f.write(chunk)
+        self.sha256.update(chunk)
+
+    def tell(self) -> int:
+        return self.f.tell()
+
+    def flush(self) -> None:
+        self.f.flush()
+
+    def _finalize(self) -> None:
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        FileManager.move_file(self.tmp_path, self.save_path)
+
+    async def commit(self) -> None:
+        # 下载完成后，将文件从下载中目录移动到下载完成目录；fsync 与跨设备复制可能耗时，放到工作线程执行
+        await asyncio.to_thread(self._finalize)
+        logger.info(f'下载完成: 从 {self.tmp_path} 移动到 {self.save_path}')
+
+    async def abort(self) -> None:
+        self.f.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+            logger.debug(f'删除临时文件: {self.tmp_path}')
+
+class LocalDiskSink(MediaSink):
+    """本地磁盘：写入 downloading_dir 下的 .part 文件，完成后重命名到 completed_dir"""
+    async def exists(self, save_path: str, name: str) -> bool:
+        return os.path.exists(save_path)
+
+    async def open(self, tmp_path: str, save_path: str, name: str, size: int, meta: dict | None = None) -> SinkWriter:
+        return LocalFileWriter(tmp_path, save_path)
+
+class S3UploadWriter(SinkWriter):
+    """把下载分块攒满一个分片即上传，内存中最多缓冲一个分片；upload_id 与已传分片记录在状态文件中以便续传"""
+    def __init__(self, sink: 'S3Sink', key: str, size: int):
+        self.sink = sink
+        self.key = key
+        self.size = size
+        self.location = f's3://{sink.bucket}/{key}'
+        self.upload_id = None
+        self.parts: list[list] = []
+        self.uploaded = 0
+        self.buffer = bytearray()
+
+    def _save(self) -> None:
+        StateManager.set_upload(self.key, {'upload_id': self.upload_id, 'size': self.size, 'parts': self.parts})
+
+    def _list_parts(self, upload_id: str) -> list:
+        parts = []
+        paginator = self.sink.client.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=self.sink.bucket, Key=self.key, UploadId=upload_id):
+            parts.extend(page.get('Parts', []))
+        return sorted(parts, key=lambda p: p['PartNumber'])
+
+    async def resume(self) -> None:
+        """续用同一对象未完成的分片上传，只保留从 1 开始连续的整片；否则新建上传"""
+        saved = await asyncio.to_thread(StateManager.get_upload, self.key)
+        if saved and saved.get('size') == self.size:
+            try:
+                listed = await asyncio.to_thread(self._list_parts, saved['upload_id'])
+                for n, part in enumerate(listed, start=1):
+                    if part['PartNumber'] != n or part['Size'] != self.sink.part_size:
+                        break
+                    self.parts.append([n, part['ETag'], part['Size']])
+                self.upload_id = saved['upload_id']
+                self.uploaded = sum(p[2] for p in self.parts)
+                if self.uploaded:
+                    logger.info(f'续传分片上传 {self.key}: 已上传 {len(self.parts)} 个分片，{self.uploaded/1024/1024:.2f}MB')
+            except Exception as e:
+                logger.warning(f'无法续传分片上传 {self.key}，重新开始: {e}')
+                self.parts = []
+                # 放弃的上传需显式取消，否则已传分片会一直占用存储桶空间
+                await asyncio.to_thread(self._abort_upload, saved['upload_id'])
+        elif saved:
+            # 同名对象但文件大小不同，旧的上传已无用
+            await asyncio.to_thread(self._abort_upload, saved['upload_id'])
+        if self.upload_id is None:
+            resp = await asyncio.to_thread(self.sink.client.create_multipart_upload, Bucket=self.sink.bucket, Key=self.key)
+            self.upload_id = resp['UploadId']
+        if not self.uploaded:
+            self.sha256 = hashlib.sha256()
+        await asyncio.to_thread(self._save)
+
+    def _abort_upload(self, upload_id: str) -> None:
+        try:
+            self.sink.client.abort_multipart_upload(Bucket=self.sink.bucket, Key=self.key, UploadId=upload_id)
+        except Exception as e:
+            logger.debug(f'取消分片上传失败 {self.key}: {e}')
+
+    async def _upload_part(self, data: bytes) -> None:
+        number = len(self.parts) + 1
+        resp = await asyncio.to_thread(
+            self.sink.client.upload_part,
+            Bucket=self.sink.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=data
+        )
+        self.parts.append([number, resp['ETag'], len(data)])
+        self.uploaded += len(data)
+        await asyncio.to_thread(self._save)
+
+    async def write(self, chunk: bytes) -> None:
+        self.buffer += chunk
+        if self.sha256 is not None:
+            self.sha256.update(chunk)
+        part_size = self.sink.part_size
+        while len(self.buffer) >= part_size:
+            await self._upload_part(bytes(self.buffer[:part_size]))
+            del self.buffer[:part_size]
+
+    def tell(self) -> int:
+        return self.uploaded + len(self.buffer)
+
+    def _digest_object(self):
+        """续传的上传缺少此前已传分片的摘要，合并后读回对象补算"""
+        sha256 = hashlib.sha256()
+        body = self.sink.client.get_object(Bucket=self.sink.bucket, Key=self.key)['Body']
+        try:
+            for chunk in iter(lambda: body.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        finally:
+            body.close()
+        return sha256
+
+    async def commit(self) -> None:
+        if self.buffer or not self.parts:
+            await self._upload_part(bytes(self.buffer))
+            self.buffer.clear()
+        await asyncio.to_thread(
+            self.sink.client.complete_multipart_upload,
+            Bucket=self.sink.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': etag} for n, etag, _ in self.parts]}
+        )
+        await asyncio.to_thread(StateManager.set_upload, self.key, None)
+        if self.sha256 is None:
+            try:
+                self.sha256 = await asyncio.to_thread(self._digest_object)
+            except Exception as e:
+                logger.warning(f'读回对象计算摘要失败 {self.key}: {e}')
+        logger.info(f'下载完成: 已上传到 {self.location}')
+
+    async def abort(self) -> None:
+        # 保留已上传的分片与 upload_id，下次下载同一文件时从已上传位置续传；未满一个分片的缓冲直接丢弃
+        self.buffer.clear()
+
+class S3Sink(MediaSink):
+    """S3 兼容对象存储（AWS S3、MinIO 等）：下载分块直接流式写入分片上传，完成时合并分片"""
+    local = False
+
+    def __init__(self, settings: dict, client=None):
+        """client 为 boto3 S3 客户端或接口相同的替身（见 benchmarks/fake_s3.py），为空时按配置创建"""
+        if not settings.get('bucket'):
+            raise ValueError('S3 存储未配置 bucket')
+        self.bucket = settings['bucket']
+        self.prefix = settings.get('prefix', '').strip('/')
+        self.part_size = int(settings['part_size_mb']) * 1024 * 1024
+        if client is not None:
+            self.client = client
+            return
+        try:
+            import boto3
+        except ImportError as e:
+            raise RuntimeError('使用 S3 存储需要安装 boto3: pip install boto3') from e
+        self.client = boto3.client(
+            's3',
+            endpoint_url=settings.get('endpoint_url') or None,
+            region_name=settings.get('region') or None,
+            aws_access_key_id=settings.get('access_key') or None,
+            aws_secret_access_key=settings.get('secret_key') or None
+        )
+
+    def key(self, name: str) -> str:
+        return f'{self.prefix}/{name}' if self.prefix else name
+
+    async def exists(self, save_path: str, name: str) -> bool:
+        def _head():
+            try:
+                self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+                return True
+            except self.client.exceptions.ClientError as e:
+                if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                    return False
+                raise
+        return await asyncio.to_thread(_head)
+
+    async def open(self, tmp_path: str, save_path: str, name: str, size: int, meta: dict | None = None) -> SinkWriter:
+        writer = S3UploadWriter(self, self.key(name), size)
+        await writer.resume()
+        return writer
+
+class PackIndex:
+    """分片成员索引（SQLite）：按文件名、消息ID、文档ID定位分片内的偏移；可由分片旁的索引文件重建"""
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS members (name TEXT PRIMARY KEY, shard TEXT NOT NULL, offset INTEGER NOT NULL, '
+                              'size INTEGER NOT NULL, sha256 TEXT, channel_id INTEGER, message_id INTEGER, document_id INTEGER, packed_at REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS members_message ON members (message_id)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS members_document ON members (document_id)')
+
+    COLUMNS = ('name', 'shard', 'offset', 'size', 'sha256', 'channel_id', 'message_id', 'document_id', 'packed_at')
+
+    def add(self, entries: list) -> None:
+        with self._lock, self.conn:
+            self.conn.executemany(f'INSERT OR REPLACE INTO members ({", ".join(self.COLUMNS)}) VALUES ({", ".join("?" * len(self.COLUMNS))})',
+                                  [tuple(e.get(c) for c in self.COLUMNS) for e in entries])
+
+    def has(self, name: str) -> bool:
+        with self._lock:
+            return self.conn.execute('SELECT 1 FROM members WHERE name = ?', (name,)).fetchone() is not None
+
+    def find(self, name: str | None = None, message_id: int | None = None, document_id: int | None = None,
+             channel_id: int | None = None, limit: int | None = None) -> list:
+        where, params = [], []
+        for column, value in (('name', name), ('message_id', message_id), ('document_id', document_id), ('channel_id', channel_id)):
+            if value is not None:
+                where.append(f'{column} = ?')
+                params.append(value)
+        sql = f'SELECT {", ".join(self.COLUMNS)} FROM members' + (' WHERE ' + ' AND '.join(where) if where else '') + ' ORDER BY shard, offset'
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+        with self._lock:
+            return [dict(zip(self.COLUMNS, row)) for row in self.conn.execute(sql, params)]
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+class PackLockedError(RuntimeError):
+    """分片目录已被其他写入方锁定"""
+
+class ShardPacker:
+    """把小文件追加到滚动的 tar 分片，每个成员的偏移写入分片旁的 .idx（JSON Lines）并登记到 PackIndex
+
+    正在写入的分片名为 shard-NNNNNN.tar.part，数据与索引行逐个 fsync 后才登记；
+    达到 shard_size_mb 或打开超过 max_open_hours 时写入 tar 结束块、fsync 后原子重命名为 .tar。
+    进程中断后从 .idx 恢复：截掉最后一个已登记成员之后的半截数据，继续追加到同一分片。
+    分片是标准 tar，可直接用 tar 解包；按索引随机读取时只需 seek 到偏移。
+
+    写入方（writable=True）在分片目录的 .writer.lock 上持有排他文件锁直到 close()，锁被占用时抛出 PackLockedError；
+    只读方（列出、解出）不加锁也不做恢复，不会截断或重命名写入方正在追加的分片。
+    """
+    BLOCK = tarfile.BLOCKSIZE
+    LOCK_NAME = '.writer.lock'
+
+    def __init__(self, settings: dict, writable: bool = True):
+        self.dir = settings['dir']
+        self.shard_size = int(settings['shard_size_mb'] * 1024 * 1024)
+        self.max_open = settings['max_open_hours'] * 3600
+        self._lock = threading.Lock()
+        self.current = None       # 当前打开的分片名（不含扩展名）
+        self.f = None
+        self.idx = None
+        self.opened_at = 0.0
+        self.count = 0
+        self.writer_lock = None
+        os.makedirs(self.dir, exist_ok=True)
+        if writable:
+            lock = FileLock(os.path.join(self.dir, self.LOCK_NAME))
+            if not lock.acquire(blocking=False):
+                raise PackLockedError(f'分片目录 {self.dir} 正被其他进程写入（下载器运行中？）')
+            self.writer_lock = lock
+        self.index = PackIndex(settings['index_path'])
+        if writable:
+            self._recover()
+
+    def _path(self, shard: str, ext: str) -> str:
+        return os.path.join(self.dir, shard + ext)
+
+    @staticmethod
+    def _padded(size: int) -> int:
+        return -(-size // ShardPacker.BLOCK) * ShardPacker.BLOCK
+
+    @staticmethod
+    def read_sidecar(path: str) -> tuple:
+        """读取索引文件，返回 (完整的条目, 完整行的总字节数)；末尾的半行视为中断时未写完"""
+        entries, good = [], 0
+        if not os.path.exists(path):
+            return entries, good
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+                good += len(line)
+        return entries, good
+
+    def _recover(self) -> None:
+        partial = sorted(n[:-len('.tar.part')] for n in os.listdir(self.dir) if n.endswith('.tar.part'))
+        for shard in partial:
+            entries, good = self.read_sidecar(self._path(shard, '.idx'))
+            end = max((e['offset'] + self._padded(e['size']) for e in entries), default=0)
+            with open(self._path(shard, '.tar.part'), 'r+b') as f:
+                f.truncate(end)
+            with open(self._path(shard, '.idx'), 'ab') as f:
+                f.truncate(good)
+            # 数据与索引行已落盘但 SQLite 登记前中断的成员，在此补登记
+            self.index.add(entries)
+            if shard != partial[-1]:
+                self._open(shard)
+                self._finalize()
+            elif entries or end:
+                logger.info(f'继续写入未封装的分片 {shard}: {len(entries)} 个文件，{end/1024/1024:.2f}MB')
+        if partial:
+            self.current = partial[-1]
+            self._open(partial[-1])
+
+    def _next_name(self) -> str:
+        numbers = [int(m.group(1)) for m in (re.match(r'shard-(\d+)\.', n) for n in os.listdir(self.dir)) if m]
+        return f'shard-{max(numbers, default=0) + 1:06d}'
+
+    def _open(self, shard: str) -> None:
+        self.current = shard
+        self.f = open(self._path(shard, '.tar.part'), 'ab')
+        self.idx = open(self._path(shard, '.idx'), 'ab')
+        entries = self.read_sidecar(self._path(shard, '.idx'))[0]
+        self.count = len(entries)
+        self.opened_at = entries[0].get('packed_at', time.time()) if entries else time.time()
+
+    def _finalize(self) -> str | None:
+        if self.current is None:
+            return None
+        shard = self.current
+        # tar 结束标记：两个全零块
+        self.f.write(bytes(self.BLOCK * 2))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        self.idx.close()
+        os.replace(self._path(shard, '.tar.part'), self._path(shard, '.tar'))
+        try:
+            fd = os.open(self.dir, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            # Windows 等平台不支持对目录 fsync
+            pass
+        self.current = self.f = self.idx = None
+        logger.info(f'分片已封装: {self._path(shard, ".tar")}，{self.count} 个文件')
+        METRICS.inc('tgdl_pack_shards_total')
+        return shard
+
+    def finalize(self) -> str | None:
+        """封装当前分片（即使未写满），返回分片名"""
+        with self._lock:
+            return self._finalize()
+
+    def append(self, src_path: str, name: str, meta: dict) -> str:
+        """把已落盘的文件追加到当前分片，返回清单中记录的位置；调用方在返回后删除源文件"""
+        size = os.path.getsize(src_path)
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        header = info.tobuf(format=tarfile.PAX_FORMAT, encoding='utf-8', errors='surrogateescape')
+        with self._lock:
+            if self.current is not None and self.count and (
+                    self.f.tell() + len(header) + self._padded(size) > self.shard_size or time.time() - self.opened_at > self.max_open):
+                self._finalize()
+            if self.current is None:
+                self._open(self._next_name())
+            start = self.f.tell()
+            try:
+                self.f.write(header)
+                with open(src_path, 'rb') as src:
+                    shutil.copyfileobj(src, self.f, 1024 * 1024)
+                self.f.write(bytes(self._padded(size) - size))
+                self.f.flush()
+                os.fsync(self.f.fileno())
+            except BaseException:
+                # 写入失败时截掉半个成员，分片保持可解析
+                self.f.truncate(start)
+                self.f.seek(start)
+                raise
+            entry = {'name': name, 'shard': self.current, 'offset': start + len(header), 'size': size, 'packed_at': time.time(), **meta}
+            self.idx.write((json.dumps(entry, ensure_ascii=False) + '\n').encode('utf-8'))
+            self.idx.flush()
+            os.fsync(self.idx.fileno())
+            self.count += 1
+            self.index.add([entry])
+            METRICS.inc('tgdl_pack_files_total')
+            METRICS.inc('tgdl_pack_bytes_total', size)
+            return f'pack://{self.current}#{name}'
+
+    def locate(self, shard: str) -> str:
+        final = self._path(shard, '.tar')
+        return final if os.path.exists(final) else self._path(shard, '.tar.part')
+
+    def _open_shard(self, shard: str):
+        try:
+            return open(self.locate(shard), 'rb')
+        except FileNotFoundError:
+            # 写入方恰好在 locate 之后把 .tar.part 封装为 .tar
+            return open(self.locate(shard), 'rb')
+
+    def read(self, entry: dict, out, chunk_size: int = 1024 * 1024) -> int:
+        """按索引条目把成员内容写入 out，返回字节数"""
+        remaining = entry['size']
+        with self._open_shard(entry['shard']) as f:
+            f.seek(entry['offset'])
+            while remaining:
+                data = f.read(min(chunk_size, remaining))
+                if not data:
+                    raise IOError(f'分片 {entry["shard"]} 在偏移 {entry["offset"]} 处数据不完整')
+                out.write(data)
+                remaining -= len(data)
+        return entry['size']
+
+    def extract(self, entry: dict, dest: str) -> str:
+        """把成员解出到 dest（目录时使用原文件名），先写临时文件再重命名"""
+        path = os.path.join(dest, entry['name']) if os.path.isdir(dest) else dest
+        with open(path + '.part', 'wb') as out:
+            self.read(entry, out)
+        os.replace(path + '.part', path)
+        return path
+
+    def reindex(self) -> int:
+        """由全部分片旁的 .idx 重建 SQLite 索引，返回条目数"""
+        total = 0
+        for n in sorted(os.listdir(self.dir)):
+            if n.endswith('.idx'):
+                entries, _ = self.read_sidecar(os.path.join(self.dir, n))
+                self.index.add(entries)
+                total += len(entries)
+        return total
+
+    def close(self) -> None:
+        with self._lock:
+            if self.f is not None:
+                self.f.close()
+                self.idx.close()
+                self.current = self.f = self.idx = None
+        self.index.close()
+        if self.writer_lock is not None:
+            self.writer_lock.release()
+            self.writer_lock = None
+
+class PackFileWriter(LocalFileWriter):
+    """与本地磁盘相同地下载到 .part 文件，完成后追加到分片而不是移动到 completed_dir"""
+    def __init__(self, sink: 'PackSink', tmp_path: str, save_path: str, name: str, meta: dict):
+        super().__init__(tmp_path, save_path)
+        self.sink = sink
+        self.name = name
+        self.meta = meta
+
+    def _finalize(self) -> None:
+        self.f.flush()
+        self.f.close()
+        self.location = self.sink.packer.append(self.tmp_path, self.name, {**self.meta, 'sha256': self.hexdigest()})
+        os.remove(self.tmp_path)
+
+    async def commit(self) -> None:
+        await asyncio.to_thread(self._finalize)
+        logger.info(f'下载完成: {self.tmp_path} 已打包到 {self.location}')
+
+class PackSink(LocalDiskSink):
+    """本地磁盘 + 分片打包：小于 threshold_mb 的文件追加到 tar 分片，其余文件照常放入 completed_dir"""
+    def __init__(self, settings: dict):
+        self.threshold = settings['threshold_mb'] * 1024 * 1024
+        self.packer = ShardPacker(settings)
+
+    async def exists(self, save_path: str, name: str) -> bool:
+        return os.path.exists(save_path) or await asyncio.to_thread(self.packer.index.has, name)
+
+    async def open(self, tmp_path: str, save_path: str, name: str, size: int, meta: dict | None = None) -> SinkWriter:
+        if size and size <= self.threshold:
+            return PackFileWriter(self, tmp_path, save_path, name, meta or {})
+        return LocalFileWriter(tmp_path, save_path)
+
+    def close(self) -> None:
+        self.packer.close()
+
+class MessageDescriptor:
+    """消息的紧凑描述：只保留分类、链接提取与日志格式化所需字段，可序列化后交给进程池处理"""
+    __slots__ = ('id', 'date', 'text', 'entities', 'has_document', 'filename', 'mime', 'size')
+
+    def __init__(self, id: int, date, text: str, entities: list, has_document: bool, filename: str, mime: str, size: int):
+        self.id = id
+        self.date = date
+        self.text = text
+        self.entities = entities  # [(offset, length, url)]
+        self.has_document = has_document
+        self.filename = filename
+        self.mime = mime
+        self.size = size
+
+    @staticmethod
+    def from_message(msg) -> 'MessageDescriptor':
+        text = getattr(msg, 'message', '') or ''
+        entities = [(getattr(ent, 'offset', None), getattr(ent, 'length', None), getattr(ent, 'url', None))
+                    for ent in (getattr(msg, 'entities', None) or [])]
+        media = getattr(msg, 'media', None)
+        doc = getattr(media, 'document', None) if isinstance(media, tg_types.MessageMediaDocument) else None
+        filename = ''
+        for attr in getattr(doc, 'attributes', None) or []:
+            if isinstance(attr, tg_types.DocumentAttributeFilename):
+                filename = attr.file_name
+                break
+        return MessageDescriptor(
+            getattr(msg, 'id', None),
+            getattr(msg, 'date', None),
+            text,
+            entities,
+            doc is not None,
+            filename,
+            getattr(doc, 'mime_type', '') or '',
+            getattr(doc, 'size', 0) or 0
+        )
+
+    def to_record(self, channel_id: int | None) -> dict:
+        """轨迹记录（JSON 可序列化），不含媒体内容"""
+        return {
+            'channel_id': channel_id,
+            'id': self.id,
+            'date': int(self.date.timestamp()) if self.date else None,
+            'text': self.text,
+            'entities': [list(e) for e in self.entities],
+            'document': {'filename': self.filename, 'mime': self.mime, 'size': self.size} if self.has_document else None
+        }
+
+    @staticmethod
+    def from_record(record: dict) -> 'MessageDescriptor':
+        date = record.get('date')
+        doc = record.get('document')
+        return MessageDescriptor(
+            record['id'],
+            datetime.fromtimestamp(date, timezone.utc) if date is not None else None,
+            record.get('text') or '',
+            [tuple(e) for e in record.get('entities') or []],
+            doc is not None,
+            (doc or {}).get('filename') or '',
+            (doc or {}).get('mime') or '',
+            (doc or {}).get('size') or 0
+        )
+
+class TraceRecorder:
+    """抓取轨迹录制（--capture）：把每条扫描到的消息的紧凑记录追加到 JSON Lines 文件，供离线回放调整过滤与链接识别规则
+
+    只写入带缓冲的文件对象，不逐条 flush，退出时关闭。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8')
+        self.count = 0
+
+    def write(self, channel_id: int | None, descs: list) -> None:
+        self.file.write(''.join(json.dumps(d.to_record(channel_id), ensure_ascii=False) + '\n' for d in descs))
+        self.count += len(descs)
+
+    def close(self) -> None:
+        self.file.close()
+        logger.info(f'已录制 {self.count} 条消息到 {self.path}')
+
+    @staticmethod
+    def read(path: str):
+        """按录制顺序产出 (channel_id, MessageDescriptor)"""
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    yield record.get('channel_id'), MessageDescriptor.from_record(record)
+
+class MediaTask:
+    """排队中的媒体下载任务的紧凑记录
+
+    只保留下载所需的文档定位信息，不持有完整的 Message 对象（实体、媒体、回复键盘等）。
+    文件引用过期时由下载方按 channel_id/message_id 重新获取消息并调用 refresh。
+    """
+    __slots__ = ('channel_id', 'message_id', 'document_id', 'access_hash', 'file_reference', 'dc_id', 'size', 'mime', 'filename', 'duration', 'posted_at', 'trace')
+
+    def __init__(self, channel_id: int, message_id: int, document_id: int, access_hash: int, file_reference: bytes,
+                 dc_id: int, size: int, mime: str, filename: str, duration: float | None = None, posted_at: float | None = None,
+                 trace: 'MessageTrace | None' = None):
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.document_id = document_id
+        self.access_hash = access_hash
+        self.file_reference = file_reference
+        self.dc_id = dc_id
+        self.size = size
+        self.mime = mime
+        self.filename = filename
+        self.duration = duration
+        self.posted_at = posted_at
+        # 采样时的逐消息追踪，未采样为 None
+        self.trace = trace
+
+    @staticmethod
+    def from_message(msg, channel_id: int, trace: 'MessageTrace | None' = None) -> 'MediaTask':
+        doc = msg.media.document
+        filename = ''
+        duration = None
+        for attr in doc.attributes:
+            if isinstance(attr, tg_types.DocumentAttributeFilename):
+                filename = attr.file_name
+            if hasattr(attr, 'duration'):
+                duration = attr.duration
+        return MediaTask(channel_id, msg.id, doc.id, doc.access_hash, doc.file_reference, doc.dc_id,
+                         doc.size or 0, doc.mime_type or '', filename, duration,
+                         msg.date.timestamp() if getattr(msg, 'date', None) else None, trace)
+
+    def refresh(self, msg) -> bool:
+        """用重新获取的消息更新文件引用等定位信息，消息已无文档时返回 False"""
+        doc = getattr(getattr(msg, 'media', None), 'document', None) if msg else None
+        if doc is None or getattr(doc, 'id', None) is None:
+            return False
+        self.document_id = doc.id
+        self.access_hash = doc.access_hash
+        self.file_reference = doc.file_reference
+        self.dc_id = doc.dc_id
+        return True
+
+    def to_record(self) -> dict:
+        """持久化到重试队列的字段（不含追踪）"""
+        return {
+            'channel_id': self.channel_id, 'message_id': self.message_id, 'document_id': self.document_id,
+            'access_hash': self.access_hash, 'file_reference': (self.file_reference or b'').hex(), 'dc_id': self.dc_id,
+            'size': self.size, 'mime': self.mime, 'filename': self.filename, 'duration': self.duration, 'posted_at': self.posted_at,
+        }
+
+    @staticmethod
+    def from_record(record: dict) -> 'MediaTask':
+        return MediaTask(record['channel_id'], record['message_id'], record['document_id'], record['access_hash'],
+                         bytes.fromhex(record.get('file_reference') or ''), record['dc_id'], record['size'], record['mime'],
+                         record['filename'], record.get('duration'), record.get('posted_at'))
+
+    def input_location(self) -> tg_types.InputDocumentFileLocation:
+        return tg_types.InputDocumentFileLocation(id=self.document_id, access_hash=self.access_hash, file_reference=self.file_reference, thumb_size='')
+
+class MediaValidator:
+    @staticmethod
+    def should_download_media(message, media_types: list, config: dict) -> bool:
+        if not message.media or not isinstance(message.media, tg_types.MessageMediaDocument):
+            logger.debug(f'消息 {message.id} 不包含可下载的媒体')
+            return False
+
+        doc = message.media.document
+        mime = doc.mime_type or ''
+        
+        # 获取文件名
+        filename = None
+        for attr in doc.attributes:
+            if isinstance(attr, tg_types.DocumentAttributeFilename):
+                filename = attr.file_name
+                break
+        if not filename:
+            # filename = f"{mime.replace('/', '_')}"
+            return False  # 如果没有文件名，则不下载
+        return MediaValidator.should_download_file(message.id, filename, mime, media_types, config)
+
+    @staticmethod
+    def should_download_file(message_id: int, filename: str, mime: str, media_types: list, config: dict) -> bool:
+        """按文件名（排除模式、语言）与 MIME 类型判断是否下载，不依赖 telethon 对象"""
+        return MediaValidator.skip_reason(message_id, filename, mime, media_types, config) is None
+
+    @staticmethod
+    def skip_reason(message_id: int, filename: str, mime: str, media_types: list, config: dict) -> str | None:
+        """返回不下载的原因（excluded/language/media_type），应下载时返回 None"""
         # 检查文件名是否应该被排除
         if FileManager.should_exclude_file(filename, config):
-            logger.debug(f'消息 {message.id} 的文件名 {filename} 匹配排除模式，跳过下载')
-            return False
+            logger.debug(f'消息 {message_id} 的文件名 {filename} 匹配排除模式，跳过下载')
+            return 'excluded'
             
         # 检查语言过滤
         language_filter = config.get('language_filter', {})
@@ -489,11 +2650,11 @@ class MediaValidator:
                 threshold=language_filter.get('detection_threshold', 0.7)
             )
             if detected_lang and detected_lang not in language_filter.get('languages', []):
-                logger.debug(f'消息 {message.id} 的文件名 {filename} 检测到语言 {detected_lang}，不在允许的语言列表中，跳过下载')
-                return False
+                logger.debug(f'消息 {message_id} 的文件名 {filename} 检测到语言 {detected_lang}，不在允许的语言列表中，跳过下载')
+                return 'language'
             elif not detected_lang and 'unknown' not in language_filter.get('languages', []):
-                logger.debug(f'消息 {message.id} 的文件名 {filename} 无法检测语言，跳过下载')
-                return False
+                logger.debug(f'消息 {message_id} 的文件名 {filename} 无法检测语言，跳过下载')
+                return 'language'
 
         should_download = any(
             (t == 'video' and 'video' in mime) or
@@ -501,8 +2662,8 @@ class MediaValidator:
             (t == 'document' and 'application' in mime)
             for t in media_types
         )
-        logger.debug(f'消息 {message.id} 媒体类型: {mime}, 是否下载: {should_download}')
-        return should_download
+        logger.debug(f'消息 {message_id} 媒体类型: {mime}, 是否下载: {should_download}')
+        return None if should_download else 'media_type'
 
     @staticmethod
     def check_file_size(size: int, config: dict) -> bool:
@@ -688,17 +2849,23 @@ class ResourceExtractor:
 
     @staticmethod
     def extract_entity_urls(msg) -> list:
-        urls = []
         try:
             text = getattr(msg, 'message', '') or ''
-            entities = getattr(msg, 'entities', []) or []
-            for ent in entities:
-                u = getattr(ent, 'url', None)
+            entities = [(getattr(ent, 'offset', None), getattr(ent, 'length', None), getattr(ent, 'url', None))
+                        for ent in (getattr(msg, 'entities', []) or [])]
+            return ResourceExtractor.entity_urls(text, entities)
+        except Exception:
+            return []
+
+    @staticmethod
+    def entity_urls(text: str, entities: list) -> list:
+        """从 (offset, length, url) 形式的实体列表中提取去重后的 URL"""
+        urls = []
+        try:
+            for offset, length, u in entities:
                 if u:
                     urls.append(u)
                 else:
-                    offset = getattr(ent, 'offset', None)
-                    length = getattr(ent, 'length', None)
                     if offset is not None and length is not None and text:
                         seg = text[offset:offset+length]
                         if seg:
@@ -715,9 +2882,12 @@ class ResourceExtractor:
 
     @staticmethod
     def extract_from_message(msg) -> list:
-        text = getattr(msg, 'message', '') or ''
-        links = ResourceExtractor.extract_links(text)
-        entity_urls = ResourceExtractor.extract_entity_urls(msg)
+        return ResourceExtractor.extract_from_descriptor(MessageDescriptor.from_message(msg))
+
+    @staticmethod
+    def extract_from_descriptor(desc) -> list:
+        links = ResourceExtractor.extract_links(desc.text)
+        entity_urls = ResourceExtractor.entity_urls(desc.text, desc.entities)
         for u in entity_urls:
             for proc in ResourceExtractor.PROCESSORS:
                 try:
@@ -728,7 +2898,7 @@ class ResourceExtractor:
         for link in links:
             tasks.append({
                 'kind': 'cloud_link',
-                'message_id': msg.id,
+                'message_id': desc.id,
                 'provider': link.get('provider', ''),
                 'url': link.get('url', ''),
                 'code': link.get('code', ''),
@@ -736,6 +2906,151 @@ class ResourceExtractor:
             })
         return tasks
 
+class LinkProbe:
+    """提交前并发探测云盘分享链接是否仍然有效，结果为 alive、dead 或 unknown
+
+    每个提供方一条探测规则：请求分享页或匿名分享接口，按状态码与响应（含跳转后的地址）中的标记判断；
+    规则可在 link_probe.rules 中按提供方覆盖，link_probe.endpoints 可把提供方的请求改发到其他地址（如本地替身服务）。
+    请求经共享连接池的 requests.Session 在工作线程中执行，每个主机的并发数受 per_host_concurrency 限制；
+    alive/dead 结果按 cache_ttl_seconds 缓存，unknown（超时、限流、服务端错误、无法判断）不缓存，按原样提交。
+    """
+    RESULTS = ('alive', 'dead', 'unknown')
+    DEAD_STATUS = (404, 410)
+    SHARE_ID = re.compile(r'/s/([\w-]+)')
+    # 标记在响应正文或跳转后的地址中查找；dead 优先于 alive
+    RULES = {
+        'baidupan': {
+            'method': 'GET', 'url': '{url}',
+            'alive': ['/share/init', '请输入提取码', 'yunData', 'locals.mset'],
+            'dead': ['/share/error', '分享的文件已经被删除', '分享的文件已经被取消', '你所访问的页面不存在', '啊哦，你来晚了', '涉及侵权', '分享已过期'],
+        },
+        'aliyundrive': {
+            'method': 'POST', 'url': 'https://api.aliyundrive.com/adrive/v3/share_link/get_share_by_anonymous?share_id={id}',
+            'json': {'share_id': '{id}'},
+            'alive': ['"file_infos"', '"share_name"'],
+            'dead': ['ShareLink.Cancelled', 'ShareLink.Expired', 'ShareLink.Forbidden', 'NotFound.ShareLink'],
+        },
+        'quark': {
+            'method': 'POST', 'url': 'https://drive-h.quark.cn/1/clouddrive/share/sharepage/token?pr=ucpro&fr=pc',
+            'json': {'pwd_id': '{id}', 'passcode': '{code}'},
+            'alive': ['"stoken"', '提取码'],
+            'dead': ['分享不存在', '分享者删除', '取消了分享', '分享已过期', '违规'],
+        },
+        'ucdrive': {
+            'method': 'POST', 'url': 'https://pc-api.uc.cn/1/clouddrive/share/sharepage/token?entry=ft&fr=pc&pr=UCBrowser',
+            'json': {'pwd_id': '{id}', 'passcode': '{code}'},
+            'alive': ['"stoken"', '提取码'],
+            'dead': ['分享不存在', '分享者删除', '取消了分享', '分享已过期', '违规'],
+        },
+        'xunlei': {
+            'method': 'GET', 'url': '{url}',
+            'alive': ['"share_status":"OK"', '提取码'],
+            'dead': ['分享不存在', '分享已失效', '链接已过期', '已被删除', '"share_status":"DELETED"', '"share_status":"EXPIRED"'],
+        },
+    }
+
+    def __init__(self, settings: dict):
+        self.settings = settings
+        self.rules = {**LinkProbe.RULES, **{provider: {**LinkProbe.RULES.get(provider, {}), **rule} for provider, rule in settings['rules'].items()}}
+        self.timeout = settings['timeout_seconds']
+        self.cache = BoundedCache('link_probe', settings['cache_entries'], settings['cache_ttl_seconds'])
+        self.hosts: dict[str, asyncio.Semaphore] = {}
+        self.total = asyncio.Semaphore(settings['max_connections'])
+        # 同一链接的并发探测合并为一次请求
+        self.pending: dict[tuple, asyncio.Future] = {}
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=settings['max_connections'], pool_maxsize=settings['per_host_concurrency'])
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['User-Agent'] = settings['user_agent']
+
+    def request_for(self, task: dict) -> dict | None:
+        """按提供方规则生成探测请求；不支持的提供方或无法解析的链接返回 None"""
+        rule = self.rules.get(task.get('provider', ''))
+        url = task.get('url', '')
+        if not rule or not url.startswith(('http://', 'https://')):
+            return None
+        m = LinkProbe.SHARE_ID.search(url)
+        values = {'url': url, 'id': m.group(1) if m else '', 'code': task.get('code', '')}
+        if '{id}' in rule['url'] + json.dumps(rule.get('json', {})) and not values['id']:
+            return None
+        probe_url = rule['url'].format(**values)
+        endpoint = self.settings['endpoints'].get(task['provider']) or self.settings['endpoint']
+        if endpoint:
+            probe_url = re.sub(r'^https?://[^/]+', endpoint.rstrip('/'), probe_url)
+        body = rule.get('json')
+        if body is not None:
+            body = {k: v.format(**values) if isinstance(v, str) else v for k, v in body.items()}
+        return {'method': rule['method'], 'url': probe_url, 'json': body}
+
+    @staticmethod
+    def judge(rule: dict, status: int, final_url: str, text: str) -> str:
+        haystack = final_url + '\n' + text
+        if status in LinkProbe.DEAD_STATUS or any(marker in haystack for marker in rule.get('dead', [])):
+            return 'dead'
+        if status == 429 or status >= 500:
+            return 'unknown'
+        if any(marker in haystack for marker in rule.get('alive', [])):
+            return 'alive'
+        return 'unknown'
+
+    def _fetch(self, req: dict) -> tuple:
+        resp = self.session.request(req['method'], req['url'], json=req['json'], timeout=self.timeout, allow_redirects=True)
+        return resp.status_code, resp.url, resp.text
+
+    async def check(self, task: dict) -> str:
+        """探测单条链接；任何异常（如 endpoint 配置缺少协议导致地址无法解析）都记为 unknown，不影响调用方"""
+        try:
+            return await self._check(task)
+        except Exception as e:
+            logger.warning(f'探测云盘链接出错，按 unknown 处理: [{task.get("provider")}] {task.get("url")} {type(e).__name__}: {e}')
+            METRICS.inc('tgdl_link_probes_total', provider=task.get('provider', ''), result='unknown', source='error')
+            return 'unknown'
+
+    async def _check(self, task: dict) -> str:
+        req = self.request_for(task)
+        if req is None:
+            return 'unknown'
+        key = (task['provider'], req['url'], json.dumps(req['json'], sort_keys=True))
+        cached = self.cache.get(key)
+        if cached is not None:
+            METRICS.inc('tgdl_link_probes_total', provider=task['provider'], result=cached, source='cache')
+            return cached
+        if key in self.pending:
+            return await asyncio.shield(self.pending[key])
+        future = self.pending[key] = asyncio.get_running_loop().create_future()
+        result = 'unknown'
+        try:
+            m = re.match(r'^https?://([^/]+)', req['url'])
+            if m is None:
+                raise ValueError(f'探测地址缺少 http(s) 协议: {req["url"]}')
+            host = m.group(1)
+            sem = self.hosts.setdefault(host, asyncio.Semaphore(self.settings['per_host_concurrency']))
+            async with sem, self.total:
+                started = time.monotonic()
+                try:
+                    status, final_url, text = await asyncio.to_thread(self._fetch, req)
+                    result = LinkProbe.judge(self.rules[task['provider']], status, final_url, text)
+                except Exception as e:
+                    logger.debug(f'探测云盘链接失败: [{task["provider"]}] {task.get("url")} {e}')
+                METRICS.observe('tgdl_link_probe_seconds', time.monotonic() - started)
+            if result != 'unknown':
+                self.cache[key] = result
+            METRICS.inc('tgdl_link_probes_total', provider=task['provider'], result=result, source='probe')
+            return result
+        finally:
+            future.set_result(result)
+            del self.pending[key]
+
+    async def probe_all(self, tasks: list) -> None:
+        """并发探测一批链接，结果写入各任务的 liveness 字段"""
+        results = await asyncio.gather(*[self.check(t) for t in tasks], return_exceptions=True)
+        for task, result in zip(tasks, results):
+            task['liveness'] = result if isinstance(result, str) else 'unknown'
+
+    def close(self) -> None:
+        self.session.close()
+
 class MessageFormatter:
     @staticmethod
     def _summarize_text(text: str, max_len: int = 160) -> str:
@@ -755,10 +3070,17 @@ class MessageFormatter:
 
     @staticmethod
     def format(msg) -> str:
+        try:
+            return MessageFormatter.format_descriptor(MessageDescriptor.from_message(msg))
+        except Exception:
+            return str(getattr(msg, 'id', ''))
+
+    @staticmethod
+    def format_descriptor(desc) -> str:
         parts = []
         try:
-            mid = getattr(msg, 'id', None)
-            dt = getattr(msg, 'date', None)
+            mid = desc.id
+            dt = desc.date
             dt_str = ''
             if dt:
                 try:
@@ -766,25 +3088,14 @@ class MessageFormatter:
                 except Exception:
                     dt_str = str(dt)
             parts.append(f'#{mid} {dt_str}')
-            text = getattr(msg, 'message', '') or ''
+            text = desc.text
             if text:
                 parts.append(f'text="{MessageFormatter._summarize_text(text)}"')
-            if getattr(msg, 'media', None) and hasattr(msg.media, 'document'):
-                doc = msg.media.document
-                size = getattr(doc, 'size', 0)
-                mime = getattr(doc, 'mime_type', '') or ''
-                fname = ''
-                try:
-                    for attr in getattr(doc, 'attributes', []) or []:
-                        if isinstance(attr, DocumentAttributeFilename):
-                            fname = attr.file_name
-                            break
-                except Exception:
-                    fname = ''
-                parts.append(f'media={mime or "-"} name="{fname or "-"}" size={MessageFormatter._human_size(size)}')
+            if desc.has_document:
+                parts.append(f'media={desc.mime or "-"} name="{desc.filename or "-"}" size={MessageFormatter._human_size(desc.size)}')
+            entity_urls = ResourceExtractor.entity_urls(text, desc.entities)
             try:
                 found_text = ResourceExtractor.extract_links(text)
-                entity_urls = ResourceExtractor.extract_entity_urls(msg)
                 found_entities = []
                 for u in entity_urls:
                     for proc in ResourceExtractor.PROCESSORS:
@@ -804,7 +3115,6 @@ class MessageFormatter:
                 pass
             try:
                 dls_text = ResourceExtractor.parse_bot_deeplinks(text)
-                entity_urls = ResourceExtractor.extract_entity_urls(msg)
                 dls_entities = []
                 for u in entity_urls:
                     try:
@@ -822,7 +3132,7 @@ class MessageFormatter:
             except Exception:
                 pass
         except Exception:
-            parts.append(str(getattr(msg, 'id', ''))) 
+            parts.append(str(getattr(desc, 'id', ''))) 
         return ' | '.join([p for p in parts if p])
 
 class LanguageDetector:
@@ -933,9 +3243,10 @@ class LanguageDetector:
         return ''
 
 class ProgressTracker:
-    def __init__(self, step: int = 10):
+    def __init__(self, step: int = 10, max_entries: int = 1000, ttl_seconds: float = 21600):
         self.step = step
-        self.last_triggered: dict[str, int] = {}
+        # 下载中途被取消等未能清除的记录按 LRU 与过期时间淘汰
+        self.last_triggered = BoundedCache('progress', max_entries, ttl_seconds)
 
     def check(self, safe_name: str, current: float, total: float):
         if total == 0:
@@ -958,22 +3269,148 @@ class ProgressTracker:
         self.last_triggered.pop(safe_name, None)
 
 
+class SparseFile(io.RawIOBase):
+    """只含文件头尾若干字节的只读文件视图，中间部分读为零字节
+
+    保留文件的真实大小，mutagen 据此按文件长度估算 CBR 时长、在文件末尾查找 ID3v1/APE 标签与 MP4 moov。
+    """
+    def __init__(self, size: int, head: bytes, tail: bytes = b'', tail_offset: int | None = None):
+        self.size = size
+        self.head = head
+        self.tail = tail
+        self.tail_offset = size - len(tail) if tail_offset is None else tail_offset
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: self.size}[whence]
+        self.pos = max(base + offset, 0)
+        return self.pos
+
+    def readinto(self, b) -> int:
+        n = max(min(len(b), self.size - self.pos), 0)
+        view = memoryview(b)[:n]
+        view[:] = bytes(n)
+        for start, data in ((0, self.head), (self.tail_offset, self.tail)):
+            lo, hi = max(self.pos, start), min(self.pos + n, start + len(data))
+            if lo < hi:
+                view[lo - self.pos:hi - self.pos] = data[lo - start:hi - start]
+        self.pos += n
+        return n
+
 class AudioQualityChecker:
+    # 无损格式（mutagen 文件类型名）；已有无损文件不会被有损文件替换
+    LOSSLESS = ('FLAC', 'WAVE', 'AIFF', 'WavPack', 'MonkeysAudio', 'TrueAudio', 'OptimFROG')
+    # 探测时每次请求的字节数（4KB 的整数倍且整除 1MB）
+    PROBE_CHUNK = 64 * 1024
+
     def __init__(self, config):
         self.config = config
         self.quality_check_config = config.get('audio_quality_check', {})
+        probe_env = os.getenv('TGDL_AUDIO_PROBE_ENABLED', None)
+        self.probe_enabled = probe_env.lower() in ('1', 'true', 'yes') if probe_env is not None else bool(self.quality_check_config.get('probe_enabled', False))
+        self.probe_head = int(self.quality_check_config.get('probe_head_kb', 256)) * 1024
+        self.probe_tail = int(self.quality_check_config.get('probe_tail_kb', 128)) * 1024
+        self.min_bitrate = float(self.quality_check_config.get('min_bitrate_kbps', 0))
+
+    @staticmethod
+    def describe(audio, size: int) -> dict | None:
+        """从 mutagen 对象提取编码、采样率、比特率（kbps）、时长与标签；无损格式按文件大小计算平均比特率"""
+        info = getattr(audio, 'info', None)
+        if info is None:
+            return None
+        codec = type(audio).__name__
+        if getattr(info, 'codec', None):
+            codec += f'/{info.codec}'
+        lossless = type(audio).__name__ in AudioQualityChecker.LOSSLESS or 'alac' in codec.lower()
+        length = getattr(info, 'length', 0) or 0
+        bitrate = (getattr(info, 'bitrate', 0) or 0) / 1000
+        if (lossless or not bitrate) and length:
+            bitrate = size * 8 / length / 1000
+        tags = {}
+        try:
+            easy = dict(audio.tags) if audio.tags is not None and hasattr(audio.tags, 'keys') else {}
+            for key, names in (('title', ('TIT2', 'title', '\xa9nam')), ('artist', ('TPE1', 'artist', '\xa9ART')), ('album', ('TALB', 'album', '\xa9alb'))):
+                value = next((easy[n] for n in names if n in easy), None)
+                if value is not None:
+                    tags[key] = str(value[0] if isinstance(value, list) and value else value)
+        except Exception:
+            pass
+        return {
+            'codec': codec, 'lossless': lossless, 'sample_rate': getattr(info, 'sample_rate', 0) or 0,
+            'channels': getattr(info, 'channels', 0) or 0, 'bitrate': bitrate, 'duration': length, 'tags': tags,
+        }
+
+    def probe_ranges(self, size: int) -> list:
+        """需要获取的 (偏移, 长度)：文件头，以及文件较大时的文件尾（ID3v1/APE 标签、MP4 moov 可能在末尾）"""
+        head = min(self.probe_head, size)
+        if size <= head + self.probe_tail:
+            return [(0, size)]
+        # 偏移按请求大小对齐（upload.getFile 要求偏移是 limit 的整数倍）
+        tail_offset = (size - self.probe_tail) // self.PROBE_CHUNK * self.PROBE_CHUNK
+        return [(0, head), (tail_offset, size - tail_offset)]
+
+    @staticmethod
+    def parse_probe(size: int, head: bytes, tail: bytes = b'', tail_offset: int | None = None) -> dict | None:
+        try:
+            audio = mutagen.File(SparseFile(size, head, tail, tail_offset))
+        except Exception as e:
+            logger.debug(f'解析音频头失败: {e}')
+            return None
+        return AudioQualityChecker.describe(audio, size) if audio is not None else None
+
+    def accept_probe(self, save_path: str, probe: dict, new_duration: float | None) -> bool:
+        """根据探测到的编码参数决定是否继续下载替换现有文件（在 should_replace_audio 通过后调用）"""
+        existing = None
+        if os.path.exists(save_path):
+            try:
+                existing = self.describe(mutagen.File(save_path), os.path.getsize(save_path))
+            except Exception as e:
+                logger.debug(f'读取现有音频元数据失败: {save_path}, 错误: {e}')
+        logger.info(f'音频探测 {save_path}: 新: {probe["codec"]} {probe["sample_rate"]}Hz {probe["bitrate"]:.0f}kbps '
+                    f'{probe["duration"]:.0f}s {probe["tags"]}' + (f' 旧: {existing["codec"]} {existing["sample_rate"]}Hz '
+                    f'{existing["bitrate"]:.0f}kbps {existing["duration"]:.0f}s' if existing else ''))
+        if self.min_bitrate and probe['bitrate'] and probe['bitrate'] < self.min_bitrate:
+            logger.info(f'新音频比特率 {probe["bitrate"]:.0f}kbps 低于最低要求 {self.min_bitrate:.0f}kbps，跳过下载: {save_path}')
+            return False
+        duration = probe['duration'] or new_duration or 0
+        if new_duration and probe['duration'] and probe['duration'] < new_duration * 0.9:
+            logger.info(f'新音频实际时长 {probe["duration"]:.0f}s 明显短于声明的 {new_duration:.0f}s，跳过下载: {save_path}')
+            return False
+        if existing is None:
+            return True
+        if existing['lossless'] and not probe['lossless']:
+            logger.info(f'现有文件为无损格式，新文件为有损 {probe["codec"]}，跳过下载: {save_path}')
+            return False
+        longer = existing['duration'] and duration > existing['duration'] * 1.05
+        if not longer and existing['sample_rate'] and probe['sample_rate'] and probe['sample_rate'] < existing['sample_rate']:
+            logger.info(f'新音频采样率 {probe["sample_rate"]}Hz 低于现有文件，跳过下载: {save_path}')
+            return False
+        if not longer and existing['bitrate'] and probe['bitrate'] and probe['bitrate'] < existing['bitrate'] * 0.95:
+            # 文件更大但比特率更低：多出的部分是填充、封面或更长的静音，不是更好的编码
+            logger.info(f'新音频比特率 {probe["bitrate"]:.0f}kbps 低于现有文件 {existing["bitrate"]:.0f}kbps，跳过下载: {save_path}')
+            return False
+        return True
 
     def _get_audio_metadata(self, file_path: str) -> dict:
         """获取本地音频文件的元数据（时长和比特率）"""
         metadata = {'duration': 0, 'bitrate': 0}
         try:
             try:
-                audio = FLAC(file_path)
+                audio = mutagen_flac.FLAC(file_path)
                 metadata['duration'] = audio.info.length
                 metadata['bitrate'] = audio.info.length * audio.info.bits_per_sample * audio.info.sample_rate / 1000 # FLAC没有直接的bitrate，估算
             except Exception:
                 # Fallback for other formats or if FLAC fails
-                audio = File(file_path)
+                audio = mutagen.File(file_path)
                 if audio and audio.info:
                     metadata['duration'] = audio.info.length
                     if hasattr(audio.info, 'bitrate'):
@@ -984,19 +3421,19 @@ class AudioQualityChecker:
                 else:
                     logger.warning(f'无法获取文件 {file_path} 的元数据。')
 
-        except ID3NoHeaderError:
+        except mutagen_id3.ID3NoHeaderError:
             logger.warning(f'文件 {file_path} 没有ID3标签，尝试作为普通文件处理。')
             # 可以尝试其他方式获取，例如ffprobe，但这里简化处理
         except Exception as e:
             logger.error(f'获取音频元数据失败: {file_path}, 错误: {e}')
         return metadata
 
-    def should_replace_audio(self, save_path: str, doc, size: int) -> bool:
+    def should_replace_audio(self, save_path: str, new_duration: float | None, size: int) -> bool:
         """检查是否需要替换现有的音频文件
         
         Args:
             save_path: 现有文件的完整路径
-            doc: Telegram文档对象
+            new_duration: 新文件的时长（来自文档属性，可能为空）
             size: 新文件的大小
             
         Returns:
@@ -1006,11 +3443,6 @@ class AudioQualityChecker:
             return False
 
         existing_file_exists = os.path.exists(save_path)
-        # 获取新文件的比特率和时长
-        new_duration = None
-        for attr in doc.attributes:
-            if hasattr(attr, 'duration'):
-                new_duration = attr.duration
 
         existing_size = 0
         existing_duration = None
@@ -1083,28 +3515,1409 @@ class AudioQualityChecker:
                 logger.info(f'新音频文件在大小、比特率、时长上不完全优于现有文件，跳过下载: {save_path}')
                 return False
 
-        if should_replace:
-            logger.info(f'新文件 {log_reason}，准备替换: {save_path}')
+        if should_replace:
+            logger.info(f'新文件 {log_reason}，准备替换: {save_path}')
+        else:
+            logger.info(f'新文件质量不满足替换要求，跳过下载: {save_path}')
+        return should_replace
+
+class Metrics:
+    """进程内指标注册表（计数器、仪表、直方图），按 Prometheus 文本格式导出
+
+    未启用指标端点时仍会计数，开销只是字典更新。
+    """
+    def __init__(self):
+        self.meta: dict[str, tuple[str, str]] = {}
+        self.buckets: dict[str, tuple] = {}
+        self.values: dict[tuple, float] = {}
+        self.histograms: dict[tuple, list] = {}
+        # 抓取时才计算的仪表（如磁盘剩余空间），返回 {标签元组: 值}
+        self.collectors: dict[str, object] = {}
+
+    def counter(self, name: str, help_text: str) -> None:
+        self.meta[name] = ('counter', help_text)
+
+    def gauge(self, name: str, help_text: str, collector=None) -> None:
+        self.meta[name] = ('gauge', help_text)
+        if collector is not None:
+            self.collectors[name] = collector
+
+    def histogram(self, name: str, help_text: str, buckets: tuple) -> None:
+        self.meta[name] = ('histogram', help_text)
+        self.buckets[name] = tuple(sorted(buckets))
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, labels)
+        bounds = self.buckets[name]
+        # [各桶计数..., +Inf 计数, 总和]
+        h = self.histograms.setdefault(key, [0] * (len(bounds) + 1) + [0.0])
+        for i, bound in enumerate(bounds):
+            if value <= bound:
+                h[i] += 1
+        h[len(bounds)] += 1
+        h[-1] += value
+
+    @staticmethod
+    def _labels(pairs, extra: tuple = ()) -> str:
+        pairs = list(pairs) + list(extra)
+        if not pairs:
+            return ''
+        escaped = ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs)
+        return '{' + escaped + '}'
+
+    def render(self, collected: dict | None = None) -> str:
+        collected = collected or {}
+        lines = []
+        for name, (kind, help_text) in self.meta.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'histogram':
+                bounds = self.buckets[name]
+                for (n, labels), h in self.histograms.items():
+                    if n != name:
+                        continue
+                    for i, bound in enumerate(bounds):
+                        lines.append(f'{name}_bucket{self._labels(labels, (("le", repr(float(bound))),))} {h[i]}')
+                    lines.append(f'{name}_bucket{self._labels(labels, (("le", "+Inf"),))} {h[len(bounds)]}')
+                    lines.append(f'{name}_sum{self._labels(labels)} {h[-1]}')
+                    lines.append(f'{name}_count{self._labels(labels)} {h[len(bounds)]}')
+                continue
+            samples = {labels: v for (n, labels), v in self.values.items() if n == name}
+            samples.update(collected.get(name, {}))
+            for labels, v in samples.items():
+                lines.append(f'{name}{self._labels(labels)} {v}')
+        return '\n'.join(lines) + '\n'
+
+    async def collect(self) -> dict:
+        """在工作线程中执行抓取时仪表（可能涉及磁盘等阻塞调用）"""
+        collected = {}
+        for name, collector in self.collectors.items():
+            try:
+                collected[name] = await asyncio.to_thread(collector)
+            except Exception as e:
+                logger.debug(f'采集指标 {name} 失败: {e}')
+        return collected
+
+METRICS = Metrics()
+METRICS.counter('tgdl_messages_scanned_total', '已扫描的消息数')
+METRICS.counter('tgdl_messages_filtered_total', '未下载的消息数（按原因）')
+METRICS.counter('tgdl_downloads_total', '下载结果计数（completed/failed）')
+METRICS.counter('tgdl_download_bytes_total', '已下载字节数')
+METRICS.counter('tgdl_links_found_total', '识别到的云盘链接数（按提供方）')
+METRICS.counter('tgdl_links_submitted_total', '云盘链接提交结果计数（success/failed）')
+METRICS.counter('tgdl_flood_waits_total', 'FloodWait 次数（按方法类别）')
+METRICS.counter('tgdl_flood_wait_seconds_total', 'FloodWait 累计等待秒数（按方法类别）')
+METRICS.histogram('tgdl_download_duration_seconds', '单个文件下载耗时', (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+METRICS.histogram('tgdl_api_call_seconds', 'Telegram API 调用耗时（按方法类别，不含文件传输）', (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+METRICS.histogram('tgdl_time_to_download_seconds', '从消息发布到下载完成的时间', (10, 60, 300, 900, 3600, 6 * 3600, 24 * 3600, 7 * 24 * 3600))
+METRICS.gauge('tgdl_inflight_transfers', '正在传输的下载数')
+METRICS.gauge('tgdl_queue_depth', '排队中与进行中的下载任务数')
+METRICS.counter('tgdl_retry_failures_total', '进入重试队列的失败次数（按任务类型与错误分类）')
+METRICS.counter('tgdl_dead_letters_total', '移入死信队列的任务数（按任务类型）')
+METRICS.counter('tgdl_bandwidth_throttled_seconds_total', '因带宽限制等待的累计秒数（按 global/channel）')
+METRICS.counter('tgdl_pack_files_total', '打包进分片的文件数')
+METRICS.counter('tgdl_pack_bytes_total', '打包进分片的字节数')
+METRICS.counter('tgdl_pack_shards_total', '已封装的分片数')
+METRICS.counter('tgdl_audio_probes_total', '替换前的音频头部探测次数（按结果：accepted/rejected/inconclusive/error）')
+METRICS.counter('tgdl_audio_probe_saved_bytes_total', '音频探测判定无需替换而省去下载的字节数')
+METRICS.counter('tgdl_retention_evicted_files_total', '保留策略淘汰的文件数（按规则，dry_run 为计划淘汰）')
+METRICS.counter('tgdl_retention_evicted_bytes_total', '保留策略淘汰的字节数（按规则，dry_run 为计划淘汰）')
+METRICS.gauge('tgdl_disk_free_bytes', '下载目录所在磁盘的剩余空间（按目录）')
+METRICS.histogram('tgdl_loop_lag_seconds', '事件循环调度延迟（仅 --profile 模式采样）', (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+METRICS.counter('tgdl_link_probes_total', '云盘链接探测结果（按提供方、结果 alive/dead/unknown 与来源 probe/cache）')
+METRICS.histogram('tgdl_link_probe_seconds', '单次云盘链接探测耗时', (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+METRICS.counter('tgdl_cache_evictions_total', '缓存淘汰的条目数（按缓存与原因：lru/ttl/budget）')
+METRICS.counter('tgdl_memory_budget_exceeded_total', '进程内存超过预算的次数')
+METRICS.gauge('tgdl_cache_entries', '各缓存与队列的条目数', lambda: {(('cache', name),): n for name, n in MEMORY_BUDGET.sizes().items()})
+METRICS.gauge('tgdl_process_rss_bytes', '进程常驻内存（RSS）', lambda: {(): psutil.Process().memory_info().rss})
+
+class BoundedCache:
+    """有界映射：超过 max_entries 时淘汰最久未使用的条目，ttl_seconds > 0 时条目写入后超过该时长即失效
+
+    创建时登记到 MEMORY_BUDGET，按名称汇总条目数；内存超出预算时由其按比例收缩。
+    """
+    def __init__(self, name: str, max_entries: int, ttl_seconds: float = 0):
+        self.name = name
+        self.max_entries = max(int(max_entries), 1)
+        self.ttl = ttl_seconds
+        # 键 -> (值, 写入时间)，最久未使用的在前
+        self.data: OrderedDict = OrderedDict()
+        MEMORY_BUDGET.register(self)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None:
+            return default
+        if self.ttl and time.monotonic() - item[1] > self.ttl:
+            del self.data[key]
+            METRICS.inc('tgdl_cache_evictions_total', cache=self.name, reason='ttl')
+            return default
+        self.data.move_to_end(key)
+        return item[0]
+
+    def __setitem__(self, key, value) -> None:
+        self.data[key] = (value, time.monotonic())
+        self.data.move_to_end(key)
+        if len(self.data) > self.max_entries:
+            self.evict(len(self.data) - self.max_entries)
+
+    def add(self, key) -> None:
+        self[key] = True
+
+    def pop(self, key, default=None):
+        item = self.data.pop(key, None)
+        return default if item is None else item[0]
+
+    def evict(self, count: int, reason: str = 'lru') -> int:
+        count = min(count, len(self.data))
+        for _ in range(count):
+            self.data.popitem(last=False)
+        if count:
+            METRICS.inc('tgdl_cache_evictions_total', count, cache=self.name, reason=reason)
+        return count
+
+    def expire(self) -> int:
+        if not self.ttl:
+            return 0
+        deadline = time.monotonic() - self.ttl
+        expired = [k for k, (_, stored_at) in self.data.items() if stored_at < deadline]
+        for k in expired:
+            del self.data[k]
+        if expired:
+            METRICS.inc('tgdl_cache_evictions_total', len(expired), cache=self.name, reason='ttl')
+        return len(expired)
+
+    def shrink(self, fraction: float) -> int:
+        return self.evict(int(len(self.data) * fraction), 'budget')
+
+class MemoryBudget:
+    """进程级内存预算与堆报告
+
+    BoundedCache 创建时自动登记；其他按设计有界的结构（进行中的下载、频道任务、重试堆等）用 watch 登记大小函数，
+    一并通过 tgdl_cache_entries 导出。定期清理过期条目；进程 RSS 超过 budget_mb 时按 shrink_fraction 收缩全部缓存并触发 gc。
+    启用堆报告（heap_report_seconds 或收到 SIGUSR2）后用 tracemalloc 记录分配，输出与上一快照的差异，
+    按子系统汇总：本程序按分配调用栈中最近的类或函数，第三方库与标准库按包名。
+    """
+    def __init__(self):
+        self.caches = weakref.WeakSet()
+        self.watches: dict[str, object] = {}
+        self.configure(ConfigManager.get_memory_settings({}))
+        self.snapshot = None
+        self.report_requested = asyncio.Event()
+        self._subsystems = None
+
+    def configure(self, settings: dict) -> None:
+        self.settings = settings
+        self.budget = settings['budget_mb'] * 1024 * 1024
+
+    def register(self, cache: BoundedCache) -> None:
+        self.caches.add(cache)
+
+    def watch(self, name: str, size) -> None:
+        self.watches[name] = size
+
+    def sizes(self) -> dict:
+        sizes: dict[str, int] = {}
+        for cache in list(self.caches):
+            sizes[cache.name] = sizes.get(cache.name, 0) + len(cache)
+        for name, size in list(self.watches.items()):
+            try:
+                sizes[name] = size()
+            except Exception as e:
+                logger.debug(f'统计 {name} 大小失败: {e}')
+        return sizes
+
+    def check(self) -> None:
+        for cache in list(self.caches):
+            cache.expire()
+        if not self.budget:
+            return
+        rss = psutil.Process().memory_info().rss
+        if rss <= self.budget:
+            return
+        METRICS.inc('tgdl_memory_budget_exceeded_total')
+        evicted = sum(cache.shrink(self.settings['shrink_fraction']) for cache in list(self.caches))
+        gc.collect()
+        logger.warning(f'进程内存 {rss / 1024 / 1024:.0f}MB 超过预算 {self.settings["budget_mb"]}MB，缓存淘汰 {evicted} 条，'
+                       f'回收后 {psutil.Process().memory_info().rss / 1024 / 1024:.0f}MB；各缓存条目数: {json.dumps(self.sizes(), ensure_ascii=False)}')
+
+    def request_report(self) -> None:
+        self.report_requested.set()
+
+    def _subsystem(self, filename: str, lineno: int) -> str:
+        if self._subsystems is None:
+            # 本文件顶层的类与函数（起始行, 结束行, 名称）
+            import ast
+            with open(__file__, 'r', encoding='utf-8') as f:
+                tree = ast.parse(f.read())
+            self._subsystems = sorted((n.lineno, n.end_lineno, n.name) for n in tree.body
+                                      if isinstance(n, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)))
+            self._starts = [s[0] for s in self._subsystems]
+        if os.path.abspath(filename) == os.path.abspath(__file__):
+            i = bisect.bisect_right(self._starts, lineno) - 1
+            if i >= 0 and lineno <= self._subsystems[i][1]:
+                return self._subsystems[i][2]
+            return '<module>'
+        for root in (sysconfig.get_paths()['purelib'], sysconfig.get_paths()['platlib'], sysconfig.get_paths()['stdlib']):
+            if filename.startswith(root + os.sep):
+                return f'[{os.path.relpath(filename, root).split(os.sep)[0].removesuffix(".py")}]'
+        return f'[{os.path.basename(filename)}]'
+
+    def _by_subsystem(self, snapshot) -> dict:
+        totals: dict[str, list] = {}
+        own = os.path.abspath(__file__)
+        for stat in snapshot.statistics('traceback'):
+            # 调用栈从最早到最近；归到最近的本程序帧（跳过通用的 BoundedCache，记到使用缓存的子系统），没有时取分配发生处
+            names = [self._subsystem(f.filename, f.lineno) for f in reversed(stat.traceback) if os.path.abspath(f.filename) == own]
+            name = next((n for n in names if n != 'BoundedCache'), names[0] if names else None)
+            if name is None:
+                name = self._subsystem(stat.traceback[-1].filename, stat.traceback[-1].lineno)
+            entry = totals.setdefault(name, [0, 0])
+            entry[0] += stat.size
+            entry[1] += stat.count
+        return totals
+
+    def heap_report(self) -> str:
+        """与上一快照比较，返回按子系统汇总的增长；首次调用时开始跟踪并记录基线"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.settings['tracemalloc_frames'])
+            self.snapshot = None
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        current = self._by_subsystem(snapshot)
+        previous, self.snapshot = self.snapshot, current
+        traced, peak = tracemalloc.get_traced_memory()
+        if previous is None:
+            return f'已开始 tracemalloc 跟踪（{self.settings["tracemalloc_frames"]} 帧），当前跟踪 {traced / 1024 / 1024:.1f}MB，下次报告输出与此基线的差异'
+        diffs = sorted(((name, size - previous.get(name, [0, 0])[0], count - previous.get(name, [0, 0])[1], size)
+                        for name, (size, count) in current.items()), key=lambda d: abs(d[1]), reverse=True)
+        lines = [f'{diff / 1024:+12.1f}KB {count:+9d} 块  共 {size / 1024 / 1024:8.2f}MB  {name}'
+                 for name, diff, count, size in diffs[:self.settings['heap_report_top']] if diff]
+        return (f'堆快照差异（跟踪 {traced / 1024 / 1024:.1f}MB，峰值 {peak / 1024 / 1024:.1f}MB）:\n' + '\n'.join(lines or ['  无变化'])
+                + f'\n各缓存条目数: {json.dumps(self.sizes(), ensure_ascii=False)}')
+
+    async def run(self) -> None:
+        interval = self.settings['heap_report_seconds']
+        if interval:
+            logger.info(await asyncio.to_thread(self.heap_report))
+        now = time.monotonic()
+        next_check, next_report = now + self.settings['check_seconds'], (now + interval if interval else None)
+        while True:
+            deadline = min(t for t in (next_check, next_report) if t is not None)
+            try:
+                await asyncio.wait_for(self.report_requested.wait(), timeout=max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+            now = time.monotonic()
+            if self.report_requested.is_set() or (next_report is not None and now >= next_report):
+                self.report_requested.clear()
+                logger.info(await asyncio.to_thread(self.heap_report))
+                if next_report is not None:
+                    next_report = now + interval
+            if now >= next_check:
+                self.check()
+                next_check = now + self.settings['check_seconds']
+
+MEMORY_BUDGET = MemoryBudget()
+
+class MetricsServer:
+    """轻量 HTTP 端点：/metrics 输出 Prometheus 文本格式，/healthz 输出健康状态"""
+    def __init__(self, settings: dict, metrics: Metrics, health):
+        self.host = settings['host']
+        self.port = settings['port']
+        self.metrics = metrics
+        self.health = health
+        self.server = None
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f'指标端点已启动: http://{self.host}:{self.port}/metrics')
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = (await asyncio.wait_for(reader.readline(), 10)).decode('latin-1').split()
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b'\r\n', b'\n', b''):
+                pass
+            path = request_line[1].split('?', 1)[0] if len(request_line) >= 2 else ''
+            if path == '/metrics':
+                status, ctype = '200 OK', 'text/plain; version=0.0.4; charset=utf-8'
+                body = self.metrics.render(await self.metrics.collect())
+            elif path == '/healthz':
+                healthy, detail = self.health()
+                status, ctype = ('200 OK' if healthy else '503 Service Unavailable'), 'application/json'
+                body = json.dumps(detail, ensure_ascii=False)
+            else:
+                status, ctype, body = '404 Not Found', 'text/plain', 'not found'
+            data = body.encode('utf-8')
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(data)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + data)
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f'处理指标请求失败: {e}')
+        finally:
+            writer.close()
+
+class ControlServer:
+    """本机控制接口（HTTP/JSON）：运行中增删、暂停与调整频道，查看队列；修改立即生效并写回配置文件
+
+    GET    /channels                      频道状态
+    POST   /channels                      添加频道 {"id": 频道ID}
+    DELETE /channels/<id>                 移除频道
+    POST   /channels/<id>/pause|resume    暂停/恢复抓取与下载（进行中的下载继续完成）
+    PATCH  /channels/<id>                 调整 {"weight": 权重, "max_concurrent_downloads": 并发}
+    POST   /channels/<id>/backfill        触发历史回溯 {"restart": 是否从最新消息重新开始}
+    GET    /queues                        各频道与重试队列、进行中的下载
+    """
+    def __init__(self, settings: dict, downloader: 'TelegramDownloader'):
+        self.host = settings['host']
+        self.port = settings['port']
+        self.token = settings['token']
+        self.downloader = downloader
+        self.server = None
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f'控制接口已启动: http://{self.host}:{self.port}/channels')
+
+    async def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def dispatch(self, method: str, path: str, body: dict) -> tuple:
+        """返回 (HTTP 状态码, 响应对象)"""
+        d = self.downloader
+        parts = [p for p in path.split('/') if p]
+        if parts == ['queues'] and method == 'GET':
+            return 200, await d.queue_status()
+        if parts == ['channels']:
+            if method == 'GET':
+                return 200, {'channels': [c.status() for c in d.controls.values()]}
+            if method == 'POST':
+                return 200, await d.add_channel(int(body['id']))
+        if len(parts) >= 2 and parts[0] == 'channels':
+            channel_id = int(parts[1])
+            if channel_id not in d.controls:
+                return 404, {'error': f'频道 {channel_id} 未在运行'}
+            action = parts[2] if len(parts) > 2 else ''
+            if method == 'DELETE' and not action:
+                return 200, await d.remove_channel(channel_id)
+            if method == 'PATCH' and not action:
+                return 200, await d.update_channel(channel_id, weight=body.get('weight'), limit=body.get('max_concurrent_downloads'))
+            if method == 'POST' and action in ('pause', 'resume'):
+                return 200, await d.update_channel(channel_id, paused=action == 'pause')
+            if method == 'POST' and action == 'backfill':
+                return 200, await d.trigger_backfill(channel_id, bool(body.get('restart', False)))
+        return 404, {'error': f'不支持的请求: {method} {path}'}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = (await asyncio.wait_for(reader.readline(), 10)).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length') or 0)
+            raw = await asyncio.wait_for(reader.readexactly(length), 10) if length else b''
+            method, path = (request_line[0], request_line[1].split('?', 1)[0]) if len(request_line) >= 2 else ('', '')
+            if self.token and headers.get('authorization') != f'Bearer {self.token}':
+                status, result = 401, {'error': '未授权'}
+            else:
+                try:
+                    status, result = await self.dispatch(method, path, json.loads(raw) if raw else {})
+                except (ValueError, KeyError, TypeError) as e:
+                    status, result = 400, {'error': f'请求参数错误: {e}'}
+                except Exception as e:
+                    logger.error(f'处理控制请求失败 {method} {path}: {e}')
+                    status, result = 500, {'error': str(e)}
+            data = json.dumps(result, ensure_ascii=False).encode('utf-8')
+            reason = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+            writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: application/json; charset=utf-8\r\nContent-Length: {len(data)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode('latin-1') + data)
+            await writer.drain()
+        except Exception as e:
+            logger.debug(f'处理控制请求失败: {e}')
+        finally:
+            writer.close()
+
+class MessageTrace:
+    """单条消息的追踪：从抓取开始，依次记录各阶段耗时（墙钟时间戳，秒）"""
+    __slots__ = ('trace_id', 'channel_id', 'message_id', 'start', 'spans', 'attributes')
+
+    def __init__(self, channel_id: int, message_id: int, start: float):
+        self.trace_id = os.urandom(16).hex()
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.start = start
+        # [(阶段名, 开始, 结束, 属性)]
+        self.spans: list = []
+        self.attributes: dict = {}
+
+    def add(self, name: str, start: float, end: float, **attributes) -> None:
+        self.spans.append((name, start, end, attributes))
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.time(), **attributes)
+
+class Tracer:
+    """逐消息流水线追踪，定位文件晚到的时间花在哪个阶段
+
+    阶段：fetch（抓取轮次开始到收到该消息）、filter（分类）、deeplink（机器人深链解析）、
+    queue_wait（排队等待下载名额）、download（传输）、finalize（落地与清单）、state_commit（进度写入）。
+    按 sample_rate 在抓取时决定是否采样，未采样的消息不产生任何记录；
+    每条追踪在结束时写一行到 JSONL 文件，format 为 otlp 时写 OTLP/JSON（ExportTraceServiceRequest，与 OpenTelemetry Collector 文件导出格式相同）。
+    """
+    FORMATS = ('jsonl', 'otlp')
+    STAGES = ('fetch', 'filter', 'deeplink', 'queue_wait', 'download', 'finalize', 'state_commit')
+
+    def __init__(self, settings: dict | None = None):
+        self.enabled = False
+        self.file = None
+        if settings:
+            self.configure(settings)
+
+    def configure(self, settings: dict) -> None:
+        self.close()
+        self.enabled = bool(settings.get('enabled')) and settings.get('sample_rate', 1.0) > 0
+        self.sample_rate = settings.get('sample_rate', 1.0)
+        self.include_skipped = bool(settings.get('include_skipped'))
+        self.format = settings.get('format', 'jsonl')
+        if self.format not in Tracer.FORMATS:
+            raise ValueError(f'不支持的追踪格式: {self.format}')
+        self.path = settings.get('path', '')
+        if self.enabled:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            # 行缓冲：每条追踪一次写入，进程异常退出时最多丢失正在进行的追踪
+            self.file = open(self.path, 'a', encoding='utf-8', buffering=1)
+            logger.info(f'已启用逐消息追踪: {self.path}（{self.format}，采样率 {self.sample_rate}）')
+
+    def start(self, channel_id: int, message_id: int, start: float) -> MessageTrace | None:
+        if not self.enabled or (self.sample_rate < 1.0 and random.random() >= self.sample_rate):
+            return None
+        return MessageTrace(channel_id, message_id, start)
+
+    def finish(self, trace: MessageTrace | None, skipped: bool = False, **attributes) -> None:
+        """结束追踪并导出；未进入下载队列的消息只在 include_skipped 时导出"""
+        if trace is None or self.file is None or (skipped and not self.include_skipped):
+            return
+        trace.attributes.update(attributes)
+        encode = self._otlp if self.format == 'otlp' else self._jsonl
+        self.file.write(json.dumps(encode(trace), ensure_ascii=False) + '\n')
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    @staticmethod
+    def _jsonl(trace: MessageTrace) -> dict:
+        end = max([trace.start] + [s[2] for s in trace.spans])
+        return {
+            'trace_id': trace.trace_id,
+            'channel_id': trace.channel_id,
+            'message_id': trace.message_id,
+            'start': round(trace.start, 6),
+            'duration': round(end - trace.start, 6),
+            'attributes': trace.attributes,
+            'spans': [
+                {'name': name, 'start': round(start, 6), 'duration': round(end - start, 6), **({'attributes': attrs} if attrs else {})}
+                for name, start, end, attrs in trace.spans
+            ]
+        }
+
+    @staticmethod
+    def _otlp_attributes(attributes: dict) -> list:
+        out = []
+        for key, value in attributes.items():
+            if isinstance(value, bool):
+                v = {'boolValue': value}
+            elif isinstance(value, int):
+                v = {'intValue': str(value)}
+            elif isinstance(value, float):
+                v = {'doubleValue': value}
+            else:
+                v = {'stringValue': str(value)}
+            out.append({'key': key, 'value': v})
+        return out
+
+    @staticmethod
+    def _otlp(trace: MessageTrace) -> dict:
+        root_id = os.urandom(8).hex()
+        end = max([trace.start] + [s[2] for s in trace.spans])
+        root = {
+            'traceId': trace.trace_id, 'spanId': root_id, 'name': 'message', 'kind': 1,
+            'startTimeUnixNano': str(int(trace.start * 1e9)), 'endTimeUnixNano': str(int(end * 1e9)),
+            'attributes': Tracer._otlp_attributes({'tgdl.channel_id': trace.channel_id, 'tgdl.message_id': trace.message_id, **trace.attributes})
+        }
+        spans = [root] + [{
+            'traceId': trace.trace_id, 'spanId': os.urandom(8).hex(), 'parentSpanId': root_id, 'name': name, 'kind': 1,
+            'startTimeUnixNano': str(int(start * 1e9)), 'endTimeUnixNano': str(int(stop * 1e9)),
+            'attributes': Tracer._otlp_attributes(attrs)
+        } for name, start, stop, attrs in trace.spans]
+        return {'resourceSpans': [{
+            'resource': {'attributes': Tracer._otlp_attributes({'service.name': 'tlgspider'})},
+            'scopeSpans': [{'scope': {'name': 'tgdl'}, 'spans': spans}]
+        }]}
+
+    @staticmethod
+    def read_durations(path: str) -> dict:
+        """读取追踪文件（jsonl 或 otlp），返回 {阶段: [每条消息该阶段的总耗时秒数]}，total 为整条追踪耗时"""
+        durations: dict[str, list] = {}
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                stages: dict[str, float] = {}
+                if 'resourceSpans' in record:
+                    for rs in record['resourceSpans']:
+                        for ss in rs.get('scopeSpans', []):
+                            for span in ss.get('spans', []):
+                                name = 'total' if not span.get('parentSpanId') else span['name']
+                                seconds = (int(span['endTimeUnixNano']) - int(span['startTimeUnixNano'])) / 1e9
+                                stages[name] = stages.get(name, 0.0) + seconds
+                else:
+                    stages['total'] = record['duration']
+                    for span in record['spans']:
+                        stages[span['name']] = stages.get(span['name'], 0.0) + span['duration']
+                for name, seconds in stages.items():
+                    durations.setdefault(name, []).append(seconds)
+        return durations
+
+    @staticmethod
+    def summarize(path: str) -> str:
+        """各阶段 p50/p95/p99（最近秩百分位）"""
+        durations = Tracer.read_durations(path)
+        order = [s for s in Tracer.STAGES if s in durations] + sorted(set(durations) - set(Tracer.STAGES) - {'total'})
+        if 'total' in durations:
+            order.append('total')
+        lines = [f'{"stage":<14}{"count":>8}{"p50":>10}{"p95":>10}{"p99":>10}{"max":>10}  （秒）']
+        for name in order:
+            values = sorted(durations[name])
+            pct = lambda p: values[max(math.ceil(p * len(values)) - 1, 0)]
+            lines.append(f'{name:<14}{len(values):>8}{pct(0.5):>10.3f}{pct(0.95):>10.3f}{pct(0.99):>10.3f}{values[-1]:>10.3f}')
+        return '\n'.join(lines)
+
+TRACER = Tracer()
+
+class LoopLagMonitor:
+    """事件循环卡顿监测
+
+    循环内协程按固定间隔打心跳并记录调度延迟；看门狗线程发现心跳停滞超过阈值时，
+    抓取事件循环线程当前的调用栈（即正占用循环的回调），并按调用点累计阻塞时长。
+    """
+    def __init__(self, threshold: float = 0.1, interval: float = 0.05):
+        self.threshold = threshold
+        self.interval = interval
+        self.loop_thread_id = None
+        self.last_tick = time.monotonic()
+        # 调用点 -> [卡顿次数, 累计阻塞秒数]
+        self.sites: dict[str, list] = {}
+        self.max_lag = 0.0
+        self.stopped = threading.Event()
+
+    async def run(self) -> None:
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        threading.Thread(target=self._watch, name='loop-lag-watchdog', daemon=True).start()
+        try:
+            while True:
+                expected = time.monotonic() + self.interval
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                lag = max(now - expected, 0.0)
+                self.max_lag = max(self.max_lag, lag)
+                METRICS.observe('tgdl_loop_lag_seconds', lag)
+                self.last_tick = now
+        finally:
+            self.stopped.set()
+
+    @staticmethod
+    def _site(stack: traceback.StackSummary) -> str:
+        """调用点取最内层的本程序帧，阻塞发生在库函数内时附上最内层帧"""
+        inner = stack[-1]
+        own = next((f for f in reversed(stack) if os.path.abspath(f.filename) == os.path.abspath(__file__)), inner)
+        site = f'{os.path.basename(own.filename)}:{own.lineno} {own.name}'
+        if own is not inner:
+            site += f' -> {os.path.basename(inner.filename)}:{inner.lineno} {inner.name}'
+        return site
+
+    def _watch(self) -> None:
+        stall_tick = None
+        last_sample = 0.0
+        while not self.stopped.wait(self.threshold / 2):
+            now = time.monotonic()
+            tick = self.last_tick
+            stalled = now - tick - self.interval
+            if stalled < self.threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            del frame
+            # 去掉 asyncio 调度框架自身的帧，只保留正在运行的回调
+            start = max((i + 1 for i, f in enumerate(stack) if f.name == '_run' and f.filename.endswith(os.path.join('asyncio', 'events.py'))), default=0)
+            stack = traceback.StackSummary.from_list(stack[start:] or stack)
+            entry = self.sites.setdefault(self._site(stack), [0, 0.0])
+            if stall_tick != tick:
+                # 新的一次卡顿：输出调用栈，阻塞时长从心跳停止时算起
+                stall_tick = tick
+                entry[0] += 1
+                entry[1] += stalled
+                logger.warning(f'事件循环被阻塞 {stalled * 1000:.0f}ms，当前调用栈:\n' + ''.join(traceback.format_list(stack[-12:])).rstrip())
+            else:
+                entry[1] += now - last_sample
+            last_sample = now
+
+    def log_summary(self, top: int = 10) -> None:
+        logger.info(f'事件循环最大调度延迟: {self.max_lag * 1000:.0f}ms')
+        if not self.sites:
+            logger.info(f'未发现超过 {self.threshold * 1000:.0f}ms 的事件循环阻塞')
+            return
+        ranked = sorted(self.sites.items(), key=lambda kv: kv[1][1], reverse=True)[:top]
+        lines = [f'{seconds:8.2f}s {count:5d} 次  {site}' for site, (count, seconds) in ranked]
+        logger.info('阻塞事件循环最多的调用点（累计时长 / 次数）:\n' + '\n'.join(lines))
+
+class CoroutineProfiler:
+    """--profile 模式下可选的函数级分析，收到 SIGUSR1 或退出时导出到 data/profiles
+
+    yappi 使用墙钟并按 asyncio 任务名打标签，可按协程（频道任务）分别查看；
+    cProfile 只统计事件循环线程的整体耗时。
+    """
+    ENGINES = ('cprofile', 'yappi')
+
+    def __init__(self, engine: str, out_dir: str = os.path.join(DATA_DIR, 'profiles')):
+        if engine not in CoroutineProfiler.ENGINES:
+            raise ValueError(f'不支持的分析器: {engine}')
+        self.engine = engine
+        self.out_dir = out_dir
+        self.tags: dict[str, int] = {}
+        self.profile = None
+        self.yappi = None
+
+    def _tag(self) -> int:
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            return 0
+        if task is None:
+            return 0
+        return self.tags.setdefault(task.get_name(), len(self.tags) + 1)
+
+    def start(self) -> None:
+        os.makedirs(self.out_dir, exist_ok=True)
+        if self.engine == 'yappi':
+            try:
+                import yappi
+            except ImportError as e:
+                raise RuntimeError('使用 yappi 分析需要安装 yappi: pip install yappi') from e
+            self.yappi = yappi
+            yappi.set_clock_type('wall')
+            yappi.set_tag_callback(self._tag)
+            yappi.start()
+        else:
+            import cProfile
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        logger.info(f'已启用 {self.engine} 分析，发送 SIGUSR1 导出到 {self.out_dir}')
+
+    def dump(self) -> str:
+        path = os.path.join(self.out_dir, f'{self.engine}-{time.strftime("%Y%m%d-%H%M%S")}')
+        if self.yappi is not None:
+            self.yappi.get_func_stats().save(path + '.pstat', type='pstat')
+            columns = {0: ('name', 90), 1: ('ncall', 10), 2: ('tsub', 10), 3: ('ttot', 10)}
+            with open(path + '.txt', 'w', encoding='utf-8') as f:
+                for name, tag in sorted(self.tags.items(), key=lambda kv: kv[1]):
+                    task_stats = self.yappi.get_func_stats(tag=tag)
+                    if task_stats.empty():
+                        continue
+                    f.write(f'=== 任务 {name} ===\n')
+                    task_stats.sort('ttot').print_all(out=f, columns=columns)
+                    f.write('\n')
+        else:
+            self.profile.disable()
+            try:
+                self.profile.dump_stats(path + '.pstat')
+                import pstats
+                with open(path + '.txt', 'w', encoding='utf-8') as f:
+                    pstats.Stats(self.profile, stream=f).sort_stats('cumulative').print_stats(80)
+            finally:
+                self.profile.enable()
+        return path + '.pstat'
+
+    def stop(self) -> str:
+        path = self.dump()
+        if self.yappi is not None:
+            self.yappi.stop()
+        else:
+            self.profile.disable()
+        return path
+
+class TokenBucket:
+    """令牌桶：按 rate（每秒令牌数）匀速补充，最多累积 burst 个令牌"""
+    def __init__(self, rate: float, burst: float):
+        self.rate = float(rate)
+        self.capacity = max(float(burst), 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        if self.rate > 0:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds: float) -> None:
+        """暂停发放令牌，直到 seconds 秒之后"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, amount: float = 1.0) -> float:
+        """获取令牌，返回因限流或暂停而等待的秒数"""
+        waited = 0.0
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    if self.rate <= 0:
+                        return waited
+                    self._refill(now)
+                    if self.tokens >= amount:
+                        self.tokens -= amount
+                        return waited
+                    delay = (min(amount, self.capacity) - self.tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+class BandwidthShaper:
+    """下载带宽整形：全局与各频道各一个字节令牌桶，在下载数据路径上按收到的字节数取令牌
+
+    限速单位为 Mbps（兆比特每秒），0 表示不限；schedule 中按一天内的时间段覆盖限速。
+    令牌桶容量为 burst_seconds 秒的流量，每收到一块数据（最大 512KB）就按块大小等待，速率平滑而不是时断时续。
+    同一处也统计下载字节数，供吞吐指标与自适应并发使用。
+    """
+    # telethon 单次请求的最大分块，令牌桶容量至少为一块
+    CHUNK = 512 * 1024
+
+    def __init__(self, settings: dict, concurrency: 'AdaptiveConcurrencyController | None' = None):
+        self.settings = settings
+        self.concurrency = concurrency
+        self.global_bucket = TokenBucket(0, self.CHUNK)
+        self.channel_buckets: dict[int, TokenBucket] = {}
+        self.limits = (0.0, 0.0)
+        self.apply_schedule()
+
+    @staticmethod
+    def _minutes(hhmm: str) -> int:
+        hours, _, minutes = str(hhmm).partition(':')
+        return int(hours) * 60 + int(minutes or 0)
+
+    def current_limits(self, now: time.struct_time | None = None) -> tuple:
+        """返回当前生效的 (全局 Mbps, 频道默认 Mbps)：第一个匹配的时间段优先，否则为默认值"""
+        now = now or time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for window in self.settings['schedule']:
+            if window.get('days') is not None and now.tm_wday not in window['days']:
+                continue
+            start, end = self._minutes(window.get('start', '00:00')), self._minutes(window.get('end', '24:00'))
+            # start 晚于 end 表示跨越午夜的时间段
+            inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if inside:
+                return (float(window.get('global_mbps', self.settings['global_mbps'])),
+                        float(window.get('channel_mbps', self.settings['channel_mbps'])))
+        return float(self.settings['global_mbps']), float(self.settings['channel_mbps'])
+
+    def _channel_mbps(self, channel_id: int) -> float:
+        override = self.settings['channels'].get(str(channel_id))
+        return float(override) if override is not None else self.limits[1]
+
+    def _configure(self, bucket: TokenBucket, mbps: float) -> None:
+        rate = mbps * 1000 * 1000 / 8
+        bucket.rate = rate
+        bucket.capacity = max(rate * self.settings['burst_seconds'], self.CHUNK)
+        bucket.tokens = min(bucket.tokens, bucket.capacity)
+
+    def apply_schedule(self) -> None:
+        limits = self.current_limits()
+        if limits == self.limits:
+            return
+        logger.info(f'下载带宽限制: 全局 {limits[0] or "不限"} Mbps，单频道 {limits[1] or "不限"} Mbps')
+        self.limits = limits
+        self._configure(self.global_bucket, limits[0])
+        for channel_id, bucket in self.channel_buckets.items():
+            self._configure(bucket, self._channel_mbps(channel_id))
+
+    def _bucket(self, channel_id: int) -> TokenBucket:
+        bucket = self.channel_buckets.get(channel_id)
+        if bucket is None:
+            bucket = self.channel_buckets[channel_id] = TokenBucket(0, self.CHUNK)
+            self._configure(bucket, self._channel_mbps(channel_id))
+        return bucket
+
+    async def consume(self, channel_id: int | None, n: int) -> None:
+        """记录收到的 n 字节，并在超出限速时等待相应的时间"""
+        if n <= 0:
+            return
+        METRICS.inc('tgdl_download_bytes_total', n)
+        if self.concurrency:
+            self.concurrency.record_bytes(n)
+        scopes = [('global', self.global_bucket)]
+        if channel_id is not None:
+            scopes.insert(0, ('channel', self._bucket(channel_id)))
+        for scope, bucket in scopes:
+            if bucket.rate <= 0:
+                continue
+            remaining = n
+            while remaining > 0:
+                # 单次取令牌不超过桶容量，否则永远取不到
+                amount = min(remaining, bucket.capacity)
+                waited = await bucket.acquire(amount)
+                if waited:
+                    METRICS.inc('tgdl_bandwidth_throttled_seconds_total', waited, scope=scope)
+                remaining -= amount
+
+    async def run(self) -> None:
+        """按时间段切换限速"""
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=30)
+            except asyncio.TimeoutError:
+                self.apply_schedule()
+
+class ApiRateLimiter:
+    """所有协程共享的 API 限流器，按方法类别（history/entity/send/download/request）各自维护令牌桶
+
+    遇到 FloodWaitError 时只暂停对应类别，等待结束后自动恢复，其他类别不受影响。
+    """
+    def __init__(self, settings: dict):
+        self.enabled = settings.get('enabled', True)
+        self.buckets: dict[str, TokenBucket] = {}
+        for name, spec in (settings.get('methods') or {}).items():
+            self.buckets[name] = TokenBucket(spec.get('rate', 1.0), spec.get('burst', 1))
+        self.counters: dict[str, dict] = {}
+        self.flood_listeners: list = []
+
+    def add_flood_listener(self, listener) -> None:
+        """注册 FloodWait 回调，签名为 listener(method_class, seconds)"""
+        self.flood_listeners.append(listener)
+
+    def _counter(self, method_class: str) -> dict:
+        return self.counters.setdefault(method_class, {
+            'calls': 0,
+            'flood_waits': 0,
+            'flood_wait_seconds': 0.0,
+            'throttled_seconds': 0.0
+        })
+
+    def _bucket(self, method_class: str) -> TokenBucket:
+        if method_class not in self.buckets:
+            self.buckets[method_class] = TokenBucket(0, 1)
+        return self.buckets[method_class]
+
+    async def acquire(self, method_class: str) -> None:
+        counter = self._counter(method_class)
+        counter['calls'] += 1
+        if not self.enabled:
+            return
+        waited = await self._bucket(method_class).acquire()
+        counter['throttled_seconds'] += waited
+
+    def on_flood_wait(self, method_class: str, seconds: int) -> None:
+        counter = self._counter(method_class)
+        counter['flood_waits'] += 1
+        counter['flood_wait_seconds'] += seconds
+        METRICS.inc('tgdl_flood_waits_total', method=method_class)
+        METRICS.inc('tgdl_flood_wait_seconds_total', seconds, method=method_class)
+        self._bucket(method_class).pause(seconds)
+        logger.warning(f'API 限流: {method_class} 类请求触发 FloodWait，暂停 {seconds} 秒')
+        for listener in self.flood_listeners:
+            try:
+                listener(method_class, seconds)
+            except Exception as e:
+                logger.debug(f'FloodWait 回调出错: {e}')
+
+    async def call(self, method_class: str, func, *args, **kwargs):
+        """在限流下执行协程函数；触发 FloodWait 时暂停该类别并在等待结束后重试"""
+        while True:
+            await self.acquire(method_class)
+            start = time.monotonic()
+            try:
+                return await func(*args, **kwargs)
+            except tg_errors.FloodWaitError as e:
+                self.on_flood_wait(method_class, e.seconds)
+            finally:
+                # 文件传输耗时单独由下载耗时直方图统计
+                if method_class != 'download':
+                    METRICS.observe('tgdl_api_call_seconds', time.monotonic() - start, method=method_class)
+
+    # GetHistory 等分页请求每次最多返回的消息数
+    PAGE_SIZE = 100
+
+    async def iterate(self, method_class: str, func, *args, **kwargs):
+        """在限流下执行异步迭代（如 iter_messages），每页请求取一次令牌；FloodWait 后以最后产出的消息ID为 offset_id 续传
+
+        不按 ids 获取时以不超过一页的 limit 分段调用，后一段以上一段最后产出的消息ID为 offset_id，
+        Telethon 内部的多页请求因此逐页经过限流，而不是整个迭代只取一次令牌。
+        """
+        limit = kwargs.get('limit')
+        paged = kwargs.get('ids') is None
+        yielded = 0
+        while True:
+            if paged:
+                if limit is not None and yielded >= limit:
+                    return
+                kwargs['limit'] = ApiRateLimiter.PAGE_SIZE if limit is None else min(ApiRateLimiter.PAGE_SIZE, limit - yielded)
+            await self.acquire(method_class)
+            # 只累计等待下一条结果的时间，不含调用方处理每条消息的时间
+            elapsed = 0.0
+            count = 0
+            start = time.monotonic()
+            try:
+                async for item in func(*args, **kwargs):
+                    elapsed += time.monotonic() - start
+                    yielded += 1
+                    count += 1
+                    yield item
+                    start = time.monotonic()
+                    kwargs['offset_id'] = getattr(item, 'id', kwargs.get('offset_id', 0))
+                elapsed += time.monotonic() - start
+                METRICS.observe('tgdl_api_call_seconds', elapsed, method=method_class)
+                # 不足一页说明已取完（或到达 min_id）
+                if not paged or count < kwargs['limit']:
+                    return
+            except tg_errors.FloodWaitError as e:
+                self.on_flood_wait(method_class, e.seconds)
+                if limit is not None and not paged:
+                    kwargs['limit'] = limit - yielded
+                    if kwargs['limit'] <= 0:
+                        return
+
+    def stats(self) -> dict:
+        """导出各类别的调用次数、FloodWait 次数与累计等待时长"""
+        return {
+            name: {
+                'calls': c['calls'],
+                'flood_waits': c['flood_waits'],
+                'flood_wait_seconds': round(c['flood_wait_seconds'], 3),
+                'throttled_seconds': round(c['throttled_seconds'], 3)
+            }
+            for name, c in self.counters.items()
+        }
+
+class RateLimitedClient:
+    """TelegramClient 代理：常用方法经 ApiRateLimiter 限流，其余属性透传给原始客户端"""
+    def __init__(self, client, limiter: ApiRateLimiter):
+        self._client = client
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def iter_messages(self, *args, **kwargs):
+        return self.limiter.iterate('history', self._client.iter_messages, *args, **kwargs)
+
+    async def get_messages(self, *args, **kwargs):
+        return await self.limiter.call('history', self._client.get_messages, *args, **kwargs)
+
+    async def get_entity(self, *args, **kwargs):
+        return await self.limiter.call('entity', self._client.get_entity, *args, **kwargs)
+
+    async def send_message(self, *args, **kwargs):
+        return await self.limiter.call('send', self._client.send_message, *args, **kwargs)
+
+    async def download_media(self, *args, **kwargs):
+        return await self.limiter.call('download', self._client.download_media, *args, **kwargs)
+
+    async def download_file(self, *args, **kwargs):
+        # 传输中途的 FloodWait 不能原样重试（已写入的数据会重复），暂停该类别后抛给调用方按偏移续传
+        await self.limiter.acquire('download')
+        try:
+            return await self._client.download_file(*args, **kwargs)
+        except tg_errors.FloodWaitError as e:
+            self.limiter.on_flood_wait('download', e.seconds)
+            raise
+
+    async def iter_download(self, *args, **kwargs):
+        await self.limiter.acquire('download')
+        try:
+            async for chunk in self._client.iter_download(*args, **kwargs):
+                yield chunk
+        except tg_errors.FloodWaitError as e:
+            self.limiter.on_flood_wait('download', e.seconds)
+            raise
+
+    async def __call__(self, request, *args, **kwargs):
+        return await self.limiter.call('request', self._client, request, *args, **kwargs)
+
+class ClientPool:
+    """多账号会话池：按频道成员关系与当前负载为频道分配客户端，下载失败时可切换到其他成员账号
+
+    每个账号各自持有 RateLimitedClient 与独立的 ApiRateLimiter。
+    """
+    def __init__(self):
+        self.names: list[str] = []
+        self.clients: list[RateLimitedClient] = []
+        self.load: list[int] = []
+        self.members: dict[int, list[int]] = {}
+        self.entities: dict[tuple[int, int], object] = {}
+        self.assignments: dict[int, int] = {}
+
+    def add(self, name: str, client: RateLimitedClient) -> None:
+        self.names.append(name)
+        self.clients.append(client)
+        self.load.append(0)
+
+    @property
+    def primary(self) -> RateLimitedClient:
+        return self.clients[0]
+
+    async def resolve_members(self, channel_id: int) -> list:
+        """返回能访问该频道的账号下标列表（结果缓存）"""
+        if channel_id in self.members:
+            return self.members[channel_id]
+        members = []
+        for idx, client in enumerate(self.clients):
+            try:
+                entity = await client.get_entity(channel_id)
+                if getattr(entity, 'left', False):
+                    continue
+                self.entities[(idx, channel_id)] = entity
+                members.append(idx)
+            except Exception as e:
+                logger.debug(f'账号 {self.names[idx]} 无法访问频道 {channel_id}: {e}')
+        self.members[channel_id] = members
+        return members
+
+    async def assign(self, channel_id: int) -> tuple:
+        """为频道选择负载最低的成员账号，返回 (账号下标, 客户端, 频道实体)；无成员账号时返回 (None, None, None)"""
+        if channel_id in self.assignments:
+            idx = self.assignments[channel_id]
+            return idx, self.clients[idx], self.entities[(idx, channel_id)]
+        members = await self.resolve_members(channel_id)
+        if not members:
+            return None, None, None
+        idx = min(members, key=lambda i: self.load[i])
+        self.assignments[channel_id] = idx
+        self.load[idx] += 1
+        logger.info(f'频道 {channel_id} 分配给账号 {self.names[idx]}（当前负载 {self.load[idx]}）')
+        return idx, self.clients[idx], self.entities[(idx, channel_id)]
+
+    def failover_candidates(self, channel_id: int) -> list:
+        """除已分配账号外的其他成员账号，按负载从低到高排列"""
+        assigned = self.assignments.get(channel_id)
+        others = [i for i in self.members.get(channel_id, []) if i != assigned]
+        return sorted(others, key=lambda i: self.load[i])
+
+    def stats(self) -> dict:
+        return {
+            name: {'load': self.load[idx], 'rate_limit': self.clients[idx].limiter.stats()}
+            for idx, name in enumerate(self.names)
+        }
+
+class AdaptiveConcurrencyController:
+    """仿 TCP 拥塞控制（AIMD）的全局下载并发控制器
+
+    按周期统计全部下载的总吞吐：吞吐持续提升且并发已用满时加性增加并发上限；
+    遇到 FloodWait、超时或并发用满时吞吐明显退化时乘性减少。上限始终保持在 [min_concurrency, max_concurrency] 内。
+    """
+    def __init__(self, settings: dict, initial: int):
+        self.min_concurrency = settings['min_concurrency']
+        self.max_concurrency = settings['max_concurrency']
+        self.interval = settings['interval_seconds']
+        self.increase_step = settings['increase_step']
+        self.decrease_factor = settings['decrease_factor']
+        self.improve_threshold = settings['improve_threshold']
+        self.regression_threshold = settings['regression_threshold']
+        self.limit = min(max(settings.get('initial_concurrency') or initial, self.min_concurrency), self.max_concurrency)
+        self.active = 0
+        self.window_bytes = 0
+        self.window_peak_active = 0
+        self.last_rate = 0.0
+        # 减少后的两个周期（跨越调整点的周期与其后一个完整周期）只重新建立吞吐基线，不做调整
+        self.cooldown_ticks = 0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+            self.window_peak_active = max(self.window_peak_active, self.active)
+
+    async def release(self) -> None:
+        async with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    def record_bytes(self, n: int) -> None:
+        if n > 0:
+            self.window_bytes += n
+
+    async def _increase(self, reason: str) -> None:
+        if self.limit >= self.max_concurrency:
+            return
+        new_limit = min(self.max_concurrency, self.limit + self.increase_step)
+        logger.info(f'自适应并发: {reason}，并发上限 {self.limit} -> {new_limit}')
+        async with self.cond:
+            self.limit = new_limit
+            self.cond.notify_all()
+
+    def _decrease(self, reason: str) -> None:
+        new_limit = max(self.min_concurrency, int(self.limit * self.decrease_factor))
+        if new_limit != self.limit:
+            logger.info(f'自适应并发: {reason}，并发上限 {self.limit} -> {new_limit}')
+            self.limit = new_limit
+        else:
+            logger.info(f'自适应并发: {reason}，并发上限已是下限 {self.limit}')
+        self.cooldown_ticks = 2
+
+    def on_congestion(self, reason: str) -> None:
+        """FloodWait、超时等拥塞信号：立即乘性减少"""
+        self._decrease(reason)
+
+    def on_flood_wait(self, method_class: str, seconds: int) -> None:
+        if method_class == 'download':
+            self.on_congestion(f'下载触发 FloodWait {seconds} 秒')
+
+    async def tick(self) -> None:
+        """结束一个采样周期并根据吞吐调整并发上限"""
+        rate = self.window_bytes / self.interval
+        saturated = self.window_peak_active >= self.limit
+        self.window_bytes = 0
+        self.window_peak_active = self.active
+        rate_mb = rate / 1024 / 1024
+        if self.cooldown_ticks > 0:
+            self.cooldown_ticks -= 1
+            logger.debug(f'自适应并发: 重新建立吞吐基线 {rate_mb:.2f}MB/s，并发上限 {self.limit}')
+            if self.cooldown_ticks == 0 and saturated:
+                # 基线建立后试探性增加一次，若吞吐随之提升则继续加性增加
+                await self._increase(f'基线 {rate_mb:.2f}MB/s 建立后试探')
+        elif saturated and self.last_rate > 0 and rate < self.last_rate * (1 - self.regression_threshold):
+            self._decrease(f'吞吐退化 {self.last_rate / 1024 / 1024:.2f} -> {rate_mb:.2f}MB/s')
+        elif saturated and rate > self.last_rate * (1 + self.improve_threshold):
+            await self._increase(f'吞吐提升至 {rate_mb:.2f}MB/s')
+        else:
+            logger.debug(f'自适应并发: 吞吐 {rate_mb:.2f}MB/s，保持并发上限 {self.limit}（活跃 {self.active}）')
+        # 并发未用满时吞吐下降只说明待下载的任务不够（一批下载结束、频道空闲），不作为比较基线
+        if saturated:
+            self.last_rate = rate
+
+    async def run(self) -> None:
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                await self.tick()
+
+class ChannelControl:
+    """运行中频道的可调参数：暂停、下载并发与权重（轮询新消息的频率倍数），修改后立即对该频道生效
+
+    同时充当该频道实时下载的并发限制（代替固定的 Semaphore），暂停时排队中的下载不再开始，进行中的下载继续完成。
+    """
+    def __init__(self, channel_id: int, limit: int, weight: float = 1.0, paused: bool = False):
+        self.channel_id = channel_id
+        self.limit = max(int(limit), 1)
+        self.weight = max(float(weight), 0.01)
+        self.paused = paused
+        self.active = 0
+        self.queued = 0
+        self.title = str(channel_id)
+        self.client = None
+        self.entity = None
+        self.backfill_task = None
+        self.cond = asyncio.Condition()
+        # 打断轮询等待，使恢复、调整权重后立即重新抓取
+        self.wake = asyncio.Event()
+
+    async def __aenter__(self):
+        self.queued += 1
+        try:
+            async with self.cond:
+                await self.cond.wait_for(lambda: not self.paused and self.active < self.limit)
+                self.active += 1
+        finally:
+            self.queued -= 1
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        async with self.cond:
+            self.active -= 1
+            self.cond.notify_all()
+
+    async def wait_running(self) -> None:
+        async with self.cond:
+            await self.cond.wait_for(lambda: not self.paused)
+
+    async def update(self, paused: bool | None = None, limit: int | None = None, weight: float | None = None) -> None:
+        async with self.cond:
+            if paused is not None:
+                self.paused = paused
+            if limit is not None:
+                self.limit = max(int(limit), 1)
+            if weight is not None:
+                self.weight = max(float(weight), 0.01)
+            self.cond.notify_all()
+        self.wake.set()
+
+    async def sleep(self, seconds: float) -> None:
+        """等待轮询间隔（按权重缩短或延长），被 update 打断时提前返回"""
+        self.wake.clear()
+        try:
+            await asyncio.wait_for(self.wake.wait(), timeout=seconds / self.weight)
+        except asyncio.TimeoutError:
+            pass
+
+    def settings(self) -> dict:
+        return {'paused': self.paused, 'weight': self.weight, 'max_concurrent_downloads': self.limit}
+
+    def status(self) -> dict:
+        return {
+            'id': self.channel_id, 'title': self.title, **self.settings(), 'active': self.active, 'queued': self.queued,
+            'backfill_running': self.backfill_task is not None and not self.backfill_task.done(),
+            'backfill': StateManager.get_backfill(self.channel_id), 'last_id': StateManager.get_last_id(self.channel_id),
+        }
+
+class MessageClassifier:
+    """消息分类与链接提取（CPU 密集部分）
+
+    workers 为 0 时在事件循环线程内执行；大于 0 时把 MessageDescriptor 分批交给进程池，
+    避免深度回溯时正则匹配占满事件循环、拖慢下载回调。
+    """
+    def __init__(self, media_types: list, config: dict, workers: int = 0, batch_size: int = 256):
+        self.media_types = media_types
+        self.config = config
+        self.batch_size = max(batch_size, 1)
+        # 子进程在首次提交时才创建，此时已有 to_thread 工作线程、事件循环监视线程与 SQLite 连接；
+        # fork 会复制其他线程持有的锁（如日志锁）而死锁，改用 spawn 重新导入本模块（导入无副作用）
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) if workers > 0 else None
+        self.recorder: TraceRecorder | None = None
+
+    @staticmethod
+    def classify(desc: MessageDescriptor, media_types: list, config: dict) -> dict:
+        if not desc.has_document:
+            skip_reason = 'no_media'
+        elif not desc.filename:
+            skip_reason = 'no_filename'
         else:
-            logger.info(f'新文件质量不满足替换要求，跳过下载: {save_path}')
-        return should_replace
+            skip_reason = MediaValidator.skip_reason(desc.id, desc.filename, desc.mime, media_types, config)
+            if skip_reason is None and not MediaValidator.check_file_size(desc.size, config):
+                skip_reason = 'size'
+        deeplinks = ResourceExtractor.parse_bot_deeplinks(desc.text)
+        for u in ResourceExtractor.entity_urls(desc.text, desc.entities):
+            try:
+                deeplinks.extend(ResourceExtractor.parse_bot_deeplinks(u))
+            except Exception:
+                pass
+        return {
+            'message_id': desc.id,
+            'summary': MessageFormatter.format_descriptor(desc),
+            'download': skip_reason is None,
+            'skip_reason': skip_reason,
+            'cloud_tasks': ResourceExtractor.extract_from_descriptor(desc),
+            'deeplinks': deeplinks
+        }
+
+    @staticmethod
+    def classify_batch(descs: list, media_types: list, config: dict) -> list:
+        return [MessageClassifier.classify(d, media_types, config) for d in descs]
+
+    async def classify_messages(self, messages: list, channel_id: int | None = None) -> list:
+        """返回与 messages 一一对应的分类结果；启用轨迹录制时同时写入消息记录"""
+        descs = [MessageDescriptor.from_message(m) for m in messages]
+        if self.recorder is not None:
+            self.recorder.write(channel_id, descs)
+        if self.executor is None:
+            return MessageClassifier.classify_batch(descs, self.media_types, self.config)
+        loop = asyncio.get_running_loop()
+        jobs = [
+            loop.run_in_executor(self.executor, MessageClassifier.classify_batch, descs[i:i + self.batch_size], self.media_types, self.config)
+            for i in range(0, len(descs), self.batch_size)
+        ]
+        results = []
+        for chunk in await asyncio.gather(*jobs):
+            results.extend(chunk)
+        return results
+
+    @staticmethod
+    def record_metrics(results: list) -> None:
+        for result in results:
+            if result['skip_reason']:
+                METRICS.inc('tgdl_messages_filtered_total', reason=result['skip_reason'])
+            for t in result['cloud_tasks']:
+                METRICS.inc('tgdl_links_found_total', provider=t.get('provider', ''))
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
 
 class MessagePreprocessor:
-    def __init__(self, client: TelegramClient, media_types: list, config: dict):
+    def __init__(self, client: telethon.TelegramClient, media_types: list, config: dict):
         self.client = client
         self.media_types = media_types
         self.config = config
         self.download_settings = ConfigManager.get_download_settings(config)
-        # 按频道维度记录已见消息及进度，避免跨频道互相影响
-        self.channel_seen_ids: dict[int, set[int]] = {}
-        self.channel_seen_queues: dict[int, deque] = {}
+        self.classifier = MessageClassifier(
+            media_types,
+            config,
+            workers=self.download_settings['cpu_workers'],
+            batch_size=self.download_settings['cpu_batch_size']
+        )
+        # 按频道维度记录已见消息及进度，避免跨频道互相影响；已见消息ID按 LRU 保留最近 seen_ids_per_channel 条
+        self.seen_ids_limit = ConfigManager.get_memory_settings(config)['seen_ids_per_channel']
+        self.channel_seen_ids: dict[int, BoundedCache] = {}
         self.channel_last_id: dict[int, int] = {}
 
-    async def fetch_valid_messages(self, entity) -> list:
+    def seen_ids(self, channel_id: int) -> BoundedCache:
+        if channel_id not in self.channel_seen_ids:
+            self.channel_seen_ids[channel_id] = BoundedCache('seen_ids', self.seen_ids_limit)
+        return self.channel_seen_ids[channel_id]
+
+    def forget(self, channel_id: int) -> None:
+        """频道被移除时释放其运行期状态"""
+        self.channel_seen_ids.pop(channel_id, None)
+        self.channel_last_id.pop(channel_id, None)
+
+    async def fetch_valid_messages(self, entity, client=None) -> list:
         """
         尝试获取 batch_size 条满足下载条件的消息（媒体类型 + 文件大小）
         如果已无新消息，可能返回不足 batch_size 条
+        client 为空时使用默认客户端；多账号时各账号共享同一份去重与进度状态
         """
+        client = client or self.client
         valid_resources = []
         exhausted = False
         channel_id = getattr(entity, 'id', None)
@@ -1115,10 +4928,9 @@ class MessagePreprocessor:
             return valid_resources
 
         # 初始化频道状态
-        seen_ids = self.channel_seen_ids.setdefault(channel_id, set())
-        seen_queue = self.channel_seen_queues.setdefault(channel_id, deque(maxlen=500))
+        seen_ids = self.seen_ids(channel_id)
         if channel_id not in self.channel_last_id:
-            persisted = StateManager.get_last_id(channel_id)
+            persisted = await asyncio.to_thread(StateManager.get_last_id, channel_id)
             self.channel_last_id[channel_id] = persisted
         last_id = self.channel_last_id[channel_id]
 
@@ -1126,17 +4938,18 @@ class MessagePreprocessor:
 
         while len(valid_resources) < self.download_settings['batch_size'] and not exhausted:
             candidate_messages = []
+            round_start = time.time()
+            fetched_at: dict[int, float] = {}
             # 使用 min_id 获取比 last_id 更新的消息，而不是 offset_id（offset_id 会取更旧的消息）
-            async for msg in self.client.iter_messages(entity, limit=self.download_settings['batch_size'] * 2, min_id=last_id):
+            async for msg in client.iter_messages(entity, limit=self.download_settings['batch_size'] * 2, min_id=last_id):
+                METRICS.inc('tgdl_messages_scanned_total')
                 if msg.id in seen_ids:
+                    METRICS.inc('tgdl_messages_filtered_total', reason='duplicate')
                     continue
                 candidate_messages.append(msg)
+                if TRACER.enabled:
+                    fetched_at[msg.id] = time.time()
                 seen_ids.add(msg.id)
-                seen_queue.append(msg.id)
-                # 当deque达到上限，预先从集合中移除最旧的ID，避免集合膨胀
-                if len(seen_queue) == seen_queue.maxlen:
-                    oldest_id = seen_queue[0]
-                    seen_ids.discard(oldest_id)
                 # 记录该频道的最新已看到消息ID（仅运行期使用，不持久化）
                 new_seen = max(self.channel_last_id.get(channel_id, 0), msg.id)
                 if new_seen != self.channel_last_id.get(channel_id, 0):
@@ -1151,43 +4964,39 @@ class MessagePreprocessor:
                 logger.info(f'频道 {title} 无新消息（min_id={last_id}），结束本轮抓取')
                 break
 
-            for msg in candidate_messages:
-                try:
-                    logger.info(MessageFormatter.format(msg))
-                except Exception:
-                    pass
-                if MediaValidator.should_download_media(msg, self.media_types, self.config):
-                    doc = msg.media.document
-                    size = getattr(doc, 'size', 0)
-                    if MediaValidator.check_file_size(size, self.config):
-                        valid_resources.append({'kind': 'telegram_media', 'message': msg, 'message_id': msg.id})
-                        if len(valid_resources) >= self.download_settings['batch_size']:
-                            break
-                cloud_tasks = ResourceExtractor.extract_from_message(msg)
-                for t in cloud_tasks:
+            filter_start = time.time()
+            classified = await self.classifier.classify_messages(candidate_messages, channel_id)
+            filter_end = time.time()
+            MessageClassifier.record_metrics(classified)
+            for msg, result in zip(candidate_messages, classified):
+                logger.info(result['summary'])
+                trace = TRACER.start(channel_id, msg.id, round_start)
+                if trace is not None:
+                    trace.add('fetch', round_start, fetched_at[msg.id])
+                    trace.add('filter', filter_start, filter_end, batch=len(candidate_messages))
+                    if getattr(msg, 'date', None):
+                        trace.attributes['poll_delay'] = round(fetched_at[msg.id] - msg.date.timestamp(), 3)
+                if result['download']:
+                    # 只保留紧凑的下载记录，不让整个 Message 对象随队列常驻内存
+                    valid_resources.append(MediaTask.from_message(msg, channel_id, trace))
+                    if len(valid_resources) >= self.download_settings['batch_size']:
+                        break
+                for t in result['cloud_tasks']:
                     valid_resources.append(t)
                     if len(valid_resources) >= self.download_settings['batch_size']:
                         break
 
+                deeplink_start = time.time()
                 try:
-                    text = getattr(msg, 'message', '') or ''
-                    dls_text = ResourceExtractor.parse_bot_deeplinks(text)
-                    entity_urls = ResourceExtractor.extract_entity_urls(msg)
-                    dls_entities = []
-                    for u in entity_urls:
-                        try:
-                            dls_entities.extend(ResourceExtractor.parse_bot_deeplinks(u))
-                        except Exception:
-                            pass
-                    deeplinks = dls_text + dls_entities
+                    deeplinks = result['deeplinks']
                     for dl in deeplinks:
                         chat_id_s = dl.get('chat_id')
                         msg_id_s = dl.get('message_id')
                         if not chat_id_s or not msg_id_s:
                             continue
                         try:
-                            ref_entity = await self.client.get_entity(int(chat_id_s))
-                            ref_msg = await self.client.get_messages(ref_entity, ids=int(msg_id_s))
+                            ref_entity = await client.get_entity(int(chat_id_s))
+                            ref_msg = await client.get_messages(ref_entity, ids=int(msg_id_s))
                             ref_text = getattr(ref_msg, 'message', '') or ''
                             ref_links = ResourceExtractor.extract_links(ref_text)
                             ref_entity_urls = ResourceExtractor.extract_entity_urls(ref_msg)
@@ -1198,6 +5007,7 @@ class MessagePreprocessor:
                                     except Exception:
                                         pass
                             for link in ref_links:
+                                METRICS.inc('tgdl_links_found_total', provider=link.get('provider', ''))
                                 valid_resources.append({
                                     'kind': 'cloud_link',
                                     'message_id': msg.id,
@@ -1221,17 +5031,17 @@ class MessagePreprocessor:
                         if allowed_bots and bot_name not in allowed_bots:
                             continue
                         try:
-                            bot_entity = await self.client.get_entity(bot_name)
+                            bot_entity = await client.get_entity(bot_name)
                             payload_provider = dl.get('provider_raw') or dl.get('provider') or ''
                             payload = f"{dl.get('action','get_link')}_{dl.get('chat_id','')}_{dl.get('message_id','')}"
                             if payload_provider:
                                 payload = payload + f"_{payload_provider}"
-                            sent_msg = await self.client.send_message(bot_entity, f"/start {payload}")
+                            sent_msg = await client.send_message(bot_entity, f"/start {payload}")
                             wait_sec = int(self.config.get('bot_interaction', {}).get('start_reply_wait_seconds', 3))
                             limit = int(self.config.get('bot_interaction', {}).get('start_reply_limit', 5))
                             await asyncio.sleep(wait_sec)
                             found_links = []
-                            async for reply in self.client.iter_messages(bot_entity, min_id=sent_msg.id, limit=limit):
+                            async for reply in client.iter_messages(bot_entity, min_id=sent_msg.id, limit=limit):
                                 try:
                                     logger.info(MessageFormatter.format(reply))
                                 except Exception:
@@ -1248,7 +5058,7 @@ class MessagePreprocessor:
                                 if links:
                                     found_links.extend(links)
                             if not found_links:
-                                async for reply in self.client.iter_messages(bot_entity, limit=limit):
+                                async for reply in client.iter_messages(bot_entity, limit=limit):
                                     try:
                                         logger.info(MessageFormatter.format(reply))
                                     except Exception:
@@ -1267,6 +5077,7 @@ class MessagePreprocessor:
                                             found_links.extend(links)
                                             break
                             for link in found_links:
+                                METRICS.inc('tgdl_links_found_total', provider=link.get('provider', ''))
                                 valid_resources.append({
                                     'kind': 'cloud_link',
                                     'message_id': msg.id,
@@ -1283,32 +5094,394 @@ class MessagePreprocessor:
                             pass
                 except Exception:
                     pass
+                if trace is not None and result['deeplinks']:
+                    trace.add('deeplink', deeplink_start, time.time(), count=len(result['deeplinks']))
+                if not result['download']:
+                    TRACER.finish(trace, skipped=True, decision=result['skip_reason'])
 
         return valid_resources
 
+class ChannelDiscovery:
+    """频道发现：分页枚举全部对话，直接使用响应中携带的频道实体，按规则选择频道
+
+    规则（均可在 channel_discovery 配置或命令行中给出）：
+        ids                     直接选中的频道ID
+        title_patterns          标题正则，任一匹配即可
+        exclude_title_patterns  标题正则，匹配则排除
+        folders                 Telegram 文件夹标题（或 archived 表示归档）
+        has_media               最新消息带文档；media_sample > 0 时改为检查最近若干条消息
+    ids 之外的规则同时生效；对话列表缓存到 cache_path，cache_ttl_seconds 内不重复枚举。
+    """
+    PAGE_SIZE = 100
+    ARCHIVED = 'archived'
+
+    def __init__(self, settings: dict):
+        self.settings = settings
+        self.cache_path = settings['cache_path']
+
+    def has_rules(self) -> bool:
+        s = self.settings
+        return bool(s['ids'] or s['title_patterns'] or s['folders'] or s['has_media'])
+
+    @staticmethod
+    def _title(value) -> str:
+        # 新版协议中文件夹标题为 TextWithEntities
+        return getattr(value, 'text', value) or ''
+
+    async def _folders(self, client) -> list:
+        """返回 [(标题, 包含的频道ID集合, 排除的频道ID集合, 是否包含全部广播频道, 是否包含全部群组)]"""
+        try:
+            result = await client(tg_functions.GetDialogFiltersRequest())
+        except Exception as e:
+            logger.warning(f'获取文件夹列表失败: {e}')
+            return []
+        folders = []
+        for f in getattr(result, 'filters', result):
+            if not hasattr(f, 'include_peers'):
+                continue
+            ids = lambda peers: {p.channel_id for p in peers if hasattr(p, 'channel_id')}
+            folders.append((self._title(f.title), ids(f.include_peers) | ids(f.pinned_peers), ids(getattr(f, 'exclude_peers', []) or []),
+                            bool(getattr(f, 'broadcasts', False)), bool(getattr(f, 'groups', False))))
+        return folders
+
+    async def enumerate(self, client) -> list:
+        """分页获取全部对话中的频道与超级群组记录"""
+        folders = await self._folders(client)
+        channels = []
+        seen = set()
+        offset_date, offset_id, offset_peer = None, 0, tg_types.InputPeerEmpty()
+        while True:
+            result = await client(tg_functions.GetDialogsRequest(offset_date=offset_date, offset_id=offset_id, offset_peer=offset_peer,
+                                                    limit=ChannelDiscovery.PAGE_SIZE, hash=0))
+            if isinstance(result, tg_types.messages.DialogsNotModified) or not result.dialogs:
+                break
+            entities = {tg_utils.get_peer_id(e): e for e in list(result.users) + list(result.chats)}
+            messages = {(tg_utils.get_peer_id(m.peer_id), m.id): m for m in result.messages if getattr(m, 'peer_id', None)}
+            for dlg in result.dialogs:
+                peer_id = tg_utils.get_peer_id(dlg.peer)
+                if peer_id in seen:
+                    continue
+                seen.add(peer_id)
+                chat = entities.get(peer_id)
+                if not isinstance(dlg.peer, tg_types.PeerChannel) or chat is None or isinstance(chat, tg_types.ChannelForbidden):
+                    continue
+                top = messages.get((peer_id, dlg.top_message))
+                megagroup = bool(getattr(chat, 'megagroup', False))
+                names = [name for name, include, exclude, broadcasts, groups in folders
+                         if chat.id not in exclude and (chat.id in include or (groups if megagroup else broadcasts))]
+                if getattr(dlg, 'folder_id', None) == 1:
+                    names.append(ChannelDiscovery.ARCHIVED)
+                channels.append({
+                    'id': str(chat.id),
+                    'title': chat.title,
+                    'username': getattr(chat, 'username', None),
+                    'megagroup': megagroup,
+                    'folders': names,
+                    'top_has_media': isinstance(getattr(top, 'media', None), tg_types.MessageMediaDocument),
+                    'top_date': top.date.timestamp() if getattr(top, 'date', None) else None,
+                })
+            last = result.dialogs[-1]
+            last_msg = messages.get((tg_utils.get_peer_id(last.peer), last.top_message))
+            total = getattr(result, 'count', None)
+            if not isinstance(result, tg_types.messages.DialogsSlice) or len(result.dialogs) < ChannelDiscovery.PAGE_SIZE or (total and len(seen) >= total):
+                break
+            next_offset = (last_msg.date if last_msg else None, last.top_message, tg_utils.get_input_peer(entities[tg_utils.get_peer_id(last.peer)]))
+            if next_offset[:2] == (offset_date, offset_id):
+                break
+            offset_date, offset_id, offset_peer = next_offset
+            logger.info(f'已枚举对话 {len(seen)}/{total}')
+        logger.info(f'枚举到频道与超级群组 {len(channels)} 个（对话 {len(seen)} 个）')
+        return channels
+
+    def _load_cache(self) -> list | None:
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - cache.get('fetched_at', 0) > self.settings['cache_ttl_seconds']:
+            return None
+        return cache.get('channels')
+
+    def _save_cache(self, channels: list) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        tmp = self.cache_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'fetched_at': time.time(), 'channels': channels}, f, ensure_ascii=False)
+        os.replace(tmp, self.cache_path)
+
+    async def discover(self, client, refresh: bool = False) -> list:
+        channels = None if refresh else self._load_cache()
+        if channels is not None:
+            logger.info(f'使用缓存的频道列表（{len(channels)} 个）: {self.cache_path}')
+            return channels
+        channels = await self.enumerate(client)
+        try:
+            self._save_cache(channels)
+        except OSError as e:
+            logger.warning(f'写入频道列表缓存失败: {e}')
+        return channels
+
+    def match(self, channels: list) -> list:
+        """按规则筛选频道记录（has_media 的抽样检查在 select 中进行）"""
+        s = self.settings
+        ids = {str(i) for i in s['ids']}
+        include = [re.compile(p, re.IGNORECASE) for p in s['title_patterns']]
+        exclude = [re.compile(p, re.IGNORECASE) for p in s['exclude_title_patterns']]
+        folders = {f.lower() for f in s['folders']}
+        selected = []
+        for ch in channels:
+            if ch['id'] in ids:
+                selected.append(ch)
+                continue
+            if not (include or folders or s['has_media']):
+                continue
+            if ch['megagroup'] and not s['include_groups']:
+                continue
+            title = ch['title'] or ''
+            if include and not any(p.search(title) for p in include):
+                continue
+            if any(p.search(title) for p in exclude):
+                continue
+            if folders and not folders & {f.lower() for f in ch['folders']}:
+                continue
+            selected.append(ch)
+        return selected
+
+    async def _has_media(self, client, channel: dict) -> bool:
+        if channel['top_has_media'] or not self.settings['media_sample']:
+            return channel['top_has_media']
+        try:
+            messages = await client.get_messages(int(channel['id']), limit=self.settings['media_sample'])
+        except Exception as e:
+            logger.warning(f'抽样频道 {channel["title"]} 的消息失败: {e}')
+            return False
+        return any(isinstance(getattr(m, 'media', None), tg_types.MessageMediaDocument) for m in messages)
+
+    async def select(self, client, channels: list) -> list:
+        """返回按规则选中的频道记录；显式 ID 不受 has_media 限制"""
+        ids = {str(i) for i in self.settings['ids']}
+        selected = []
+        for ch in self.match(channels):
+            if self.settings['has_media'] and ch['id'] not in ids and not await self._has_media(client, ch):
+                continue
+            selected.append(ch)
+        return selected
+
+class InventoryScanner:
+    """盘点模式：只扫描与过滤、不下载，统计各频道待下载的文件数、字节数，并按带宽估算耗时
+
+    从最新消息向更早按整页翻页，分类与下载流程相同（MediaValidator、ResourceExtractor），
+    不与机器人交互、不推进 last_id。处理当前页的同时预取下一页；每页候选写入频道清单后
+    记录检查点（翻页位置、清单长度与累计统计），中断后从检查点继续。
+    """
+    PAGE_SIZE = 100
+
+    def __init__(self, classifier: MessageClassifier, out_dir: str, bandwidth_mbps: float, completed_dir: str | None = None):
+        self.classifier = classifier
+        self.out_dir = out_dir
+        self.bandwidth_mbps = bandwidth_mbps
+        # 本地存储时统计 completed_dir 中已存在的文件，这部分不计入待下载
+        self.completed_dir = completed_dir
+        os.makedirs(out_dir, exist_ok=True)
+
+    def _paths(self, channel_id: int) -> tuple:
+        return os.path.join(self.out_dir, f'{channel_id}.jsonl'), os.path.join(self.out_dir, f'{channel_id}.json')
+
+    def _load(self, channel_id: int, title: str, restart: bool) -> dict:
+        manifest_path, checkpoint_path = self._paths(channel_id)
+        if not restart and os.path.exists(checkpoint_path):
+            with open(checkpoint_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        return {
+            'channel_id': channel_id, 'title': title, 'done': False, 'offset_id': 0, 'manifest_size': 0,
+            'scanned': 0, 'candidates': 0, 'bytes': 0, 'existing': 0, 'existing_bytes': 0, 'links': 0, 'deeplinks': 0,
+            'skipped': {}, 'newest_date': None, 'oldest_date': None, 'updated_at': None,
+        }
+
+    def _save(self, state: dict) -> None:
+        _, checkpoint_path = self._paths(state['channel_id'])
+        state['updated_at'] = time.time()
+        tmp = checkpoint_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, checkpoint_path)
+
+    def _existing(self, tasks: list) -> list:
+        if self.completed_dir is None:
+            return [False] * len(tasks)
+        # 与 FileManager.build_filepath 的保存路径一致，不逐个重新读取配置
+        return [os.path.exists(os.path.join(self.completed_dir, FileManager.sanitize_filename(t.filename or t.mime.replace('/', '_'))))
+                for t in tasks]
+
+    def eta(self, size: int) -> float:
+        return size * 8 / (self.bandwidth_mbps * 1_000_000) if self.bandwidth_mbps > 0 else 0.0
+
+    async def scan(self, channel_id: int, client, entity, title: str, restart: bool = False) -> dict:
+        state = self._load(channel_id, title, restart)
+        if state['done']:
+            logger.info(f'频道 {title} 已盘点完成（{state["scanned"]} 条消息），跳过；使用 --inventory-restart 重新盘点')
+            return state
+        manifest_path, _ = self._paths(channel_id)
+        if state['offset_id']:
+            logger.info(f'频道 {title} 从检查点继续盘点: offset_id={state["offset_id"]}，已扫描 {state["scanned"]} 条')
+
+        async def page(offset_id: int) -> list:
+            return [m async for m in client.iter_messages(entity, limit=InventoryScanner.PAGE_SIZE, offset_id=offset_id)]
+
+        pending = asyncio.create_task(page(state['offset_id']))
+        try:
+            with open(manifest_path, 'ab') as f:
+                # 丢弃上次中断时检查点之后写入的不完整页
+                f.truncate(state['manifest_size'])
+                while not stop_event.is_set():
+                    messages = await pending
+                    if not messages:
+                        state['done'] = True
+                        self._save(state)
+                        break
+                    offset_id = min(m.id for m in messages)
+                    pending = asyncio.create_task(page(offset_id))
+                    results = await self.classifier.classify_messages(messages, channel_id)
+                    tasks = [MediaTask.from_message(m, channel_id) for m, r in zip(messages, results) if r['download']]
+                    exists = await asyncio.to_thread(self._existing, tasks)
+                    lines = []
+                    for task, existing in zip(tasks, exists):
+                        state['candidates'] += 1
+                        state['bytes'] += task.size
+                        if existing:
+                            state['existing'] += 1
+                            state['existing_bytes'] += task.size
+                        lines.append(json.dumps({'message_id': task.message_id, 'filename': task.filename, 'size': task.size,
+                                                 'mime': task.mime, 'posted_at': task.posted_at, 'exists': existing}, ensure_ascii=False))
+                    for r in results:
+                        if r['skip_reason']:
+                            state['skipped'][r['skip_reason']] = state['skipped'].get(r['skip_reason'], 0) + 1
+                        state['links'] += len(r['cloud_tasks'])
+                        state['deeplinks'] += len(r['deeplinks'])
+                    dates = [m.date.timestamp() for m in messages if getattr(m, 'date', None)]
+                    if dates:
+                        state['newest_date'] = max(dates + [state['newest_date'] or 0])
+                        state['oldest_date'] = min(dates + [state['oldest_date'] or float('inf')])
+                    state['scanned'] += len(messages)
+                    if lines:
+                        f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                        f.flush()
+                    state['offset_id'] = offset_id
+                    state['manifest_size'] = f.tell()
+                    self._save(state)
+                    logger.info(f'频道 {title} 盘点进度: 已扫描 {state["scanned"]} 条，候选 {state["candidates"]} 个 '
+                                f'{state["bytes"]/1024/1024/1024:.2f}GB，offset_id -> {offset_id}')
+        finally:
+            if not pending.done():
+                pending.cancel()
+                await asyncio.gather(pending, return_exceptions=True)
+        return state
+
+    @staticmethod
+    def _format_eta(seconds: float) -> str:
+        minutes = int(seconds // 60)
+        days, minutes = divmod(minutes, 24 * 60)
+        return (f'{days}d' if days else '') + f'{minutes // 60:02d}h{minutes % 60:02d}m'
+
+    def summarize(self, states: list) -> str:
+        """写入 summary.json，返回各频道待下载量与预计耗时的表格"""
+        channels = []
+        for s in states:
+            pending = s['bytes'] - s['existing_bytes']
+            channels.append({**s, 'pending_files': s['candidates'] - s['existing'], 'pending_bytes': pending, 'eta_seconds': self.eta(pending)})
+        total_pending = sum(c['pending_bytes'] for c in channels)
+        summary = {
+            'generated_at': time.time(), 'bandwidth_mbps': self.bandwidth_mbps, 'channels': channels,
+            'total': {'candidates': sum(c['candidates'] for c in channels), 'bytes': sum(c['bytes'] for c in channels),
+                      'pending_files': sum(c['pending_files'] for c in channels), 'pending_bytes': total_pending,
+                      'eta_seconds': self.eta(total_pending)},
+        }
+        with open(os.path.join(self.out_dir, 'summary.json'), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        lines = [f'{"频道":<28} {"扫描":>8} {"候选":>7} {"总大小":>10} {"已有":>6} {"待下载":>10} {"预计耗时":>10}  状态']
+        for c in channels:
+            lines.append(f'{(c["title"] or str(c["channel_id"]))[:28]:<28} {c["scanned"]:>8} {c["candidates"]:>7} {c["bytes"]/1024**3:>8.2f}GB '
+                         f'{c["existing"]:>6} {c["pending_bytes"]/1024**3:>8.2f}GB {self._format_eta(c["eta_seconds"]):>10}  '
+                         f'{"完成" if c["done"] else "未完成"}')
+        t = summary['total']
+        lines.append(f'{"合计":<28} {sum(c["scanned"] for c in channels):>8} {t["candidates"]:>7} {t["bytes"]/1024**3:>8.2f}GB '
+                     f'{t["candidates"] - t["pending_files"]:>6} {t["pending_bytes"]/1024**3:>8.2f}GB {self._format_eta(t["eta_seconds"]):>10}')
+        lines.append(f'预计耗时按 {self.bandwidth_mbps:g} Mbps 计算；清单与检查点位于 {self.out_dir}')
+        return '\n'.join(lines)
+
 class TelegramDownloader:
     def __init__(self):
         logger.info('初始化 TelegramDownloader')
+        init_data_dirs()
         self.config = ConfigManager.load_config()
         self.client = None
         self.audio_checker = AudioQualityChecker(self.config)
         self.preprocessor = None
         self.download_settings = ConfigManager.get_download_settings(self.config)
-        self.progress_tracker = ProgressTracker(self.download_settings['progress_step'] if 'progress_step' in self.download_settings else 10)
+        self.memory_settings = ConfigManager.get_memory_settings(self.config)
+        MEMORY_BUDGET.configure(self.memory_settings)
+        self.progress_tracker = ProgressTracker(self.download_settings['progress_step'] if 'progress_step' in self.download_settings else 10,
+                                                self.memory_settings['progress_entries'], self.memory_settings['progress_ttl_seconds'])
+        self.rate_limit_settings = ConfigManager.get_rate_limit_settings(self.config)
+        self.rate_limiter = None
+        self.pool = ClientPool()
+        self.coordination_settings = ConfigManager.get_coordination_settings(self.config)
+        self.adaptive_concurrency_settings = ConfigManager.get_adaptive_concurrency_settings(self.config)
+        self.backfill_settings = ConfigManager.get_backfill_settings(self.config)
+        self.storage_settings = ConfigManager.get_storage_settings(self.config)
+        self.sink = MediaSink.create(self.storage_settings)
+        self.metrics_settings = ConfigManager.get_metrics_settings(self.config)
+        self.tracing_settings = ConfigManager.get_tracing_settings(self.config)
+        self.retention_settings = ConfigManager.get_retention_settings(self.config)
+        self.retention = None
+        if self.retention_settings['enabled']:
+            if self.sink.local:
+                self.retention = RetentionManager(self.retention_settings, self.download_settings)
+            else:
+                logger.warning('磁盘保留策略只适用于本地存储，已忽略')
+        self.backfill_sem = Semaphore(self.backfill_settings['concurrency'])
+        self.retry_queue_settings = ConfigManager.get_retry_queue_settings(self.config)
+        self.discovery_settings = ConfigManager.get_channel_discovery_settings(self.config)
+        # --refresh-channels：忽略对话列表缓存重新枚举
+        self.refresh_channels = False
+        self.retry_queue = None
+        if self.retry_queue_settings['enabled']:
+            # 多节点共享重试队列时按节点认领任务，避免每个节点都重试同一任务
+            owner = self.coordination_settings['worker_id'] if self.coordination_settings['enabled'] else None
+            self.retry_queue = RetryQueue(self.retry_queue_settings, self.download_settings, owner)
+        self.retry_sem = Semaphore(self.retry_queue_settings['concurrency'] or self.download_settings['max_concurrent_downloads'])
+        # 各频道实时抓取是否空闲；回溯只在实时抓取空闲时运行，优先级低于新消息
+        self.live_idle: dict[int, asyncio.Event] = {}
+        self.concurrency = None
+        if self.adaptive_concurrency_settings['enabled']:
+            self.concurrency = AdaptiveConcurrencyController(self.adaptive_concurrency_settings, self.download_settings['max_concurrent_downloads'])
+        self.bandwidth_settings = ConfigManager.get_bandwidth_settings(self.config)
+        self.bandwidth = BandwidthShaper(self.bandwidth_settings, self.concurrency)
+        self.control_settings = ConfigManager.get_control_settings(self.config)
+        self.link_probe_settings = ConfigManager.get_link_probe_settings(self.config)
+        self.link_probe = LinkProbe(self.link_probe_settings) if self.link_probe_settings['enabled'] else None
+        # 运行中的频道（控制接口可增删）、各频道可调参数与任务
+        self.channels: list[str] = []
+        self.controls: dict[int, ChannelControl] = {}
+        self.channel_tasks: dict[int, asyncio.Task] = {}
+        # 正在写入的目标路径，避免多个账号/频道同时下载到同一文件
+        self.inflight_paths: set[str] = set()
+        # 抓取轨迹录制文件（--capture 或 TGDL_CAPTURE_FILE），为空时不录制
+        self.capture_path = os.getenv('TGDL_CAPTURE_FILE') or None
+        # 按设计有界的结构只登记大小，随缓存一并报告
+        MEMORY_BUDGET.watch('inflight_paths', lambda: len(self.inflight_paths))
+        MEMORY_BUDGET.watch('channel_tasks', lambda: len(self.channel_tasks))
+        MEMORY_BUDGET.watch('pool_entities', lambda: len(self.pool.entities))
+        MEMORY_BUDGET.watch('bandwidth_buckets', lambda: len(self.bandwidth.channel_buckets))
+        MEMORY_BUDGET.watch('retry_heap', lambda: len(self.retry_queue.heap) if self.retry_queue else 0)
+        MEMORY_BUDGET.watch('tqdm_bars', lambda: len(getattr(tqdm_lib.tqdm, '_instances', ())) if 'tqdm' in sys.modules else 0)
         self.log_effective_runtime_config()
 
     def log_effective_runtime_config(self) -> None:
-        safe_phone = re.sub(r'(\d{3})\d+(\d{2})', r'\1***\2', str(self.config.get('phone_number', '')))
-        payload = {
-            'api_id': self.config.get('api_id'),
-            'api_hash': self.config.get('api_hash'),
-            'phone_number': safe_phone,
-            'media_types': self.config.get('media_types'),
-            'audio_quality_check': self.config.get('audio_quality_check'),
-            'language_filter': self.config.get('language_filter'),
-            'selected_channels': self.config.get('selected_channels', []),
-            'download_settings': self.download_settings,
-        }
+        payload = ConfigManager.effective_runtime_config(self.config)
         try:
             logger.info(f"有效运行时配置: {json.dumps(payload, ensure_ascii=False)}")
         except Exception:
@@ -1316,150 +5489,358 @@ class TelegramDownloader:
 
     async def initialize(self) -> None:
         logger.info('开始初始化客户端')
-        safe_name = re.sub(r'[^\w\-_.]', '_', self.config['phone_number'])
+        for account in ConfigManager.get_accounts(self.config):
+            client = await self._create_client(account)
+            if self.concurrency:
+                client.limiter.add_flood_listener(self.concurrency.on_flood_wait)
+            self.pool.add(account['phone_number'], client)
+        self.client = self.pool.primary
+        self.rate_limiter = self.client.limiter
+        logger.info(f'已连接账号 {len(self.pool.clients)} 个')
+
+        # 初始化预处理器
+        self.preprocessor = MessagePreprocessor(self.client, self.config['media_types'], self.config)
+        if self.capture_path:
+            self.preprocessor.classifier.recorder = TraceRecorder(self.capture_path)
+            logger.info(f'抓取轨迹录制到: {self.capture_path}')
+
+    async def _create_client(self, account: dict) -> RateLimitedClient:
+        safe_name = re.sub(r'[^\w\-_.]', '_', account['phone_number'])
         session_path = os.path.join(SESSION_DIR, safe_name)
         logger.debug(f'使用会话文件: {session_path}')
 
         # 准备代理配置
-        proxy = ConfigManager.get_proxy_config(self.config)
+        proxy = ConfigManager.get_proxy_config({'proxy': account.get('proxy', {})})
 
-        self.client = TelegramClient(
+        raw_client = telethon.TelegramClient(
             session_path,
-            self.config['api_id'],
-            self.config['api_hash'],
+            account['api_id'],
+            account['api_hash'],
             connection_retries=5,        # 连接重试次数
             retry_delay=1,              # 重试延迟（秒）
             auto_reconnect=True,        # 自动重连
             request_retries=5,          # 请求重试次数
             timeout=30,                 # 连接超时时间
-            proxy=proxy                 # 代理配置
+            proxy=proxy,                # 代理配置
+            flood_sleep_threshold=self.rate_limit_settings['flood_sleep_threshold']  # 超过该秒数的 FloodWait 交由限流器处理
         )
-        await self.client.connect()
+        # 每个账号独立的限流状态
+        client = RateLimitedClient(raw_client, ApiRateLimiter(self.rate_limit_settings))
+        await client.connect()
 
-        if not await self.client.is_user_authorized():
-            logger.info('需要登录授权')
-            await self._handle_authorization()
+        if not await client.is_user_authorized():
+            logger.info(f'账号 {safe_name} 需要登录授权')
+            await self._handle_authorization(client, account['phone_number'])
         else:
-            logger.info('已经授权，无需登录')
+            logger.info(f'账号 {safe_name} 已经授权，无需登录')
+        return client
 
-        # 初始化预处理器
-        self.preprocessor = MessagePreprocessor(self.client, self.config['media_types'], self.config)
-
-    async def _handle_authorization(self) -> None:
+    async def _handle_authorization(self, client: RateLimitedClient, phone_number: str) -> None:
         logger.info('开始登录流程')
-        await self.client.send_code_request(self.config['phone_number'])
-        code = input("请输入收到的验证码: ")
+        await client.send_code_request(phone_number)
+        code = input(f"请输入 {phone_number} 收到的验证码: ")
         try:
-            await self.client.sign_in(self.config['phone_number'], code)
+            await client.sign_in(phone_number, code)
             logger.info('登录成功')
-        except SessionPasswordNeededError:
+        except tg_errors.SessionPasswordNeededError:
             logger.info('需要二步验证')
             pwd = input("请输入二步验证密码: ")
-            await self.client.sign_in(password=pwd)
+            await client.sign_in(password=pwd)
             logger.info('二步验证成功')
 
-    async def select_channels(self) -> list:
-        logger.info('开始选择频道')
-        result = await self.client(GetDialogsRequest(
-            offset_date=None,
-            offset_id=0,
-            offset_peer=InputPeerEmpty(),
-            limit=100,
-            hash=0
-        ))
-
-        channels = []
-        for dlg in result.dialogs:
+    async def close(self) -> None:
+        for client in self.pool.clients:
             try:
-                entity = await self.client.get_entity(dlg.peer)
-                if hasattr(entity, 'title'):
-                    channels.append(entity)
+                await client.disconnect()
             except Exception as e:
-                logger.error(f'获取频道实体失败: {e}')
+                logger.warning(f'断开客户端连接失败: {e}')
 
-        all_channels = {str(ch.id): ch.title for ch in channels}
+    async def select_channels(self) -> list:
+        """枚举全部对话后按规则选择频道；未配置规则时在终端中交互选择"""
+        logger.info('开始选择频道')
+        discovery = ChannelDiscovery(self.discovery_settings)
+        channels = await discovery.discover(self.client, self.refresh_channels)
+        all_channels = {ch['id']: ch['title'] for ch in channels}
         logger.info(f'找到 {len(all_channels)} 个频道')
 
-        for idx, (chid, title) in enumerate(all_channels.items()):
-            print(f"[{idx}] {title} ({chid})")
-
-        choices = input("请输入要下载的频道编号（用逗号分隔）: ").split(',')
         selected = []
-        id_list = list(all_channels.keys())
-        for choice in choices:
-            try:
-                idx = int(choice.strip())
-                selected.append(id_list[idx])
-                logger.info(f'选择频道: {all_channels[id_list[idx]]}')
-            except Exception as e:
-                logger.error(f'无效的选择: {choice}, 错误: {e}')
+        if discovery.has_rules():
+            for ch in await discovery.select(self.client, channels):
+                selected.append(ch['id'])
+                logger.info(f'按规则选择频道: {ch["title"]} ({ch["id"]})')
+            for chid in self.discovery_settings['ids']:
+                if chid not in all_channels:
+                    # 未加入的公开频道仍可尝试访问，无法访问时由 process_channel 跳过
+                    selected.append(chid)
+                    logger.warning(f'频道 {chid} 不在对话列表中，仍按 ID 选择')
+        elif sys.stdin.isatty():
+            for idx, (chid, title) in enumerate(all_channels.items()):
+                print(f"[{idx}] {title} ({chid})")
+
+            choices = input("请输入要下载的频道编号（用逗号分隔）: ").split(',')
+            id_list = list(all_channels.keys())
+            for choice in choices:
+                try:
+                    idx = int(choice.strip())
+                    selected.append(id_list[idx])
+                    logger.info(f'选择频道: {all_channels[id_list[idx]]}')
+                except Exception as e:
+                    logger.error(f'无效的选择: {choice}, 错误: {e}')
+        else:
+            logger.error('未配置频道选择规则且无法交互输入，请配置 channel_discovery 或使用 --select-* 参数')
 
         self.config['selected_channels'] = selected
         ConfigManager.save_config(self.config)
         return selected
 
-    async def download_media(self, message, channel_title: str) -> bool:
-        if not MediaValidator.should_download_media(message, self.config['media_types'], self.config):
+    async def _channel_entity(self, client, idx: int | None, channel_id: int):
+        entity = self.pool.entities.get((idx, channel_id))
+        return entity if entity is not None else await client.get_entity(channel_id)
+
+    @staticmethod
+    async def _stream_document(client, task: MediaTask, file: SinkWriter, progress_callback=None) -> None:
+        """从写入句柄的当前位置开始下载：新文件走 download_file，已有部分数据（重试、续传）时按偏移用 iter_download 续写
+
+        传输中途遇到 FloodWait 时等待后从已写入的位置继续。
+        """
+        while True:
+            offset = file.tell()
+            try:
+                if offset == 0:
+                    await client.download_file(task.input_location(), file, file_size=task.size, dc_id=task.dc_id, progress_callback=progress_callback)
+                    return
+                logger.info(f'消息 {task.message_id} 从 {offset/1024/1024:.2f}MB 处续传')
+                async for chunk in client.iter_download(task.input_location(), offset=offset, file_size=task.size, dc_id=task.dc_id):
+                    await file.write(chunk)
+                    if progress_callback:
+                        r = progress_callback(file.tell(), task.size)
+                        if inspect.isawaitable(r):
+                            await r
+                return
+            except tg_errors.FloodWaitError as e:
+                # RateLimitedClient 已暂停下载类请求，下一次 acquire 会等待；原始客户端在此等待
+                if not isinstance(client, RateLimitedClient):
+                    await asyncio.sleep(e.seconds)
+
+    async def _fetch_document(self, client, idx: int | None, task: MediaTask, **kwargs) -> None:
+        """按任务记录下载文档；文件引用过期时即时重新获取消息并重试一次"""
+        try:
+            await self._stream_document(client, task, **kwargs)
+        except tg_errors.FileReferenceExpiredError:
+            logger.info(f'消息 {task.message_id} 文件引用已过期，重新获取消息后重试')
+            msg = await client.get_messages(await self._channel_entity(client, idx, task.channel_id), ids=task.message_id)
+            if not task.refresh(msg):
+                raise
+            await self._stream_document(client, task, **kwargs)
+
+    async def _download_with_failover(self, task: MediaTask, **kwargs) -> None:
+        """优先使用频道分配的账号下载，失败时依次切换到其他成员账号重新获取消息后下载"""
+        channel_id = task.channel_id
+        assigned = self.pool.assignments.get(channel_id)
+        if assigned is None:
+            await self._fetch_document(self.client, None, task, **kwargs)
+            return
+        last_error = None
+        for n, idx in enumerate([assigned] + self.pool.failover_candidates(channel_id)):
+            client = self.pool.clients[idx]
+            target = task
+            if n > 0:
+                logger.warning(f'切换到账号 {self.pool.names[idx]} 重试下载消息 {task.message_id}: {last_error}')
+                try:
+                    # 其他账号需用自己的频道实体重新获取消息，文件引用与 access_hash 按账号区分
+                    msg = await client.get_messages(self.pool.entities[(idx, channel_id)], ids=task.message_id)
+                except Exception as e:
+                    last_error = e
+                    continue
+                if not msg or not isinstance(getattr(msg, 'media', None), tg_types.MessageMediaDocument):
+                    continue
+                target = MediaTask.from_message(msg, channel_id)
+            self.pool.load[idx] += 1
+            try:
+                await self._fetch_document(client, idx, target, **kwargs)
+                return
+            except Exception as e:
+                last_error = e
+            finally:
+                self.pool.load[idx] -= 1
+        raise last_error or RuntimeError(f'没有可用账号下载消息 {task.message_id}')
+
+    async def _probe_audio(self, task: MediaTask, save_path: str) -> bool:
+        """下载替换前只获取新文件的头尾若干 KB 解析编码参数，判断是否值得完整下载；探测失败或无法判断时照常下载"""
+        assigned = self.pool.assignments.get(task.channel_id)
+        client = self.pool.clients[assigned] if assigned is not None else self.client
+        chunk = AudioQualityChecker.PROBE_CHUNK
+        ranges = self.audio_checker.probe_ranges(task.size)
+        if ranges == [(0, task.size)]:
+            # 文件不比探测范围大，直接完整下载
+            return True
+        parts = []
+        try:
+            for offset, length in ranges:
+                data = bytearray()
+                async for piece in client.iter_download(task.input_location(), offset=offset, request_size=chunk,
+                                                        limit=-(-length // chunk), file_size=task.size, dc_id=task.dc_id):
+                    data += piece
+                    if len(data) >= length:
+                        break
+                parts.append((offset, bytes(data[:length])))
+        except Exception as e:
+            logger.warning(f'音频探测失败，照常下载消息 {task.message_id}: {e}')
+            METRICS.inc('tgdl_audio_probes_total', result='error')
+            return True
+        head = parts[0][1]
+        tail_offset, tail = parts[1] if len(parts) > 1 else (None, b'')
+        probe = AudioQualityChecker.parse_probe(task.size, head, tail, tail_offset)
+        if probe is None:
+            logger.info(f'无法从文件头解析消息 {task.message_id} 的音频参数，照常下载')
+            METRICS.inc('tgdl_audio_probes_total', result='inconclusive')
+            return True
+        if self.audio_checker.accept_probe(save_path, probe, task.duration):
+            METRICS.inc('tgdl_audio_probes_total', result='accepted')
+            return True
+        METRICS.inc('tgdl_audio_probes_total', result='rejected')
+        METRICS.inc('tgdl_audio_probe_saved_bytes_total', max(task.size - len(head) - len(tail), 0))
+        return False
+
+    async def download_media(self, task: MediaTask, channel_title: str) -> bool:
+        if not task.filename:
+            logger.debug(f'消息 {task.message_id} 没有文件名，跳过下载')
+            return False
+        if not MediaValidator.should_download_file(task.message_id, task.filename, task.mime, self.config['media_types'], self.config):
             return False
 
-        doc = message.media.document
-        size = doc.size or 0
+        size = task.size
         if not MediaValidator.check_file_size(size, self.config):
             logger.warning(f'跳过大文件: {size/1024/1024:.2f}MB')
             return False
 
-        tmp_path, tmp_name, save_path, safe_name = FileManager.get_filepath(message, channel_title)
+        tmp_path, tmp_name, save_path, safe_name = FileManager.build_filepath(task.message_id, task.filename, task.mime)
+        mime = task.mime
         
-        # 检查磁盘空间是否足够
+        if save_path in self.inflight_paths:
+            logger.info(f'文件正在由其他任务下载，跳过: {save_path}')
+            METRICS.inc('tgdl_messages_filtered_total', reason='inflight')
+            return False
+        # 检查是否需要进行音频质量比较（需要读取已有文件，仅本地存储支持）
+        if await self.sink.exists(save_path, safe_name):
+            if self.retention is not None:
+                await asyncio.to_thread(self.retention.touch, save_path)
+            # 已打包进分片的文件不可替换，按已存在处理
+            if not (self.sink.local and 'audio' in mime and os.path.exists(save_path)):
+                logger.info(f'文件已存在，跳过: {save_path}')
+                METRICS.inc('tgdl_messages_filtered_total', reason='exists')
+                return False
+            if not self.audio_checker.should_replace_audio(save_path, task.duration, size):
+                METRICS.inc('tgdl_messages_filtered_total', reason='exists')
+                return False
+            if self.audio_checker.probe_enabled and not await self._probe_audio(task, save_path):
+                METRICS.inc('tgdl_messages_filtered_total', reason='exists')
+                return False
+
+        # 检查磁盘空间是否足够（对象存储只在内存中缓冲分片，不占用本地磁盘）；
+        # 启用保留策略时按文件大小预留空间，不足时先淘汰已完成文件
         min_disk_space_mb = self.download_settings.get('min_disk_space_mb', 500)
         downloading_dir = self.download_settings.get('downloading_dir', os.path.join(MEDIA_DIR, 'downloading'))
-        if not FileManager.check_disk_space(downloading_dir, min_disk_space_mb):
+        if self.retention is not None:
+            has_space = await asyncio.to_thread(self.retention.reserve, save_path, size, task.channel_id, tmp_path)
+        else:
+            has_space = not self.sink.local or FileManager.check_disk_space(downloading_dir, min_disk_space_mb)
+        if not has_space:
             logger.warning(f'磁盘空间不足 {min_disk_space_mb}MB，暂停下载: {safe_name}')
+            METRICS.inc('tgdl_messages_filtered_total', reason='disk_space')
             await asyncio.sleep(self.download_settings.get('wait_interval_seconds', 300))
+            await self._schedule_retry('media', RetryQueue.media_key(task), task.to_record(), task.channel_id, task.message_id,
+                                       channel_title, OSError(errno.ENOSPC, f'磁盘空间不足 {min_disk_space_mb}MB'))
             return False
-            
-        mime = doc.mime_type or ''
-        
-        # 检查是否需要进行音频质量比较
-        if os.path.exists(save_path) and 'audio' in mime:
-            if not self.audio_checker.should_replace_audio(save_path, doc, size):
-                return False
-        elif os.path.exists(save_path):
-            logger.info(f'文件已存在，跳过: {save_path}')
-            return False
 
-        logger.info(f'开始下载: {safe_name}, 大小: {size/1024/1024:.2f}MB')
+        self.inflight_paths.add(save_path)
+        METRICS.inc('tgdl_inflight_transfers')
+        writer = None
+        received = 0
+        started = time.monotonic()
+        download_start = download_end = None
+
+        async def account(current):
+            # 统计增量字节（吞吐指标与自适应并发），并按带宽限制等待
+            nonlocal received
+            delta = current - received
+            received = current
+            await self.bandwidth.consume(task.channel_id, delta)
+
         try:
+            writer = await self.sink.open(tmp_path, save_path, safe_name, size,
+                                          {'channel_id': task.channel_id, 'message_id': task.message_id, 'document_id': task.document_id})
+            received = writer.tell()
+            logger.info(f'开始下载: {safe_name}, 大小: {size/1024/1024:.2f}MB')
+            download_start = time.time()
             if DISABLE_TQDM:
                 async def progress_callback(current, total):
+                    await account(current)
                     self.progress_tracker.check(safe_name, current, total)
-                await self.client.download_media(
-                    message,
-                    file=tmp_path,
+                await self._download_with_failover(
+                    task,
+                    file=writer,
                     progress_callback=progress_callback
                 )
             else:
                 # 使用tqdm进度条
-                with tqdm(total=size, unit='B', unit_scale=True, desc=safe_name, leave=True) as progress_bar:
-                    await self.client.download_media(
-                        message,
-                        file=tmp_path,
-                        progress_callback=lambda current, _: progress_bar.update(current - progress_bar.n)
+                with tqdm_lib.tqdm(total=size, initial=received, unit='B', unit_scale=True, desc=safe_name, leave=True) as progress_bar:
+                    async def progress_callback(current, _):
+                        await account(current)
+                        progress_bar.update(current - progress_bar.n)
+                    await self._download_with_failover(
+                        task,
+                        file=writer,
+                        progress_callback=progress_callback
                     )
-            
-            # 下载完成后，将文件从下载中目录移动到下载完成目录
-            os.rename(tmp_path, save_path)
-            logger.info(f'下载完成: 从 {tmp_path} 移动到 {save_path}')
+            download_end = time.time()
+
+            written = writer.tell()
+            if size and written != size:
+                raise IOError(f'下载大小不一致: 期望 {size} 字节，实际 {written} 字节')
+            await writer.commit()
+            try:
+                await asyncio.to_thread(Manifest.append, {
+                    'sha256': writer.hexdigest(),
+                    'size': written,
+                    'location': writer.location,
+                    'channel_id': task.channel_id,
+                    'message_id': task.message_id,
+                    'document_id': task.document_id,
+                    'finished_at': int(time.time())
+                })
+            except Exception as e:
+                logger.warning(f'写入文件清单失败: {writer.location}, 错误: {e}')
+            if task.trace is not None:
+                task.trace.add('download', download_start, download_end, size=size)
+                task.trace.add('finalize', download_end, time.time())
+            METRICS.inc('tgdl_downloads_total', result='completed')
+            METRICS.observe('tgdl_download_duration_seconds', time.monotonic() - started)
+            if task.posted_at:
+                METRICS.observe('tgdl_time_to_download_seconds', max(time.time() - task.posted_at, 0))
+            if self.retry_queue is not None:
+                await self.retry_queue.complete(RetryQueue.media_key(task))
             return True
         except Exception as e:
             logger.error(f'下载失败: {save_path}, 错误: {e}')
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
-                logger.debug(f'删除临时文件: {tmp_path}')
+            METRICS.inc('tgdl_downloads_total', result='failed')
+            if task.trace is not None:
+                task.trace.attributes['error'] = str(e)
+                if download_start is not None:
+                    task.trace.add('download', download_start, download_end or time.time(), size=size)
+            if self.concurrency and isinstance(e, (asyncio.TimeoutError, TimeoutError)):
+                self.concurrency.on_congestion(f'下载超时 {safe_name}')
+            if writer is not None:
+                await writer.abort()
+            await self._schedule_retry('media', RetryQueue.media_key(task), task.to_record(), task.channel_id, task.message_id, channel_title, e)
             return False
         finally:
-            # 清理进度跟踪器
-            DISABLE_TQDM and self.progress_tracker.clear(safe_name)
+            self.inflight_paths.discard(save_path)
+            if self.retention is not None:
+                self.retention.release(save_path)
+            METRICS.inc('tgdl_inflight_transfers', -1)
+            # 清理进度跟踪器（成功、失败或取消都清除）
+            self.progress_tracker.clear(safe_name)
 
     async def handle_cloud_link(self, task: dict, channel_title: str) -> bool:
         try:
@@ -1467,6 +5848,15 @@ class TelegramDownloader:
             url = task.get('url', '')
             code = task.get('code', '')
             full_url = task.get('full_url', url)
+            if self.link_probe is not None:
+                if 'liveness' not in task:
+                    task['liveness'] = await self.link_probe.check(task)
+                if task['liveness'] == 'dead' and self.link_probe_settings['skip_dead']:
+                    logger.info(f'云盘链接已失效，不提交: {channel_title} [{provider}] {full_url}')
+                    METRICS.inc('tgdl_links_submitted_total', result='dead')
+                    if self.retry_queue is not None:
+                        await self.retry_queue.complete(RetryQueue.link_key(task))
+                    return True
             settings = self.config.get('link_submission', {})
             if settings.get('enabled') and settings.get('api_url'):
                 payload = {
@@ -1477,63 +5867,238 @@ class TelegramDownloader:
                     'message_id': task.get('message_id'),
                     'channel_title': channel_title
                 }
+                if 'liveness' in task:
+                    payload['liveness'] = task['liveness']
                 def _post():
                     return requests.post(settings['api_url'], json=payload, timeout=10)
                 resp = await asyncio.to_thread(_post)
                 ok = 200 <= resp.status_code < 300
+                METRICS.inc('tgdl_links_submitted_total', result='success' if ok else 'failed')
                 if ok:
                     logger.info(f'提交云盘任务成功: {channel_title} [{provider}] {full_url}')
+                    if self.retry_queue is not None:
+                        await self.retry_queue.complete(RetryQueue.link_key(task))
                 else:
                     logger.error(f'提交云盘任务失败: {resp.status_code} {resp.text}')
+                    await self._schedule_retry('link', RetryQueue.link_key(task), self._link_retry_payload(task), None, task.get('message_id'), channel_title,
+                                               requests.HTTPError(f'{resp.status_code} {resp.text[:200]}', response=resp))
                 return ok
             else:
-                logger.info(f'识别到云盘链接: {channel_title} [{provider}] {full_url} 提取码:{code or "N/A"}')
+                logger.info(f'识别到云盘链接: {channel_title} [{provider}] {full_url} 提取码:{code or "N/A"}'
+                            + (f' 状态:{task["liveness"]}' if 'liveness' in task else ''))
                 return True
         except Exception as e:
             logger.error(f'处理云盘链接失败: {e}')
+            METRICS.inc('tgdl_links_submitted_total', result='failed')
+            await self._schedule_retry('link', RetryQueue.link_key(task), self._link_retry_payload(task), None, task.get('message_id'), channel_title, e)
             return False
 
-    async def _limited_download(self, sem: Semaphore, message, title: str):
-        async with sem:
-            ok = await self.download_media(message, title)
-            return (message.id, ok)
+    @staticmethod
+    def _link_retry_payload(task: dict) -> dict:
+        """持久化到重试队列的链接任务不带探测结果，重试时重新探测（仍经 LinkProbe 的 TTL 缓存）"""
+        return {k: v for k, v in task.items() if k != 'liveness'}
+
+    async def _schedule_retry(self, kind: str, key: str, payload: dict, channel_id, message_id, channel_title: str, error: Exception) -> None:
+        if self.retry_queue is None:
+            return
+        try:
+            await self.retry_queue.fail(kind, key, payload, channel_id, message_id, channel_title, error)
+        except Exception as e:
+            logger.error(f'记录重试任务失败: {e}')
+
+    async def _retry_job(self, job: dict) -> None:
+        """重试队列到期的任务重新送入下载或链接提交流程，失败时由下载方重新安排
+
+        下载任务同时受重试总并发与所属频道的 ChannelControl 限制：频道暂停时推迟，频道已移除时丢弃。
+        """
+        if job['kind'] == 'media':
+            channel_id = job['channel_id']
+            if str(channel_id) not in self.channels:
+                logger.info(f'重试任务 {job["key"]} 所属频道 {channel_id} 已移除，不再重试')
+                return
+            control = self._control(channel_id)
+            if control.paused:
+                await self.retry_queue.defer(job['key'], self.retry_queue.poll_seconds)
+                logger.debug(f'频道 {control.title} 已暂停，推迟重试任务 {job["key"]}')
+                return
+            async with self.retry_sem:
+                await self._limited_download(control, MediaTask.from_record(job['payload']), job['channel_title'] or str(channel_id))
+        else:
+            await self.handle_cloud_link(self._link_retry_payload(job['payload']), job['channel_title'] or '')
+
+    async def _limited_download(self, sem: Semaphore | ChannelControl, task: MediaTask, title: str):
+        METRICS.inc('tgdl_queue_depth')
+        queued = time.time()
+        try:
+            async with sem:
+                if self.concurrency is None:
+                    if task.trace is not None:
+                        task.trace.add('queue_wait', queued, time.time())
+                    ok = await self.download_media(task, title)
+                    return (task.message_id, ok)
+                await self.concurrency.acquire()
+                if task.trace is not None:
+                    task.trace.add('queue_wait', queued, time.time())
+                try:
+                    ok = await self.download_media(task, title)
+                finally:
+                    await self.concurrency.release()
+                return (task.message_id, ok)
+        finally:
+            METRICS.inc('tgdl_queue_depth', -1)
+
+    @staticmethod
+    def _finish_traces(tasks: list, results: list, commit_start: float) -> None:
+        """批次进度写入后结束各下载任务的追踪；只有成功下载的任务记录 state_commit 阶段"""
+        commit_end = time.time()
+        for task, (_, ok) in zip(tasks, results):
+            if task.trace is None:
+                continue
+            if ok:
+                task.trace.add('state_commit', commit_start, commit_end)
+            result = 'completed' if ok else ('failed' if 'error' in task.trace.attributes else 'skipped')
+            TRACER.finish(task.trace, result=result)
+            task.trace = None
+
+    def _control(self, channel_id: int) -> ChannelControl:
+        control = self.controls.get(channel_id)
+        if control is None:
+            saved = (self.config.get('channel_settings') or {}).get(str(channel_id), {})
+            control = self.controls[channel_id] = ChannelControl(
+                channel_id, saved.get('max_concurrent_downloads', self.download_settings['max_concurrent_downloads']),
+                saved.get('weight', 1.0), saved.get('paused', False))
+        return control
+
+    def _start_channel(self, channel: str) -> None:
+        task = self.channel_tasks.get(int(channel))
+        if task is None or task.done():
+            self.channel_tasks[int(channel)] = asyncio.create_task(self.process_channel(channel), name=f'channel-{channel}')
+
+    def _save_channels(self, added: str | None = None, removed: str | None = None) -> None:
+        """把频道列表与各频道的可调参数写回配置文件；按规则选择频道时，增删的频道同时写入 channel_discovery.ids"""
+        self.config['selected_channels'] = list(self.channels)
+        self.config['channel_settings'] = {str(cid): c.settings() for cid, c in self.controls.items()}
+        discovery = self.config.get('channel_discovery')
+        if discovery is not None and (added or removed) and ChannelDiscovery(self.discovery_settings).has_rules():
+            ids = [str(i) for i in discovery.get('ids') or [] if str(i) != removed]
+            discovery['ids'] = ids + [added] if added and added not in ids else ids
+        ConfigManager.save_config(self.config)
+
+    async def add_channel(self, channel_id: int) -> dict:
+        channel = str(channel_id)
+        if channel not in self.channels:
+            self.channels.append(channel)
+        self._control(channel_id)
+        self._save_channels(added=channel)
+        # 多节点模式下由下一次租约同步决定是否在本节点运行；移除时 remove_channel 直接取消本节点上的任务
+        if not self.coordination_settings['enabled']:
+            self._start_channel(channel)
+        logger.info(f'控制接口: 添加频道 {channel}')
+        return self.controls[channel_id].status()
+
+    async def remove_channel(self, channel_id: int) -> dict:
+        channel = str(channel_id)
+        if channel in self.channels:
+            self.channels.remove(channel)
+        task = self.channel_tasks.pop(channel_id, None)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        control = self.controls.pop(channel_id)
+        if self.preprocessor:
+            self.preprocessor.forget(channel_id)
+        self.live_idle.pop(channel_id, None)
+        self.bandwidth.channel_buckets.pop(channel_id, None)
+        self._save_channels(removed=channel)
+        logger.info(f'控制接口: 移除频道 {control.title}')
+        return {'id': channel_id, 'removed': True}
+
+    async def update_channel(self, channel_id: int, paused: bool | None = None, limit: int | None = None, weight: float | None = None) -> dict:
+        control = self.controls[channel_id]
+        await control.update(paused, limit, weight)
+        self._save_channels()
+        logger.info(f'控制接口: 频道 {control.title} 参数 -> {control.settings()}')
+        return control.status()
+
+    async def trigger_backfill(self, channel_id: int, restart: bool = False) -> dict:
+        control = self.controls[channel_id]
+        if control.entity is None:
+            return {**control.status(), 'error': '频道尚未开始处理（实体未解析），稍后重试'}
+        if control.backfill_task is None or control.backfill_task.done():
+            if restart or (await asyncio.to_thread(StateManager.get_backfill, channel_id))['done']:
+                await asyncio.to_thread(StateManager.set_backfill, channel_id, 0)
+            control.backfill_task = asyncio.create_task(self.backfill_channel(channel_id, control.client, control.entity, control.title),
+                                                        name=f'backfill-{channel_id}')
+            logger.info(f'控制接口: 触发频道 {control.title} 历史回溯')
+        return control.status()
+
+    async def queue_status(self) -> dict:
+        status = {
+            'channels': [c.status() for c in self.controls.values()],
+            'queue_depth': METRICS.values.get(Metrics._key('tgdl_queue_depth', {}), 0),
+            'inflight': sorted(self.inflight_paths),
+        }
+        if self.concurrency:
+            status['adaptive_concurrency'] = {'limit': self.concurrency.limit, 'active': self.concurrency.active}
+        if self.retry_queue:
+            status['retry_queue'] = await asyncio.to_thread(self.retry_queue.counts)
+        return status
 
     async def process_channel(self, channel: str) -> None:
+        control = None
         try:
             logger.info(f'处理频道 ID: {channel}')
-            entity = await self.client.get_entity(int(channel))
+            channel_id_int = int(channel)
+            control = self._control(channel_id_int)
+            _, client, entity = await self.pool.assign(channel_id_int)
+            if client is None:
+                logger.error(f'没有账号能访问频道 {channel}，跳过')
+                return
             title = entity.title or channel
+            control.title, control.client, control.entity = title, client, entity
             logger.info(f'开始处理频道: {title}')
             retry_count = 0
             retry_delay = self.download_settings['initial_retry_delay']
-            sem = Semaphore(self.download_settings['max_concurrent_downloads'])
+            idle = self.live_idle.setdefault(channel_id_int, asyncio.Event())
+            if self.backfill_settings['enabled']:
+                control.backfill_task = asyncio.create_task(self.backfill_channel(channel_id_int, client, entity, title), name=f'backfill-{channel_id_int}')
 
             while not stop_event.is_set():
                 try:
-                    tasks = await self.preprocessor.fetch_valid_messages(entity)
+                    if control.paused:
+                        logger.info(f'频道 {title} 已暂停')
+                        await control.wait_running()
+                        logger.info(f'频道 {title} 已恢复')
+                    idle.clear()
+                    tasks = await self.preprocessor.fetch_valid_messages(entity, client)
                     if not tasks:
-                        logger.info(f'频道 {title} 暂无新消息，等待 {self.download_settings["wait_interval_seconds"]} 秒')
-                        await asyncio.sleep(self.download_settings['wait_interval_seconds'])
+                        wait = self.download_settings['wait_interval_seconds'] / control.weight
+                        logger.info(f'频道 {title} 暂无新消息，等待 {wait:.0f} 秒')
+                        idle.set()
+                        await control.sleep(self.download_settings['wait_interval_seconds'])
                         continue
 
-                    media_tasks = [t for t in tasks if t.get('kind') == 'telegram_media']
-                    link_tasks = [t for t in tasks if t.get('kind') == 'cloud_link']
+                    media_tasks = [t for t in tasks if isinstance(t, MediaTask)]
+                    link_tasks = [t for t in tasks if not isinstance(t, MediaTask) and t.get('kind') == 'cloud_link']
                     logger.info(f'{title} 资源任务: 媒体 {len(media_tasks)} 条，云盘链接 {len(link_tasks)} 条')
-                    media_jobs = [self._limited_download(sem, t['message'], title) for t in media_tasks]
+                    media_jobs = [self._limited_download(control, t, title) for t in media_tasks]
                     media_results = await asyncio.gather(*media_jobs)
                     link_success_ids = []
+                    if self.link_probe is not None and link_tasks:
+                        await self.link_probe.probe_all(link_tasks)
                     for lt in link_tasks:
                         ok = await self.handle_cloud_link(lt, title)
                         if ok:
                             link_success_ids.append(lt.get('message_id'))
 
-                    channel_id_int = int(channel)
                     success_ids = [mid for (mid, ok) in media_results if ok]
                     success_ids.extend([mid for mid in link_success_ids if mid])
+                    commit_start = time.time()
                     if success_ids:
                         new_last = max(success_ids)
-                        StateManager.set_last_id(channel_id_int, new_last)
+                        await asyncio.to_thread(StateManager.set_last_id, channel_id_int, new_last)
                         logger.info(f'频道 {title} 成功下载推进进度: last_id -> {new_last}')
+                    self._finish_traces(media_tasks, media_results, commit_start)
 
                     retry_count = 0
                     retry_delay = self.download_settings['initial_retry_delay']
@@ -1550,43 +6115,419 @@ class TelegramDownloader:
 
         except Exception as e:
             logger.error(f'处理频道 {channel} 时发生错误: {e}')
+        finally:
+            if control is not None and control.backfill_task is not None:
+                control.backfill_task.cancel()
+                await asyncio.gather(control.backfill_task, return_exceptions=True)
+
+    async def backfill_channel(self, channel_id: int, client, entity, title: str) -> None:
+        """历史回溯：从最新消息向更早的消息按整页倒序抓取，独立检查点，只在实时抓取空闲时运行
+
+        只处理消息自身的媒体与网盘链接，不与机器人交互，避免大量 /start 请求触发限流。
+        """
+        checkpoint = await asyncio.to_thread(StateManager.get_backfill, channel_id)
+        if checkpoint['done']:
+            logger.info(f'频道 {title} 历史回溯已完成，跳过')
+            return
+        page_size = self.backfill_settings['page_size']
+        offset_id = checkpoint['offset_id']
+        if not offset_id:
+            latest = await client.get_messages(entity, limit=1)
+            if not latest:
+                await asyncio.to_thread(StateManager.set_backfill, channel_id, 0, True)
+                return
+            # 从最新消息（含）开始向前回溯
+            offset_id = latest[0].id + 1
+        logger.info(f'频道 {title} 开始历史回溯: offset_id={offset_id}, 每页 {page_size} 条')
+
+        history = client
+        takeout_cm = None
+        if self.backfill_settings['use_takeout']:
+            try:
+                takeout_cm = client.takeout(finalize=True, channels=True, megagroups=True)
+                history = RateLimitedClient(await takeout_cm.__aenter__(), client.limiter)
+                logger.info(f'频道 {title} 历史回溯使用 takeout 会话')
+            except Exception as e:
+                takeout_cm = None
+                logger.warning(f'频道 {title} 无法创建 takeout 会话，使用普通会话回溯: {e}')
+
+        idle = self.live_idle.setdefault(channel_id, asyncio.Event())
+        control = self._control(channel_id)
+        seen_ids = self.preprocessor.seen_ids(channel_id)
+        try:
+            while not stop_event.is_set():
+                await idle.wait()
+                await control.wait_running()
+                page_start = time.time()
+                messages = [m async for m in history.iter_messages(entity, limit=page_size, offset_id=offset_id)]
+                page_end = time.time()
+                if not messages:
+                    await asyncio.to_thread(StateManager.set_backfill, channel_id, offset_id, True)
+                    logger.info(f'频道 {title} 历史回溯完成')
+                    break
+                # 跳过实时抓取已处理过的消息
+                pending = [m for m in messages if m.id not in seen_ids]
+                METRICS.inc('tgdl_messages_scanned_total', len(messages))
+                METRICS.inc('tgdl_messages_filtered_total', len(messages) - len(pending), reason='duplicate')
+                filter_start = time.time()
+                classified = await self.preprocessor.classifier.classify_messages(pending, channel_id)
+                filter_end = time.time()
+                MessageClassifier.record_metrics(classified)
+                media_tasks = []
+                link_tasks = []
+                for msg, result in zip(pending, classified):
+                    trace = TRACER.start(channel_id, msg.id, page_start)
+                    if trace is not None:
+                        trace.attributes['backfill'] = True
+                        trace.add('fetch', page_start, page_end)
+                        trace.add('filter', filter_start, filter_end, batch=len(pending))
+                    if result['download']:
+                        media_tasks.append(MediaTask.from_message(msg, channel_id, trace))
+                    else:
+                        TRACER.finish(trace, skipped=True, decision=result['skip_reason'])
+                    link_tasks.extend(result['cloud_tasks'])
+                media_results = await asyncio.gather(*[self._limited_download(self.backfill_sem, t, title) for t in media_tasks])
+                if self.link_probe is not None and link_tasks:
+                    await self.link_probe.probe_all(link_tasks)
+                for lt in link_tasks:
+                    await self.handle_cloud_link(lt, title)
+                offset_id = min(m.id for m in messages)
+                commit_start = time.time()
+                await asyncio.to_thread(StateManager.set_backfill, channel_id, offset_id)
+                self._finish_traces(media_tasks, media_results, commit_start)
+                logger.info(f'频道 {title} 历史回溯进度: offset_id -> {offset_id}（本页媒体 {len(media_tasks)} 条，云盘链接 {len(link_tasks)} 条）')
+        except Exception as e:
+            logger.error(f'频道 {title} 历史回溯出错，检查点 offset_id={offset_id}: {e}')
+        finally:
+            if takeout_cm is not None:
+                try:
+                    await takeout_cm.__aexit__(None, None, None)
+                except Exception as e:
+                    logger.debug(f'关闭 takeout 会话失败: {e}')
+
+    async def run_inventory(self, channels: list, out_dir: str, bandwidth_mbps: float, concurrency: int, restart: bool = False) -> None:
+        """盘点模式：并发扫描频道的全部历史，输出候选清单与待下载量，不下载"""
+        if not channels:
+            discovery = ChannelDiscovery(self.discovery_settings)
+            if discovery.has_rules():
+                channels = [ch['id'] for ch in await discovery.select(self.client, await discovery.discover(self.client, self.refresh_channels))]
+            else:
+                channels = self.config.get('selected_channels', [])
+        if not channels:
+            logger.error('没有要盘点的频道：请在 --inventory 后给出频道ID，或配置频道选择规则')
+            return
+        scanner = InventoryScanner(self.preprocessor.classifier, out_dir, bandwidth_mbps,
+                                   self.download_settings['completed_dir'] if self.sink.local else None)
+        sem = Semaphore(max(concurrency, 1))
+        logger.info(f'开始盘点 {len(channels)} 个频道，并发 {concurrency}，输出到 {out_dir}')
+
+        async def scan(channel: str):
+            async with sem:
+                channel_id = int(channel)
+                _, client, entity = await self.pool.assign(channel_id)
+                if client is None:
+                    logger.error(f'没有账号能访问频道 {channel}，跳过盘点')
+                    return None
+                try:
+                    return await scanner.scan(channel_id, client, entity, entity.title or channel, restart)
+                except Exception as e:
+                    logger.error(f'盘点频道 {channel} 出错，下次从检查点继续: {e}')
+                    return None
+
+        states = [s for s in await asyncio.gather(*[scan(ch) for ch in channels]) if s is not None]
+        print(scanner.summarize(states))
+
+    async def _run_coordinated(self, channels: list) -> None:
+        """多节点模式：只处理本节点持有租约的频道，租约变化时启动或取消对应任务"""
+        coordinator = LeaseCoordinator(self.coordination_settings)
+        logger.info(f'启用多节点协调，节点ID: {coordinator.worker_id}，频道总数 {len(channels)}')
+        running: dict[str, asyncio.Task] = {}
+        # 租约在最近一次成功续租开始后 ttl 秒到期；失联时提前一个心跳周期停止，不与接管节点重叠
+        margin = min(coordinator.heartbeat_seconds, coordinator.ttl / 3)
+        renewed = time.monotonic()
+        try:
+            while not stop_event.is_set():
+                started = time.monotonic()
+                deadline = renewed + coordinator.ttl - margin
+                synced = False
+                try:
+                    # 续租卡住（如共享卷上的 SQLite 锁等待）时同样不能越过安全期限
+                    held = set(await asyncio.wait_for(coordinator.sync(channels), timeout=deadline - started if running else coordinator.ttl))
+                    renewed = started
+                    synced = True
+                except Exception as e:
+                    # 存储暂不可用时，安全期限之前保持现状；到期则停止全部任务，避免与接管节点重复下载
+                    logger.error(f'同步频道租约失败: {e!r}')
+                    held = set(running) if time.monotonic() < deadline else set()
+                    if running and not held:
+                        logger.error(f'与租约存储失联已接近租期（{coordinator.ttl} 秒），停止全部频道任务')
+                for ch in list(running):
+                    if ch not in held or running[ch].done():
+                        task = running.pop(ch)
+                        task.cancel()
+                        if self.channel_tasks.get(int(ch)) is task:
+                            del self.channel_tasks[int(ch)]
+                for ch in held:
+                    if ch not in running:
+                        # 同时登记到 channel_tasks，控制接口移除频道时可立即取消
+                        running[ch] = self.channel_tasks[int(ch)] = asyncio.create_task(self.process_channel(ch), name=f'channel-{ch}')
+                timeout = coordinator.heartbeat_seconds
+                if not synced and running:
+                    # 失联期间不晚于安全期限再次检查
+                    timeout = max(min(timeout, deadline - time.monotonic()), 0)
+                try:
+                    await asyncio.wait_for(stop_event.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in running.values():
+                task.cancel()
+            await asyncio.gather(*running.values(), return_exceptions=True)
+            try:
+                await coordinator.release_all()
+            except Exception as e:
+                logger.warning(f'释放频道租约失败: {e}')
+
+    def health(self) -> tuple:
+        connected = sum(1 for c in self.pool.clients if c.is_connected())
+        healthy = connected > 0 and not stop_event.is_set()
+        return healthy, {'status': 'ok' if healthy else 'unavailable', 'accounts': len(self.pool.clients), 'connected': connected}
+
+    async def _start_metrics_server(self) -> MetricsServer | None:
+        if self.sink.local:
+            dirs = {self.download_settings['downloading_dir'], self.download_settings['completed_dir']}
+            METRICS.collectors['tgdl_disk_free_bytes'] = lambda: {
+                (('path', d),): psutil.disk_usage(d).free for d in dirs if os.path.exists(d)
+            }
+        server = MetricsServer(self.metrics_settings, METRICS, self.health)
+        try:
+            await server.start()
+        except OSError as e:
+            logger.error(f'指标端点启动失败: {e}')
+            return None
+        return server
 
     async def run(self) -> None:
         logger.info('启动下载器')
         await self.initialize()
+        TRACER.configure(self.tracing_settings)
 
-        enabled_channels = self.config.get('selected_channels', [])
-        if not enabled_channels:
+        enabled_channels = list(self.config.get('selected_channels', []))
+        if ChannelDiscovery(self.discovery_settings).has_rules():
+            # 按规则选择时每次启动重新匹配（对话列表缓存未过期时不请求 Telegram），新加入的频道随之生效
+            enabled_channels = await self.select_channels()
+        elif not enabled_channels:
             logger.info('没有选择频道，开始选择频道')
             enabled_channels = await self.select_channels()
 
+        # 后台任务（自适应并发采样等），随下载器退出一并取消
+        background = []
+        if self.concurrency:
+            background.append(asyncio.create_task(self.concurrency.run()))
+        if self.retention:
+            background.append(asyncio.create_task(self.retention.run(), name='retention'))
+        if self.retry_queue:
+            background.append(asyncio.create_task(self.retry_queue.run(self._retry_job), name='retry-queue'))
+        if self.bandwidth_settings['schedule']:
+            background.append(asyncio.create_task(self.bandwidth.run(), name='bandwidth-schedule'))
+        background.append(asyncio.create_task(MEMORY_BUDGET.run(), name='memory-budget'))
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, MEMORY_BUDGET.request_report)
+        except (NotImplementedError, AttributeError):
+            logger.debug('当前平台不支持 SIGUSR2，堆报告只能按 memory.heap_report_seconds 定期输出')
+        metrics_server = None
+        if self.metrics_settings['enabled']:
+            metrics_server = await self._start_metrics_server()
+        self.channels = [str(ch) for ch in enabled_channels]
+        control_server = None
+        if self.control_settings['enabled']:
+            control_server = ControlServer(self.control_settings, self)
+            try:
+                await control_server.start()
+            except OSError as e:
+                logger.error(f'控制接口启动失败: {e}')
+                control_server = None
         try:
-            tasks = []
-            for channel in enabled_channels:
+            if self.coordination_settings['enabled']:
+                # 传入同一个列表，控制接口增删的频道在下一次租约同步时生效
+                await self._run_coordinated(self.channels)
+                return
+            for channel in self.channels:
                 if stop_event.is_set():
                     break
-                task = asyncio.create_task(self.process_channel(channel))
-                tasks.append(task)
+                self._start_channel(channel)
 
-            logger.info(f'创建了 {len(tasks)} 个下载任务')
-            await asyncio.gather(*tasks)
+            logger.info(f'创建了 {len(self.channel_tasks)} 个下载任务')
+            # 启用控制接口时频道可随时增删，全部频道任务结束后仍等待直到收到退出信号
+            while True:
+                pending = [t for t in self.channel_tasks.values() if not t.done()]
+                if not pending and (control_server is None or stop_event.is_set()):
+                    break
+                if pending:
+                    await asyncio.wait(pending, timeout=1)
+                else:
+                    await asyncio.sleep(1)
         finally:
-            await self.client.disconnect()
+            if control_server is not None:
+                await control_server.close()
+            for task in background:
+                task.cancel()
+            await asyncio.gather(*background, return_exceptions=True)
+            if metrics_server is not None:
+                await metrics_server.close()
+            await self.close()
+            if self.preprocessor:
+                self.preprocessor.classifier.shutdown()
+            TRACER.close()
+            if self.retention:
+                self.retention.close()
+            if self.link_probe:
+                self.link_probe.close()
+            self.sink.close()
             logger.info('客户端已断开连接')
+            logger.info(f'账号池与 API 限流统计: {json.dumps(self.pool.stats(), ensure_ascii=False)}')
 
 def handle_sigint():
     logger.info('收到中断信号')
     stop_event.set()
 
 async def main():
-    logger.info('程序启动')
     parser = argparse.ArgumentParser(description='Telegram 媒体下载器')
     parser.add_argument('-r', '--reconfigure', action='store_true', help='仅进行配置更新，不启动下载')
     parser.add_argument('-c', '--clean', action='store_true', help='启动前清理未完成文件(.part)')
     parser.add_argument('--print-config', action='store_true', help='打印有效运行时配置并退出')
+    parser.add_argument('--profile', action='store_true', help='性能分析模式：监测事件循环卡顿，退出时汇总阻塞调用点')
+    parser.add_argument('--profile-engine', choices=CoroutineProfiler.ENGINES, help='--profile 模式下同时启用 cProfile 或 yappi，收到 SIGUSR1 时导出')
+    parser.add_argument('--lag-threshold-ms', type=int, default=int(os.getenv('TGDL_LAG_THRESHOLD_MS', '100')), help='事件循环卡顿报告阈值（毫秒）')
+    subparsers = parser.add_subparsers(dest='command', metavar='命令')
+    trace_summary = subparsers.add_parser('trace-summary', help='汇总逐消息追踪文件中各阶段耗时的 p50/p95/p99')
+    trace_summary.add_argument('path', nargs='?', help='追踪文件（jsonl 或 otlp），默认为 tracing.path')
+    retention = subparsers.add_parser('retention', help='按保留策略检查已完成文件，默认只报告将被淘汰的文件（dry-run）')
+    retention.add_argument('--apply', action='store_true', help='实际删除文件')
+    retention.add_argument('--limit', type=int, default=50, help='报告中列出的文件数')
+    parser.add_argument('--select-title', action='append', metavar='REGEX', help='按标题正则选择频道（可重复），覆盖 channel_discovery.title_patterns')
+    parser.add_argument('--select-id', action='append', metavar='ID', help='按频道ID选择（可重复），覆盖 channel_discovery.ids')
+    parser.add_argument('--select-folder', action='append', metavar='NAME', help='按 Telegram 文件夹选择（可重复，archived 表示归档），覆盖 channel_discovery.folders')
+    parser.add_argument('--select-has-media', action='store_true', help='只选择最新消息带文档的频道')
+    parser.add_argument('--refresh-channels', action='store_true', help='忽略对话列表缓存，重新枚举全部对话')
+    parser.add_argument('--inventory', nargs='*', metavar='CHANNEL_ID', help='盘点模式：只扫描不下载，统计频道待下载的文件与预计耗时；不给出频道时使用频道选择规则或 selected_channels')
+    parser.add_argument('--inventory-dir', default=os.getenv('TGDL_INVENTORY_DIR', os.path.join(DATA_DIR, 'inventory')), help='盘点清单、检查点与汇总的输出目录')
+    parser.add_argument('--inventory-concurrency', type=int, default=int(os.getenv('TGDL_INVENTORY_CONCURRENCY', '4')), help='同时盘点的频道数')
+    parser.add_argument('--inventory-restart', action='store_true', help='忽略检查点，重新盘点')
+    parser.add_argument('--bandwidth-mbps', type=float, default=float(os.getenv('TGDL_INVENTORY_BANDWIDTH_MBPS', '20')), help='估算下载耗时使用的带宽（Mbps）')
+    retry_queue = subparsers.add_parser('retry-queue', help='查看重试队列与死信，或把死信重新入队')
+    retry_queue.add_argument('action', choices=('list', 'requeue'), help='list 列出任务；requeue 把死信重新入队')
+    retry_queue.add_argument('keys', nargs='*', help='requeue 的任务 key（list 输出的第一列）')
+    retry_queue.add_argument('--dead', action='store_true', help='list 时列出死信而不是待重试任务')
+    retry_queue.add_argument('--all', action='store_true', help='requeue 全部死信')
+    pack = subparsers.add_parser('pack', help='查询、解出分片中的文件，封装当前分片或重建分片索引')
+    pack.add_argument('action', choices=('list', 'extract', 'finalize', 'reindex'), help='list 列出成员；extract 解出成员；finalize 封装当前分片；reindex 由 .idx 重建索引')
+    pack.add_argument('--message-id', type=int, help='按消息ID筛选')
+    pack.add_argument('--document-id', type=int, help='按文档ID筛选')
+    pack.add_argument('--channel-id', type=int, help='按频道ID筛选')
+    pack.add_argument('--name', help='按文件名筛选')
+    pack.add_argument('--limit', type=int, default=50, help='list 列出的条目数，0 表示全部')
+    pack.add_argument('-o', '--output', default='.', help='extract 的输出目录或文件路径')
+    control = subparsers.add_parser('control', help='通过控制接口调整运行中的下载器（需启用 control.enabled）')
+    control.add_argument('action', choices=('channels', 'queues', 'add', 'remove', 'pause', 'resume', 'set', 'backfill'), help='操作')
+    control.add_argument('channel', nargs='?', type=int, help='频道ID（channels、queues 之外的操作需要）')
+    control.add_argument('--weight', type=float, help='set: 轮询权重（2 表示以一半的间隔检查新消息）')
+    control.add_argument('--concurrency', type=int, help='set: 该频道的最大并发下载数')
+    control.add_argument('--restart', action='store_true', help='backfill: 从最新消息重新开始回溯')
+    parser.add_argument('--capture', metavar='PATH', help='把扫描到的每条消息（文本、实体、文档元数据，不含媒体内容）录制为 JSON Lines，供 benchmarks/replay_trace.py 离线回放')
     args = parser.parse_args()
+    if args.print_config or args.command:
+        # 打印配置与离线子命令：日志只写到 stderr、不创建日志文件，标准输出只有命令结果，可直接交给 jq 等工具
+        setup_logging(log_file=None, stream=sys.stderr)
+    else:
+        setup_logging()
+        logger.info('程序启动')
+    if args.print_config:
+        # 只解析配置，不构造下载器、不导入 telethon
+        config = ConfigManager.load_config() if os.path.exists(CONFIG_FILE) else {}
+        print(json.dumps(ConfigManager.effective_runtime_config(config), ensure_ascii=False, indent=2))
+        return
+    if args.command == 'trace-summary':
+        path = args.path or ConfigManager.get_tracing_settings(ConfigManager.load_config() if os.path.exists(CONFIG_FILE) else {})['path']
+        print(Tracer.summarize(path))
+        return
+    if args.command == 'retry-queue':
+        config = ConfigManager.load_config() if os.path.exists(CONFIG_FILE) else {}
+        queue = RetryQueue(ConfigManager.get_retry_queue_settings(config), ConfigManager.get_download_settings(config))
+        if args.action == 'list':
+            print(RetryQueue.format_jobs(queue.list_jobs(args.dead), args.dead))
+        elif not args.keys and not args.all:
+            parser.error('requeue 需要指定任务 key 或 --all')
+        else:
+            print(f'已重新入队 {queue.requeue(None if args.all else args.keys)} 个死信任务，运行中的下载器将在 poll_seconds 内执行')
+        return
+    if args.command == 'control':
+        settings = ConfigManager.get_control_settings(ConfigManager.load_config() if os.path.exists(CONFIG_FILE) else {})
+        if args.action not in ('channels', 'queues') and args.channel is None:
+            parser.error(f'{args.action} 需要频道ID')
+        method, path, body = {
+            'channels': ('GET', '/channels', None),
+            'queues': ('GET', '/queues', None),
+            'add': ('POST', '/channels', {'id': args.channel}),
+            'remove': ('DELETE', f'/channels/{args.channel}', None),
+            'pause': ('POST', f'/channels/{args.channel}/pause', None),
+            'resume': ('POST', f'/channels/{args.channel}/resume', None),
+            'set': ('PATCH', f'/channels/{args.channel}', {k: v for k, v in (('weight', args.weight), ('max_concurrent_downloads', args.concurrency)) if v is not None}),
+            'backfill': ('POST', f'/channels/{args.channel}/backfill', {'restart': args.restart}),
+        }[args.action]
+        host = '127.0.0.1' if settings['host'] in ('0.0.0.0', '') else settings['host']
+        headers = {'Authorization': f'Bearer {settings["token"]}'} if settings['token'] else {}
+        try:
+            resp = requests.request(method, f'http://{host}:{settings["port"]}{path}', json=body, headers=headers, timeout=30)
+        except requests.ConnectionError as e:
+            parser.exit(1, f'无法连接控制接口 {host}:{settings["port"]}（下载器未运行或未启用 control.enabled）: {e}\n')
+        print(json.dumps(resp.json(), ensure_ascii=False, indent=2))
+        if resp.status_code != 200:
+            parser.exit(1)
+        return
+    if args.command == 'pack':
+        config = ConfigManager.load_config() if os.path.exists(CONFIG_FILE) else {}
+        # 封装与重建索引需要独占分片目录；列出与解出只读索引和分片，可在下载器运行时执行
+        try:
+            packer = ShardPacker(ConfigManager.get_storage_settings(config)['pack'], writable=args.action in ('finalize', 'reindex'))
+        except PackLockedError as e:
+            parser.exit(1, f'{e}，请先停止下载器再执行 {args.action}\n')
+        try:
+            if args.action == 'finalize':
+                shard = packer.finalize()
+                print(f'已封装分片 {shard}' if shard else '没有未封装的分片')
+            elif args.action == 'reindex':
+                print(f'已由索引文件重建 {packer.reindex()} 个条目')
+            else:
+                entries = packer.index.find(args.name, args.message_id, args.document_id, args.channel_id,
+                                            args.limit if args.action == 'list' else None)
+                if args.action == 'list':
+                    for e in entries:
+                        print(f'{e["shard"]}  {e["offset"]:>12}  {e["size"]:>10}  {e["channel_id"] or "-":>14}  {e["message_id"] or "-":>8}  {e["name"]}')
+                elif not any(v is not None for v in (args.name, args.message_id, args.document_id)):
+                    parser.error('extract 需要 --name、--message-id 或 --document-id')
+                elif not entries:
+                    parser.error('分片中没有匹配的文件')
+                elif len(entries) > 1 and not os.path.isdir(args.output):
+                    parser.error(f'匹配到 {len(entries)} 个文件，--output 需要是目录（可加 --channel-id 缩小范围）')
+                else:
+                    for e in entries:
+                        print(f'已解出: {packer.extract(e, args.output)}')
+        finally:
+            packer.close()
+        return
+    if args.command == 'retention':
+        config = ConfigManager.load_config() if os.path.exists(CONFIG_FILE) else {}
+        manager = RetentionManager({**ConfigManager.get_retention_settings(config), 'dry_run': not args.apply},
+                                   ConfigManager.get_download_settings(config))
+        try:
+            print(manager.report(manager.enforce(), args.limit))
+        finally:
+            manager.close()
+        return
     env_reconfigure = os.getenv('TGDL_RECONFIGURE', '').lower() in ('1', 'true', 'yes')
     env_clean = os.getenv('TGDL_CLEAN_ON_START', '').lower() in ('1', 'true', 'yes')
+    profile = args.profile or os.getenv('TGDL_PROFILE', '').lower() in ('1', 'true', 'yes')
     loop = asyncio.get_running_loop()
     try:
         loop.add_signal_handler(signal.SIGINT, handle_sigint)
@@ -1602,23 +6543,67 @@ async def main():
         threading.Thread(target=windows_signal_listener, daemon=True).start()
         logger.debug('启动Windows信号监听器')
 
+    monitor = None
+    monitor_task = None
+    profiler = None
+    if profile:
+        monitor = LoopLagMonitor(args.lag_threshold_ms / 1000)
+        monitor_task = asyncio.create_task(monitor.run(), name='loop-lag-monitor')
+        logger.info(f'性能分析模式：报告超过 {args.lag_threshold_ms}ms 的事件循环阻塞')
+        engine = args.profile_engine or os.getenv('TGDL_PROFILE_ENGINE', '')
+        if engine:
+            profiler = CoroutineProfiler(engine)
+            profiler.start()
+            try:
+                loop.add_signal_handler(signal.SIGUSR1, lambda: logger.info(f'性能分析已导出: {profiler.dump()}'))
+            except (NotImplementedError, AttributeError):
+                logger.warning('当前平台不支持 SIGUSR1，分析结果将在退出时导出')
+    try:
+        await run_downloader(args, env_reconfigure, env_clean)
+    finally:
+        if monitor is not None:
+            monitor_task.cancel()
+            await asyncio.gather(monitor_task, return_exceptions=True)
+            monitor.log_summary()
+        if profiler is not None:
+            logger.info(f'性能分析已导出: {profiler.stop()}')
+
+async def run_downloader(args, env_reconfigure: bool, env_clean: bool) -> None:
     downloader = TelegramDownloader()
+    if args.capture:
+        downloader.capture_path = args.capture
+    for key, value in (('title_patterns', args.select_title), ('ids', args.select_id), ('folders', args.select_folder)):
+        if value:
+            downloader.discovery_settings[key] = value
+    if args.select_has_media:
+        downloader.discovery_settings['has_media'] = True
+    downloader.refresh_channels = args.refresh_channels
     if args.clean or env_clean:
         try:
             FileManager.cleanup_unfinished_files(downloader.download_settings)
         except Exception as e:
             logger.warning(f'启动前清理未完成文件发生错误: {e}')
-    if args.print_config:
+    if args.inventory is not None:
+        await downloader.initialize()
+        try:
+            await downloader.run_inventory(args.inventory, args.inventory_dir, args.bandwidth_mbps, args.inventory_concurrency, args.inventory_restart)
+        finally:
+            downloader.preprocessor.classifier.shutdown()
+            await downloader.close()
         return
     if args.reconfigure or env_reconfigure:
         await downloader.initialize()
         await downloader.select_channels()
-        await downloader.client.disconnect()
+        await downloader.close()
         logger.info('重配置完成，未启动下载')
         return
     await downloader.run()
 
 if __name__ == '__main__':
+    # 打包为可执行文件时，进程池子进程需要 freeze_support
+    multiprocessing.freeze_support()
+    setup_timezone()
+    # 日志在 main() 中按命令配置（打印配置与离线子命令不写日志文件）
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -14,12 +14,29 @@ ICON = 'icon.ico' if IS_WINDOWS else ('icon.icns' if IS_MAC else None)
 CONSOLE = True
 TARGET_ARCH = None
 
+# main.py 通过 LazyModule 按需导入这些模块，静态分析找不到，需显式打包；
+# socks 为 telethon 代理与 requests[socks] 运行时才导入的依赖
+HIDDEN_IMPORTS = [
+    'telethon',
+    'telethon.utils',
+    'telethon.errors',
+    'telethon.tl.types',
+    'telethon.tl.functions.messages',
+    'requests',
+    'tqdm',
+    'mutagen',
+    'mutagen.flac',
+    'mutagen.id3',
+    'psutil',
+    'socks',
+]
+
 a = Analysis(
     ['main.py'],
     pathex=[],
     binaries=[],
     datas=[],
-    hiddenimports=[],
+    hiddenimports=HIDDEN_IMPORTS,
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],